@@ -1,2 +1,3 @@
 from harness import Harness, main
 from session_processor import PersistentSessionProcessor, SessionProcessor
+from update_parser import PacketSeries
@@ -1,15 +1,45 @@
 from collections import defaultdict
-from datetime import datetime, timedelta
-from itertools import ifilter
+from itertools import ifilter, izip
 import re
 
 from session_processor import PersistentSessionProcessor
+from symbol_table import intern_update, SymbolTable
+from update_parser import duration, PacketSeries
+
+# How often to expire stale DNS mappings, in seconds of update time.
+GARBAGE_COLLECTION_INTERVAL = 30
+
+# None of these processors use the global context, so they are all mergeable
+# and retractable.
+
+class SymbolTableSessionProcessor(PersistentSessionProcessor):
+
+    """Interns the anonymized IPs, MAC addresses and domains of every update
+    into a symbol table shared by all of a session's updates, and stored in
+    the persistent context. List it before the other correlation processors,
+    so the flows, addresses and DNS mappings they store reference shared
+    identifiers instead of fresh copies from every update."""
+
+    mergeable = True
+    retractable = True
+
+    def initialize_context(self, context):
+        context.symbols = SymbolTable()
+
+    def process_update_persistent(self, context, update):
+        intern_update(update, context.symbols)
+
+    def complete_session_persistent(self, context):
+        context.symbols.prune()
 
 class FlowCorrelationSessionProcessor(PersistentSessionProcessor):
 
     """Builds a table mapping flow IDs to flow objects. Flow IDs are opaque
     identifiers from update files."""
 
+    mergeable = True
+    retractable = True
+
     def initialize_context(self, context):
         context.flows = dict()
 
@@ -22,6 +52,9 @@ class MacAddressCorrelationSessionProcessor(PersistentSessionProcessor):
     """Builds tables mapping IPs to MAC addresses and address table indices.
     Address table indices are opaque identifiers from update files."""
 
+    mergeable = True
+    retractable = True
+
     def initialize_context(self, context):
         context.ip_to_mac_address_map = dict()
         context.ip_to_mac_address_index_map = dict()
@@ -37,12 +70,19 @@ class MacAddressCorrelationSessionProcessor(PersistentSessionProcessor):
 class DomainCorrelationSessionProcessor(PersistentSessionProcessor):
 
     """Builds a table mapping address table IDs and IP addresses to domain
-    names. This represents the set of valid DNS mappings for each device."""
+    names. This represents the set of valid DNS mappings for each device.
+
+    Mappings are valid from (start, end) timestamps, which have the same type
+    as the timestamps of the updates. With raw_timestamps updates, all interval
+    arithmetic is on integer microseconds."""
+
+    mergeable = True
+    retractable = True
 
     def initialize_context(self, context):
         context.ip_to_domain_map = defaultdict(set)
         context._domain_to_a_record_map = defaultdict(list)
-        context._latest_timestamp = datetime.min
+        context._latest_timestamp = None
 
     def process_update_persistent(self, context, update):
         for a_record in update.a_records:
@@ -54,7 +94,9 @@ class DomainCorrelationSessionProcessor(PersistentSessionProcessor):
         for cname_record in update.cname_records:
             self.process_cname_record(
                     context, cname_record, update.packet_series)
-        if update.timestamp - context._latest_timestamp > timedelta(seconds=30):
+        if context._latest_timestamp is not None \
+                and update.timestamp - context._latest_timestamp \
+                > duration(update, GARBAGE_COLLECTION_INTERVAL):
             self.garbage_collect_tables(context)
         context._latest_timestamp = update.timestamp
 
@@ -96,6 +138,8 @@ class DomainCorrelationSessionProcessor(PersistentSessionProcessor):
             context.ip_to_domain_map[ip_key].add(domain_record)
 
     def garbage_collect_tables(self, context):
+        if context._latest_timestamp is None:
+            return
         for key in context.ip_to_domain_map.keys():
             new_mappings = set(ifilter(
                  lambda (anon, domain, start, end): end >= context._latest_timestamp,
@@ -122,11 +166,14 @@ class WhitelistedDomainCorrelationSessionProcessor(PersistentSessionProcessor):
     domain names, without their subdomains. This represents the set of valid DNS
     mappings to whitelisted domains for each device."""
 
+    mergeable = True
+    retractable = True
+
     def initialize_context(self, context):
         context.whitelist = set()
         context.ip_to_domain_map = defaultdict(set)
         context._domain_to_a_record_map = defaultdict(list)
-        context._latest_timestamp = datetime.min
+        context._latest_timestamp = None
 
     def process_update_persistent(self, context, update):
         for domain in update.whitelist:
@@ -185,6 +232,8 @@ class WhitelistedDomainCorrelationSessionProcessor(PersistentSessionProcessor):
                     context.ip_to_domain_map[ip_key].add(domain_record)
 
     def garbage_collect_tables(self, context):
+        if context._latest_timestamp is None:
+            return
         for key in context.ip_to_domain_map.keys():
             new_mappings = set(ifilter(
                  lambda (anon, domain, start, end): end >= context._latest_timestamp,
@@ -210,6 +259,9 @@ class FlowToDomainCorrelationSessionProcessor(PersistentSessionProcessor):
     """Builds a map from flow IDs to domains for that flow. Flow IDs are opaque
     identifiers from updates."""
 
+    mergeable = True
+    retractable = True
+
     def initialize_context(self, context):
         context.flow_to_domain_map = dict()
 
@@ -218,11 +270,17 @@ class FlowToDomainCorrelationSessionProcessor(PersistentSessionProcessor):
         for entry in update.flow_table:
             new_flows.add(entry.flow_id)
 
+        packet_series = update.packet_series
+        if isinstance(packet_series, PacketSeries) \
+                and packet_series.raw_timestamps:
+            packets = izip(packet_series.flow_ids, packet_series.timestamps)
+        else:
+            packets = ((packet.flow_id, packet.timestamp)
+                       for packet in packet_series)
         first_timestamps = dict()
-        for packet in update.packet_series:
-            if packet.flow_id not in first_timestamps \
-                    and packet.flow_id in new_flows:
-                first_timestamps[packet.flow_id] = packet.timestamp
+        for flow_id, timestamp in packets:
+            if flow_id not in first_timestamps and flow_id in new_flows:
+                first_timestamps[flow_id] = timestamp
 
         for flow in update.flow_table:
             context.flow_to_domain_map[flow.flow_id] = set()
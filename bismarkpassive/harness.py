@@ -1,8 +1,10 @@
 from abc import abstractmethod, ABCMeta
+from calendar import timegm
 from errno import EEXIST
 from optparse import OptionParser
 from os import makedirs
 from os.path import join
+from time import strptime
 
 from process_sessions import process_sessions
 
@@ -108,13 +110,31 @@ class Harness(object):
 
         The global context contains the results of all the processors we ran."""
 
+# Formats accepted by --start-time and --end-time, besides Unix timestamps.
+TIME_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S']
+
+def parse_time(value):
+    """Parse a Unix timestamp or a UTC date and time in one of TIME_FORMATS
+    into a Unix timestamp."""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for time_format in TIME_FORMATS:
+        try:
+            return timegm(strptime(value, time_format))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time %r' % value)
+
 def parse_args(HarnessClass):
     usage = 'usage: %prog [options] ' \
             'database_backend database_name pickles_directory'
     parser = OptionParser(usage=usage)
     parser.add_option('-t', '--temp-pickles-dir', action='store',
-                      dest='temp_pickles_dir', default='/dev/shm',
-                      help='Directory for temporary runtime pickle storage')
+                      dest='temp_pickles_dir',
+                      help='Ignored; workers no longer store results in '
+                           'temporary pickles')
     parser.add_option('-w', '--workers', type='int', action='store',
                       dest='workers',
                       help='Maximum number of worker threads to use')
@@ -124,15 +144,45 @@ def parse_args(HarnessClass):
     parser.add_option('-g', '--cached-global-context', action='store',
                       dest='cached_global_context',
                       help='Attempt to cache global context to the given filename')
+    parser.add_option('--incremental-global-context', action='store',
+                      dest='incremental_global_context',
+                      help='Cache the contribution of each session to the '
+                           'global context in the given filename, and only '
+                           'merge sessions with new updates again')
     parser.add_option('-r', '--run-name', action='store',
                       dest='run_name', default='default',
                       help='Assign a name to this processing run')
+    parser.add_option('--start-time', action='store',
+                      dest='start_time',
+                      help='Only process updates written at or after this time '
+                           '(YYYY-MM-DD [HH:MM[:SS]] UTC or a Unix timestamp)')
+    parser.add_option('--end-time', action='store',
+                      dest='end_time',
+                      help='Only process updates written before this time')
+    parser.add_option('--prefetch', action='store_true',
+                      dest='prefetch', default=False,
+                      help='Read updates from the index in a background thread')
+    parser.add_option('--pipeline-updates', type='int', action='store',
+                      dest='pipeline_updates',
+                      help='Read the updates of sessions with at least this '
+                           'many new updates in a separate process, which '
+                           'unlike --prefetch also runs the Python work of '
+                           'reading in parallel')
     parser.add_option('--indexer-postgres-user', action='store',
                       dest='indexer_postgres_user',
                       help='Log into Postgres as this user')
     parser.add_option('--indexer-postgres-host', action='store',
                       dest='indexer_postgres_host',
                       help='Log into Postgres on this host')
+    parser.add_option('--indexer-sqlite-cache-size', type='int',
+                      action='store', dest='indexer_sqlite_cache_size',
+                      help='Kilobytes of sqlite index pages to cache')
+    parser.add_option('--indexer-sqlite-mmap-size', type='int',
+                      action='store', dest='indexer_sqlite_mmap_size',
+                      help='Bytes of the sqlite index to memory map')
+    parser.add_option('--indexer-postgres-fetch-size', type='int',
+                      action='store', dest='indexer_postgres_fetch_size',
+                      help='Fetch this many updates at a time from Postgres')
     HarnessClass.setup_options(parser)
     options, args = parser.parse_args()
     if len(args) != 3:
@@ -141,11 +191,25 @@ def parse_args(HarnessClass):
                   'database_name': args[1],
                   'pickles_directory': args[2],
                 }
+    for name in ['start_time', 'end_time']:
+        if getattr(options, name) is not None:
+            try:
+                setattr(options, name, parse_time(getattr(options, name)))
+            except ValueError, e:
+                parser.error(str(e))
     database_options = {}
     if options.indexer_postgres_host is not None:
         database_options['postgres_host'] = options.indexer_postgres_host
     if options.indexer_postgres_user is not None:
         database_options['postgres_user'] = options.indexer_postgres_user
+    if options.indexer_sqlite_cache_size is not None:
+        database_options['sqlite_cache_size'] = \
+                options.indexer_sqlite_cache_size
+    if options.indexer_sqlite_mmap_size is not None:
+        database_options['sqlite_mmap_size'] = options.indexer_sqlite_mmap_size
+    if options.indexer_postgres_fetch_size is not None:
+        database_options['postgres_fetch_size'] = \
+                options.indexer_postgres_fetch_size
     return options, mandatory, database_options
 
 def main(HarnessClass):
@@ -167,7 +231,12 @@ def main(HarnessClass):
                      options.temp_pickles_dir,
                      options.workers,
                      options.ignore_pickles,
-                     options.cached_global_context)
+                     options.cached_global_context,
+                     options.start_time,
+                     options.end_time,
+                     options.prefetch,
+                     options.incremental_global_context,
+                     options.pipeline_updates)
 
 # You can't run this harness, since it's an abstract class. To run your own
 # harness, put the following lines in the module with your harness, replacing
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+from cStringIO import StringIO
 from glob import iglob
 from gzip import GzipFile
 from hashlib import md5
-from itertools import chain, ifilter, imap
+from io import BufferedReader
+from itertools import ifilter, imap
+from multiprocessing import cpu_count, Process, Queue
 from optparse import OptionParser
 from os.path import basename, join, splitext
 try:
@@ -16,62 +19,148 @@ except ImportError:
     print "Install the 'progressbar' package if " \
             "you're curious how long this will take"
     progressbar = None
+import sys
 import tarfile
+from threading import Thread
+import traceback
 
 from update_parser import PassiveUpdate
-from updates_index import UpdatesIndexer
+from updates_index import map_update, UpdatesIndexer
 
-def verify_checksum(tarname):
+# How many tarballs each worker can have waiting in each queue.
+TASKS_PER_WORKER = 2
+
+# How many bytes to read from tarballs at a time.
+CHUNK_SIZE = 64 * 1024
+
+class HashingReader(object):
+    """A read-only file wrapper that computes the MD5 sum of everything read
+    through it, so a file can be verified while it's being parsed."""
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._hasher = md5()
+
+    def read(self, size=-1):
+        data = self._handle.read(size)
+        self._hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        """Read the rest of the file and return its MD5 sum."""
+        while self.read(CHUNK_SIZE):
+            pass
+        return self._hasher.hexdigest()
+
+def expected_checksum(tarname):
     try:
-        true_sum = splitext(basename(tarname))[0].split('_')[3]
+        return splitext(basename(tarname))[0].split('_')[3]
     except IndexError:
-        true_sum = None
-    if true_sum is not None:
-        hasher = md5()
-        hasher.update(open(tarname, 'r').read())
-        if hasher.hexdigest() != true_sum:
-            print 'skipping', tarname, '(invalid hash)'
-            return False
-    return True
-
-def process_tarfile(tarname):
-    tarball = tarfile.open(tarname, 'r')
-    def extract_update(tarmember):
-        tarhandle = tarball.extractfile(tarmember.name)
+        return None
+
+def process_tarfile(tarname, fileobj=None, **parser_options):
+    """Parse the updates in a tarball in a single pass over the file."""
+    tarball = tarfile.open(tarname, 'r|', fileobj=fileobj)
+    def parse_update(tarmember):
+        # GzipFile seeks backwards, which tarball streams don't allow, so
+        # read each (small) member into memory first.
+        tarhandle = StringIO(tarball.extractfile(tarmember).read())
         try:
-            return GzipFile(fileobj=tarhandle).read()
+            return PassiveUpdate(BufferedReader(GzipFile(fileobj=tarhandle)),
+                                 **parser_options)
         except IOError:
             print 'skipping', tarname, '(IO Error)'
             return None
-    update_contents = ifilter(lambda el: el is not None,
-                              imap(extract_update,
-                                   tarball.getmembers()))
-    return imap(PassiveUpdate, update_contents)
+    return ifilter(lambda el: el is not None,
+                   imap(parse_update, ifilter(tarfile.TarInfo.isfile, tarball)))
+
+def encode_tarfile(tarname, parser_options):
+    """Parse and encode every update in a tarball, verifying the tarball's
+    checksum as it's read. Return None if the tarball is invalid."""
+    with open(tarname, 'rb', CHUNK_SIZE) as handle:
+        reader = HashingReader(handle)
+        try:
+            encoded = map(map_update,
+                          process_tarfile(tarname, reader, **parser_options))
+        except tarfile.TarError:
+            encoded = None
+        checksum = reader.hexdigest()
+    true_sum = expected_checksum(tarname)
+    if true_sum is not None and checksum != true_sum:
+        print 'skipping', tarname, '(invalid hash)'
+        return None
+    if encoded is None:
+        print 'skipping', tarname, '(invalid tarball)'
+    return encoded
+
+def ingestion_worker(tasks, results, parser_options):
+    while True:
+        tarname = tasks.get()
+        if tarname is None:
+            break
+        try:
+            results.put((tarname, encode_tarfile(tarname, parser_options)))
+        except:
+            print 'skipping', tarname, '(unexpected error)'
+            traceback.print_exc(file=sys.stdout)
+            results.put((tarname, None))
+    results.put(None)
+
+def encode_tarfiles(tarnames, parser_options, num_workers):
+    """Yield (tarname, encoded_updates) for every tarball, with
+    encoded_updates set to None for invalid tarballs.
+
+    A pool of num_workers processes (or one per CPU if num_workers is None)
+    parses, encodes and verifies the tarballs, and bounded queues keep them at
+    most a few tarballs ahead of the consumer. Results arrive in the order the
+    workers finish them. If num_workers is 0, do everything in this process."""
+    if num_workers == 0:
+        for tarname in tarnames:
+            yield tarname, encode_tarfile(tarname, parser_options)
+        return
+    if num_workers is None:
+        num_workers = cpu_count()
+    tasks = Queue(TASKS_PER_WORKER * num_workers)
+    results = Queue(TASKS_PER_WORKER * num_workers)
+    workers = [Process(target=ingestion_worker,
+                       args=(tasks, results, parser_options))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    def feed_tasks():
+        for tarname in tarnames:
+            tasks.put(tarname)
+        for _ in workers:
+            tasks.put(None)
+    feeder = Thread(target=feed_tasks)
+    feeder.daemon = True
+    feeder.start()
+    workers_running = len(workers)
+    while workers_running > 0:
+        result = results.get()
+        if result is None:
+            workers_running -= 1
+        else:
+            yield result
+    feeder.join()
+    for worker in workers:
+        worker.join()
 
 def index_traces(updates_directory,
                  database_backend,
                  database_name,
+                 parser_options=None,
+                 num_workers=None,
                  **database_options):
+    if parser_options is None:
+        parser_options = {}
     index = UpdatesIndexer(
             database_backend, database_name, **database_options)
 
     tarnames_processed = set(index.tarnames)
-    tarnames_unprocessed = filter(lambda f: basename(f) not in tarnames_processed,
-                                  iglob(join(updates_directory, '*.tar')))
-    number_to_verify = len(tarnames_unprocessed)
-    print 'Verifying %d tarfile checksums' % number_to_verify
-    if number_to_verify == 0:
-        return
-    if progressbar is not None:
-        vprogress = progressbar.ProgressBar(
-                maxval=number_to_verify,
-                widgets=[progressbar.SimpleProgress(),
-                         progressbar.Bar(),
-                         progressbar.Timer()])
-    else:
-        vprogress = lambda x: x
-    tarnames = sorted(filter(verify_checksum, vprogress(tarnames_unprocessed)))
-
+    tarnames = sorted(filter(lambda f: basename(f) not in tarnames_processed,
+                             iglob(join(updates_directory, '*.tar'))))
     number_of_tarfiles = len(tarnames)
     print 'Found %d new tar files' % number_of_tarfiles
     if number_of_tarfiles == 0:
@@ -85,14 +174,45 @@ def index_traces(updates_directory,
                          progressbar.Timer()])
     else:
         progress = lambda x: x
-    index.index(imap(basename, tarnames),
-                chain.from_iterable(imap(process_tarfile, progress(tarnames))),
-                reindex)
+
+    # The indexer records tarnames only after it consumes all the updates, so
+    # this list is complete by the time it's used.
+    valid_tarnames = []
+    def encoded_updates():
+        for tarname, encoded in progress(
+                encode_tarfiles(tarnames, parser_options, num_workers)):
+            if encoded is not None:
+                valid_tarnames.append(basename(tarname))
+                for encoded_update in encoded:
+                    yield encoded_update
+    index.index(valid_tarnames, encoded_updates(), reindex)
 
 def main():
     usage = 'usage: %prog [options] ' \
             'updates_directory database_backend database_name'
     parser = OptionParser(usage=usage)
+    parser.add_option('--columnar', action='store_true',
+                      dest='columnar', default=False,
+                      help='Store packet series as compact columnar arrays')
+    parser.add_option('--raw-timestamps', action='store_true',
+                      dest='raw_timestamps', default=False,
+                      help='Store timestamps as integer microseconds')
+    parser.add_option('-w', '--workers', type='int', action='store',
+                      dest='workers',
+                      help='Number of worker processes to parse tarballs with '
+                           '(0 to parse in the indexing process)')
+    parser.add_option('--sqlite-journal-mode', action='store',
+                      dest='sqlite_journal_mode',
+                      help='Journal mode for sqlite indexes (default WAL, '
+                           'except for initial builds and reindexing)')
+    parser.add_option('--shard-by', action='store',
+                      dest='shard_by',
+                      help='Split a sqlite-sharded index by node or month '
+                           '(default node)')
+    parser.add_option('--shard-writers', type='int', action='store',
+                      dest='shard_writers',
+                      help='Number of processes to write shards with '
+                           '(default one per CPU)')
     parser.add_option('--postgres-user', action='store',
                       dest='postgres_user',
                       help='Log into Postgres as this user')
@@ -103,11 +223,23 @@ def main():
     if len(args) != 3:
         parser.error('Invalid number of required options')
     database_options = {}
+    if options.sqlite_journal_mode is not None:
+        database_options['sqlite_journal_mode'] = options.sqlite_journal_mode
+    if options.shard_by is not None:
+        database_options['shard_by'] = options.shard_by
+    if options.shard_writers is not None:
+        database_options['shard_writers'] = options.shard_writers
     if options.postgres_host is not None:
         database_options['postgres_host'] = options.postgres_host
     if options.postgres_user is not None:
         database_options['postgres_user'] = options.postgres_user
-    index_traces(*args, **database_options)
+    parser_options = { 'columnar': options.columnar,
+                       'raw_timestamps': options.raw_timestamps,
+                     }
+    index_traces(*args,
+                 parser_options=parser_options,
+                 num_workers=options.workers,
+                 **database_options)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,90 @@
+import index_traces
+import update_parser_benchmark
+from updates_index import UpdatesReader
+
+from cStringIO import StringIO
+from gzip import GzipFile
+from hashlib import md5
+from os.path import join
+from shutil import rmtree
+import sys
+import tarfile
+from tempfile import mkdtemp
+import unittest
+
+def tarball_contents(seed, sequence_numbers):
+    """Return the contents of a tarball of gzipped updates."""
+    contents = StringIO()
+    tarball = tarfile.open(fileobj=contents, mode='w')
+    updates = update_parser_benchmark.small_updates([seed], sequence_numbers)
+    for sequence_number, data in zip(sequence_numbers, updates):
+        update = StringIO()
+        handle = GzipFile(mode='w', fileobj=update)
+        handle.write(data)
+        handle.close()
+        member = tarfile.TarInfo(
+                name='OWBENCHMARK%d-%d.gz' % (seed, sequence_number))
+        member.size = update.tell()
+        update.seek(0)
+        tarball.addfile(member, update)
+    tarball.close()
+    return contents.getvalue()
+
+class TestHashingReader(unittest.TestCase):
+    def test_hexdigest(self):
+        data = 'x' * (3 * index_traces.CHUNK_SIZE + 5)
+        reader = index_traces.HashingReader(StringIO(data))
+        self.assertEqual(reader.read(10), data[:10])
+        self.assertEqual(reader.hexdigest(), md5(data).hexdigest())
+        self.assertEqual(reader.read(), '')
+
+class TestIndexTraces(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        rmtree(self.directory)
+
+    def write_tarball(self, seed, sequence_numbers, checksum=None):
+        contents = tarball_contents(seed, sequence_numbers)
+        if checksum is None:
+            checksum = md5(contents).hexdigest()
+        tarname = join(self.directory, 'OWBENCHMARK%d_%d_%d_%s.tar'
+                       % (seed, 1300000000 + seed, sequence_numbers[0],
+                          checksum))
+        open(tarname, 'wb').write(contents)
+        return tarname
+
+    def test_encode_tarfile(self):
+        tarname = self.write_tarball(0, range(3))
+        encoded = index_traces.encode_tarfile(tarname, {})
+        self.assertEqual([row[3] for node_id, row, data in encoded], range(3))
+        bad_tarname = self.write_tarball(1, range(3), checksum='0' * 32)
+        self.assertEqual(index_traces.encode_tarfile(bad_tarname, {}), None)
+
+    def test_skip_invalid_checksum(self):
+        self.write_tarball(0, range(3))
+        self.write_tarball(1, range(3), checksum='0' * 32)
+        self.write_tarball(2, range(3, 5))
+        for num_workers in [0, 2]:
+            database = join(self.directory, 'index%d.sqlite' % num_workers)
+            index_traces.index_traces(self.directory,
+                                      'sqlite',
+                                      database,
+                                      num_workers=num_workers)
+            reader = UpdatesReader('sqlite', database)
+            self.assertEqual(sorted((session.node_id, session.update_count)
+                                    for session in reader.session_catalog),
+                             [('OWBENCHMARK0', 3), ('OWBENCHMARK2', 2)])
+            reader.close()
+            indexer = index_traces.UpdatesIndexer('sqlite', database)
+            self.assertEqual(len(indexer.tarnames), 2)
+            self.assertFalse(any(tarname.startswith('OWBENCHMARK1_')
+                                 for tarname in indexer.tarnames))
+            indexer.close()
+
+if __name__ == '__main__':
+    unittest.main()
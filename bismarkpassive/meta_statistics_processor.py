@@ -9,6 +9,8 @@ def min_date():
     return datetime.min
 
 class MetaStatisticsProcessor(SessionProcessor):
+    mergeable = True
+
     def initialize_ephemeral_context(self, context):
         context.oldest_timestamp = datetime.max
         context.newest_timestamp = datetime.min
@@ -53,3 +55,21 @@ class MetaStatisticsProcessor(SessionProcessor):
         global_context.newest_timestamp_per_anyonymization_context[key] = \
                 max(global_context.newest_timestamp_per_anyonymization_context[key],
                     ephemeral_context.newest_timestamp)
+
+    def combine_global_contexts(self, global_context, partial_global_context):
+        global_context.oldest_timestamp = \
+                min(global_context.oldest_timestamp,
+                    partial_global_context.oldest_timestamp)
+        global_context.newest_timestamp = \
+                max(global_context.newest_timestamp,
+                    partial_global_context.newest_timestamp)
+        for name in ['oldest_timestamp_per_node',
+                     'oldest_timestamp_per_anonymization_context']:
+            timestamps = getattr(global_context, name)
+            for key, timestamp in getattr(partial_global_context, name).items():
+                timestamps[key] = min(timestamps[key], timestamp)
+        for name in ['newest_timestamp_per_node',
+                     'newest_timestamp_per_anyonymization_context']:
+            timestamps = getattr(global_context, name)
+            for key, timestamp in getattr(partial_global_context, name).items():
+                timestamps[key] = max(timestamps[key], timestamp)
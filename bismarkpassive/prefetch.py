@@ -0,0 +1,227 @@
+"""
+Read ahead of a consumer in a background thread or process.
+
+read_ahead() iterates over a producer in its own thread and hands items to the
+consumer through a bounded queue. This only helps when the producer spends
+its time outside the GIL (waiting on a database or in zlib), which is what
+reading updates from the index does.
+
+ReadAheadProcess runs producers in a forked child process instead, so they run
+in parallel with the consumer even while both hold the GIL. Items are pickled
+across a pipe, so they should be cheap to pickle.
+"""
+
+from multiprocessing import Pipe
+from multiprocessing.util import Finalize
+from os import _exit, fork, getpid, waitpid
+from Queue import Empty, Full, Queue
+import sys
+from threading import Event, Thread
+import traceback
+
+# Items are passed between threads in batches of this many, and the producer
+# can have this many batches waiting for the consumer.
+PREFETCH_BATCH_SIZE = 16
+PREFETCH_QUEUE_SIZE = 4
+
+# How long the producer waits on a full queue before checking whether the
+# consumer has stopped.
+POLL_INTERVAL = 0.1
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class _ProcessFailure(object):
+    def __init__(self, formatted_traceback):
+        self.traceback = formatted_traceback
+
+class _Stop(object):
+    pass
+
+def read_ahead(iterable,
+               batch_size=PREFETCH_BATCH_SIZE,
+               queue_size=PREFETCH_QUEUE_SIZE):
+    """Yield the items of iterable, which is read by a background thread.
+    Exceptions raised by iterable are raised again here. If the consumer stops
+    early, the thread stops reading and this waits for it to exit."""
+    queue = Queue(queue_size)
+    stopped = Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        batch = []
+        try:
+            for item in iterator:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(None)
+        except:
+            exc_info = sys.exc_info()
+            if not batch or put(batch):
+                put(_Failure(exc_info))
+        finally:
+            # Generators must be closed in the thread that runs them.
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, _Failure):
+                raise batch.exc_info[0], batch.exc_info[1], batch.exc_info[2]
+            for item in batch:
+                yield item
+    finally:
+        stopped.set()
+        # Unblock a producer waiting on a full queue.
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        thread.join()
+
+def _serve_requests(produce, requests, results, batch_size):
+    """Run produce for every request until the requests pipe closes or sends
+    None, and send back batches of the items it produces, followed by None. A
+    _Stop from the consumer ends the current request early."""
+    while True:
+        try:
+            request = requests.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        if isinstance(request, _Stop):
+            # The request it was meant for already finished.
+            continue
+        iterator = None
+        batch = []
+        try:
+            iterator = iter(produce(request))
+            for item in iterator:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    results.send(batch)
+                    batch = []
+                    if requests.poll():
+                        # Only a _Stop can arrive before the end of a request.
+                        requests.recv()
+                        break
+            else:
+                if batch:
+                    results.send(batch)
+            results.send(None)
+        except (EOFError, IOError):
+            return
+        except:
+            failure = _ProcessFailure(traceback.format_exc())
+            if batch:
+                results.send(batch)
+            results.send(failure)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+class ReadAheadProcess(object):
+
+    """A child process that reads ahead of this one. For every request it's
+    sent, the child calls produce(request) and sends the items back in
+    batches, so producing runs in parallel with the consumer even while both
+    hold the GIL. The child blocks once the pipe between them is full.
+
+    The child is forked when this is created and serves requests until this
+    process exits. Create it before this process starts threads or opens
+    database connections, which don't survive forking, and let produce open
+    its own. Requests and items are pickled, so they should be cheap to
+    pickle."""
+
+    def __init__(self, produce, batch_size=PREFETCH_BATCH_SIZE):
+        self.owner = getpid()
+        requests_reader, self._requests = Pipe(duplex=False)
+        self._results, results_writer = Pipe(duplex=False)
+        self._pid = fork()
+        if self._pid == 0:
+            self._requests.close()
+            self._results.close()
+            status = 0
+            try:
+                _serve_requests(produce,
+                                requests_reader,
+                                results_writer,
+                                batch_size)
+            except:
+                status = 1
+            # Skip the exit handlers of the parent, like multiprocessing's.
+            _exit(status)
+        requests_reader.close()
+        results_writer.close()
+        Finalize(None, self.close, exitpriority=10)
+
+    def _receive(self):
+        try:
+            return self._results.recv()
+        except EOFError:
+            self.close()
+            raise RuntimeError('Read ahead process exited unexpectedly')
+
+    def read(self, request):
+        """Yield the items the child produces for request. Only read one
+        request at a time. Failures in the child are raised here as
+        RuntimeError."""
+        if self._pid is None:
+            raise RuntimeError('Read ahead process is closed')
+        self._requests.send(request)
+        finished = False
+        try:
+            while True:
+                batch = self._receive()
+                if batch is None:
+                    finished = True
+                    break
+                if isinstance(batch, _ProcessFailure):
+                    finished = True
+                    raise RuntimeError('Read ahead process failed:\n%s'
+                                       % batch.traceback)
+                for item in batch:
+                    yield item
+        finally:
+            if not finished and self._pid is not None:
+                # Stop the child early and skip what it already sent.
+                self._requests.send(_Stop())
+                while True:
+                    batch = self._receive()
+                    if batch is None or isinstance(batch, _ProcessFailure):
+                        break
+
+    def close(self):
+        if self._pid is None or self.owner != getpid():
+            return
+        try:
+            self._requests.send(None)
+        except IOError:
+            pass
+        self._requests.close()
+        self._results.close()
+        waitpid(self._pid, 0)
+        self._pid = None
@@ -0,0 +1,100 @@
+import prefetch
+
+import os
+import threading
+import unittest
+
+class TestReadAhead(unittest.TestCase):
+    def test_order(self):
+        items = range(100)
+        self.assertEqual(list(prefetch.read_ahead(items, batch_size=7)), items)
+        self.assertEqual(list(prefetch.read_ahead([])), [])
+
+    def test_exception(self):
+        def failing():
+            yield 1
+            raise KeyError('missing')
+        results = []
+        with self.assertRaises(KeyError):
+            for item in prefetch.read_ahead(failing()):
+                results.append(item)
+        self.assertEqual(results, [1])
+
+    def test_early_stop(self):
+        closed = []
+        def endless():
+            try:
+                index = 0
+                while True:
+                    yield index
+                    index += 1
+            finally:
+                closed.append(threading.current_thread())
+        threads = threading.active_count()
+        items = prefetch.read_ahead(endless(), batch_size=2, queue_size=1)
+        self.assertEqual([items.next() for _ in range(5)], range(5))
+        items.close()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(len(closed), 1)
+        self.assertNotEqual(closed[0], threading.current_thread())
+
+def produce(request):
+    if request == 'pid':
+        return [os.getpid()]
+    elif request == 'fail':
+        return failing()
+    elif request == 'endless':
+        return endless()
+    return range(request)
+
+def failing():
+    yield 1
+    raise KeyError('missing')
+
+def endless():
+    index = 0
+    while True:
+        yield index
+        index += 1
+
+class TestReadAheadProcess(unittest.TestCase):
+    def setUp(self):
+        self.process = prefetch.ReadAheadProcess(produce, batch_size=7)
+        self.addCleanup(self.process.close)
+
+    def test_order(self):
+        self.assertEqual(list(self.process.read(100)), range(100))
+        self.assertEqual(list(self.process.read(0)), [])
+        self.assertEqual(list(self.process.read(3)), range(3))
+
+    def test_runs_in_child(self):
+        self.assertNotEqual(list(self.process.read('pid')), [os.getpid()])
+
+    def test_exception(self):
+        results = []
+        with self.assertRaises(RuntimeError):
+            for item in self.process.read('fail'):
+                results.append(item)
+        self.assertEqual(results, [1])
+        self.assertEqual(list(self.process.read(5)), range(5))
+
+    def test_early_stop(self):
+        items = self.process.read('endless')
+        self.assertEqual([items.next() for _ in range(5)], range(5))
+        items.close()
+        self.assertEqual(list(self.process.read(20)), range(20))
+        items = self.process.read(20)
+        items.next()
+        items.close()
+        self.assertEqual(list(self.process.read(3)), range(3))
+
+    def test_close(self):
+        pid = list(self.process.read('pid'))[0]
+        self.process.close()
+        with self.assertRaises(OSError):
+            os.kill(pid, 0)
+        with self.assertRaises(RuntimeError):
+            list(self.process.read(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+zlib compression of index blobs against per-node preset dictionaries.
+
+Every update in the index is compressed on its own, so zlib starts each blob
+with an empty window and can't exploit the strings that repeat across a
+node's updates (anonymized IPs and domains, the whitelist, the anonymization
+signature). A preset dictionary fills the window with those strings before
+compressing each blob.
+
+Python 2's zlib module doesn't accept a zdict, so Compressor and Decompressor
+emulate one: they feed the dictionary through a compression stream once,
+sync flush it, and then compress or decompress every blob from a copy of that
+primed stream. The blobs are ordinary zlib streams minus the header and
+dictionary bytes, and decompress to exactly the original data.
+"""
+
+from collections import defaultdict
+from heapq import heapify, heappop, heappush
+from zlib import compress, compressobj, decompressobj, Z_SYNC_FLUSH
+
+# Maximum size of a trained dictionary. zlib can only refer back 32KB, so a
+# larger dictionary would be partly out of reach even at the start of a blob.
+DICTIONARY_SIZE = 24 * 1024
+
+# Length of the segments of the samples that make up a dictionary, and of the
+# substrings used to score them.
+SEGMENT_LENGTH = 64
+DMER_LENGTH = 8
+
+# Number of encoded updates from a node to train its dictionary on. Nodes with
+# fewer than MINIMUM_TRAINING_SAMPLES updates are stored without a dictionary
+# until a later run sees enough of them.
+TRAINING_SAMPLES = 16
+MINIMUM_TRAINING_SAMPLES = 4
+
+def train_dictionary(samples,
+                     size=DICTIONARY_SIZE,
+                     segment_length=SEGMENT_LENGTH,
+                     dmer_length=DMER_LENGTH):
+    """Build a preset dictionary from a list of sample strings.
+
+    This is a simplified version of the COVER algorithm used by zstd: every
+    dmer (substring of dmer_length bytes) is weighted by the number of samples
+    it appears in, and segments of the samples are greedily added to the
+    dictionary by the total weight of the dmers they contain that aren't
+    already covered by the dictionary. The best segments go at the end of the
+    dictionary, where zlib can refer to them most cheaply."""
+    frequencies = defaultdict(int)
+    for sample in samples:
+        for dmer in set(sample[index:index + dmer_length]
+                        for index in xrange(len(sample) - dmer_length + 1)):
+            frequencies[dmer] += 1
+
+    def score(segment):
+        return sum(frequencies.get(segment[index:index + dmer_length], 0)
+                   for index in xrange(len(segment) - dmer_length + 1))
+
+    candidates = set()
+    step = max(segment_length // 2, 1)
+    for sample in samples:
+        for start in xrange(0, max(len(sample) - segment_length, 0) + 1, step):
+            candidates.add(sample[start:start + segment_length])
+    # Only dmers shared by several samples are worth a place in the dictionary.
+    for dmer, frequency in frequencies.items():
+        if frequency < 2:
+            del frequencies[dmer]
+    heap = [(-score(segment), segment) for segment in candidates]
+    heapify(heap)
+
+    segments = []
+    length = 0
+    while heap and length < size:
+        negative_score, segment = heappop(heap)
+        if negative_score == 0:
+            break
+        current = score(segment)
+        if heap and current < -heap[0][0]:
+            # Part of this segment is already covered, so compare its
+            # remaining score against the other candidates again.
+            if current > 0:
+                heappush(heap, (-current, segment))
+            continue
+        segment = segment[:size - length]
+        segments.append(segment)
+        length += len(segment)
+        for index in xrange(len(segment) - dmer_length + 1):
+            frequencies.pop(segment[index:index + dmer_length], None)
+    segments.reverse()
+    return ''.join(segments)
+
+def _primed_stream(dictionary):
+    compressor = compressobj()
+    primer = compressor.compress(dictionary) + compressor.flush(Z_SYNC_FLUSH)
+    return compressor, primer
+
+class Compressor(object):
+    """Compresses strings against a preset dictionary."""
+
+    def __init__(self, dictionary):
+        self._compressor = _primed_stream(dictionary)[0]
+
+    def compress(self, data):
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+class Decompressor(object):
+    """Decompresses strings compressed by a Compressor with the same
+    dictionary."""
+
+    def __init__(self, dictionary):
+        self._decompressor = decompressobj()
+        self._decompressor.decompress(_primed_stream(dictionary)[1])
+
+    def decompress(self, data):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+class DictionaryCompressor(object):
+
+    """Compresses index rows with the preset dictionary of their node.
+
+    dictionaries maps node ids to the (dictionary_id, dictionary) pairs already
+    stored in the index. Nodes without a dictionary have their first
+    TRAINING_SAMPLES blobs held back until their dictionary is trained, so
+    rows aren't necessarily emitted in the order they arrive. New dictionaries
+    are numbered from next_dictionary_id and collected in new_dictionaries as
+    (dictionary_id, node_id, dictionary) tuples; store them along with the
+    rows."""
+
+    def __init__(self, dictionaries, next_dictionary_id):
+        self._compressors = {}
+        for node_id, (dictionary_id, dictionary) in dictionaries.iteritems():
+            self._compressors[node_id] = (dictionary_id, Compressor(dictionary))
+        self._next_dictionary_id = next_dictionary_id
+        self._samples = defaultdict(list)
+        self.new_dictionaries = []
+
+    def _compress(self, node_id, row, data):
+        dictionary_id, compressor = self._compressors[node_id]
+        blob = buffer(compressor.compress(data))
+        return row + (blob, len(blob), dictionary_id)
+
+    def _train(self, node_id):
+        samples = self._samples.pop(node_id)
+        dictionary = train_dictionary([data for _, data in samples])
+        dictionary_id = self._next_dictionary_id
+        self._next_dictionary_id += 1
+        self._compressors[node_id] = (dictionary_id, Compressor(dictionary))
+        self.new_dictionaries.append((dictionary_id, node_id, buffer(dictionary)))
+        return [self._compress(node_id, row, data) for row, data in samples]
+
+    def compress(self, items):
+        """Compress the data of each (node_id, row, data) tuple in items and
+        yield row extended with the compressed blob, its size and its
+        dictionary id (None for blobs compressed without a dictionary)."""
+        for node_id, row, data in items:
+            if node_id in self._compressors:
+                yield self._compress(node_id, row, data)
+                continue
+            self._samples[node_id].append((row, data))
+            if len(self._samples[node_id]) >= TRAINING_SAMPLES:
+                for compressed in self._train(node_id):
+                    yield compressed
+        for node_id in self._samples.keys():
+            if len(self._samples[node_id]) >= MINIMUM_TRAINING_SAMPLES:
+                for compressed in self._train(node_id):
+                    yield compressed
+            else:
+                for row, data in self._samples.pop(node_id):
+                    blob = buffer(compress(data))
+                    yield row + (blob, len(blob), None)
@@ -0,0 +1,53 @@
+import preset_dictionary
+import update_codec
+import update_parser
+import update_parser_benchmark
+
+import unittest
+from zlib import decompress
+
+def encoded_updates(count, seed=0):
+    return [update_codec.encode_update(update_parser.PassiveUpdate(
+                update_parser_benchmark.generate_update(sequence_number=index,
+                                                        packets=50,
+                                                        seed=seed)))
+            for index in range(count)]
+
+class TestPresetDictionary(unittest.TestCase):
+    def test_roundtrip(self):
+        samples = encoded_updates(8)
+        dictionary = preset_dictionary.train_dictionary(samples[:4])
+        self.assertTrue(0 < len(dictionary) <= preset_dictionary.DICTIONARY_SIZE)
+        compressor = preset_dictionary.Compressor(dictionary)
+        decompressor = preset_dictionary.Decompressor(dictionary)
+        for data in samples + ['', 'unrelated data']:
+            blob = compressor.compress(data)
+            self.assertEqual(decompressor.decompress(blob), data)
+            self.assertEqual(decompressor.decompress(blob), data)
+
+    def test_dictionary_compressor(self):
+        samples = encoded_updates(preset_dictionary.TRAINING_SAMPLES + 2)
+        few_samples = encoded_updates(2, seed=1)
+        items = [('A', (index,), data) for index, data in enumerate(samples)] \
+                + [('B', (index,), data) for index, data in enumerate(few_samples)]
+        compressor = preset_dictionary.DictionaryCompressor({}, 5)
+        rows = list(compressor.compress(items))
+        self.assertEqual(len(rows), len(items))
+        self.assertEqual(len(compressor.new_dictionaries), 1)
+        dictionary_id, node_id, dictionary = compressor.new_dictionaries[0]
+        self.assertEqual((dictionary_id, node_id), (5, 'A'))
+        decompressor = preset_dictionary.Decompressor(str(dictionary))
+        decompressed = {}
+        for index, blob, size, row_dictionary_id in rows:
+            self.assertEqual(size, len(blob))
+            if row_dictionary_id is None:
+                decompressed[index, 'B'] = decompress(blob)
+            else:
+                self.assertEqual(row_dictionary_id, 5)
+                decompressed[index, 'A'] = decompressor.decompress(blob)
+        for node_id, node_samples in [('A', samples), ('B', few_samples)]:
+            for index, data in enumerate(node_samples):
+                self.assertEqual(decompressed[index, node_id], data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
-import atexit
 from itertools import imap
-from multiprocessing import Pool
+from multiprocessing import cpu_count, Pool
+from multiprocessing.util import Finalize
 from os import getpid, makedirs
 from os.path import join
 try:
@@ -17,11 +17,18 @@ except ImportError:
     print "Install the 'progressbar' package if " \
             "you're curious how long this will take"
     progressbar = None
-from shutil import rmtree
+from os import rename
+from os.path import exists
+from Queue import Queue
 import sys
+from threading import Thread
+from time import time
 import traceback
 
-from updates_index import UpdatesReader
+from prefetch import ReadAheadProcess
+from scheduler import balance_tasks, default_rate, load_costs, new_updates, \
+        pack_tasks, record_cost, save_costs
+from updates_index import decode_payloads, UpdatesReader
 
 class SessionContext(object):
     def __init__(self, session):
@@ -51,15 +58,198 @@ class EphemeralContext(SessionContext):
 class GlobalContext(object):
     pass
 
+# Records the last sequence number processed for each session, so we can
+# tell which sessions have new updates without opening them.
+MANIFEST_FILENAME = 'manifest.pickle'
+
+# The updates index reader of this process, which it reuses for every session
+# it processes, and the arguments it was opened with.
+_index_reader = None
+_index_reader_arguments = None
+
+def open_index_reader(database_backend, database_name, database_options):
+    """Return this process's updates index reader, opening it if necessary."""
+    global _index_reader, _index_reader_arguments
+    arguments = (database_backend,
+                 database_name,
+                 sorted(database_options.items()))
+    if _index_reader is None or _index_reader_arguments != arguments:
+        _index_reader = UpdatesReader(
+                database_backend, database_name, **database_options)
+        _index_reader_arguments = arguments
+    return _index_reader
+
+# The process that reads the updates of large sessions ahead of this one, and
+# its own reader of the updates index, which is only ever opened in there,
+# and the arguments it was opened with.
+_read_ahead_process = None
+_read_ahead_index_reader = None
+_read_ahead_index_reader_arguments = None
+
+def read_session_payloads((database_backend,
+                           database_name,
+                           database_options,
+                           session,
+                           first_sequence_number,
+                           start_time,
+                           end_time)):
+    """Yield the compressed updates of a session. This runs in the read ahead
+    process."""
+    global _read_ahead_index_reader, _read_ahead_index_reader_arguments
+    arguments = (database_backend,
+                 database_name,
+                 sorted(database_options.items()))
+    if _read_ahead_index_reader is None \
+            or _read_ahead_index_reader_arguments != arguments:
+        if _read_ahead_index_reader is not None:
+            _read_ahead_index_reader.close()
+        _read_ahead_index_reader = UpdatesReader(
+                database_backend, database_name, **database_options)
+        _read_ahead_index_reader_arguments = arguments
+    return _read_ahead_index_reader.session_payloads(
+            session, first_sequence_number, start_time, end_time)
+
+def start_read_ahead_process():
+    """Fork this process's read ahead process, unless it already has one. Call
+    this before opening the index or starting threads, since the child
+    inherits everything this process has open."""
+    global _read_ahead_process
+    if read_ahead_process() is None:
+        _read_ahead_process = ReadAheadProcess(read_session_payloads)
+
+def read_ahead_process():
+    if _read_ahead_process is not None \
+            and _read_ahead_process.owner == getpid():
+        return _read_ahead_process
+    return None
+
+def initialize_worker(database_backend,
+                      database_name,
+                      database_options,
+                      pipeline):
+    """Worker pools call this when they start each worker."""
+    if pipeline:
+        start_read_ahead_process()
+    open_index_reader(database_backend, database_name, database_options)
+
+def session_key(session):
+    return (session.node_id, session.anonymization_context, session.id)
+
+def context_key(context):
+    return (context.node_id, context.anonymization_context, context.session_id)
+
+def window_pickle_root(disk_pickle_root, start_time, end_time):
+    """Return the pickle directory for runs restricted to updates between
+    start_time and end_time, which is kept apart from the pickles of runs over
+    every update."""
+    if start_time is None and end_time is None:
+        return disk_pickle_root
+    return join(disk_pickle_root,
+                'window_%s_%s' % (start_time if start_time is not None else '',
+                                  end_time if end_time is not None else ''))
+
+def session_pickle_filename(session):
+    return '%s_%s_%s.pickle' \
+            % (session.node_id, session.anonymization_context, str(session.id))
+
+def load_manifest(disk_pickle_root):
+    try:
+        return pickle.load(open(join(disk_pickle_root, MANIFEST_FILENAME), 'rb'))
+    except:
+        return {}
+
+def save_manifest(disk_pickle_root, manifest):
+    manifest_path = join(disk_pickle_root, MANIFEST_FILENAME)
+    with open(manifest_path + '.tmp', 'wb') as handle:
+        pickle.dump(manifest, handle, pickle.HIGHEST_PROTOCOL)
+    rename(manifest_path + '.tmp', manifest_path)
+
+# When every processor is mergeable, sessions are split into this many batches
+# of about the same predicted cost per worker, and each batch is merged into a
+# partial global context.
+MERGE_BATCHES_PER_WORKER = 4
+
+# How many session pickles each process can have waiting to be written.
+PENDING_PICKLE_WRITES = 4
+
+class PickleWriter(object):
+    """Writes pickled session contexts to disk in a background thread, so
+    processes can move on to their next session while the last one is written.
+    Each pickle is written to a temporary file and renamed into place, and
+    pending writes are flushed when the process exits."""
+
+    def __init__(self):
+        self.pid = getpid()
+        self._queue = Queue(PENDING_PICKLE_WRITES)
+        thread = Thread(target=self._write_pickles)
+        thread.daemon = True
+        thread.start()
+        Finalize(None, self.flush, exitpriority=10)
+
+    def _write_pickles(self):
+        while True:
+            path, data = self._queue.get()
+            try:
+                with open(path + '.tmp', 'wb') as handle:
+                    handle.write(data)
+                rename(path + '.tmp', path)
+            except:
+                print 'Failed to write', path
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                self._queue.task_done()
+
+    def write(self, path, data):
+        self._queue.put((path, data))
+
+    def flush(self):
+        self._queue.join()
+
+# The pickle writer of this process, which is started when it's first used.
+# Forked processes don't inherit its thread, so they start their own.
+_pickle_writer = None
+
+def pickle_writer():
+    global _pickle_writer
+    if _pickle_writer is None or _pickle_writer.pid != getpid():
+        _pickle_writer = PickleWriter()
+    return _pickle_writer
+
+def merge_unchanged_session(session, disk_pickle_root, processors, global_context):
+    """Merge a session with no new updates straight from its stored persistent
+    context, which is what process_session would do after finding no updates.
+    Return False if the persistent context can't be loaded or is older than
+    the manifest says, which happens if a process exited before writing it."""
+    disk_pickle_path = join(disk_pickle_root, session_pickle_filename(session))
+    try:
+        persistent_context = pickle.load(open(disk_pickle_path, 'rb'))
+    except:
+        return False
+    if persistent_context.last_sequence_number_processed \
+            != session.max_sequence_number:
+        return False
+    ephemeral_context = EphemeralContext(session)
+    for processor in processors:
+        processor.initialize_ephemeral_context(ephemeral_context)
+    for processor in processors:
+        processor.complete_session(persistent_context, ephemeral_context)
+    for processor in processors:
+        processor.merge_contexts(
+                persistent_context, ephemeral_context, global_context)
+    return True
+
 def process_session((session,
                      database_backend,
                      database_name,
                      database_options,
                      disk_pickle_root,
-                     ram_pickle_root,
                      processors,
                      multiprocessed,
-                     ignore_pickles)):
+                     ignore_pickles,
+                     start_time,
+                     end_time,
+                     prefetch,
+                     pipeline)):
     """
         Args:
 
@@ -72,47 +262,73 @@ def process_session((session,
             updates information comes from.
         disk_pickle_root: String
             pickle directory given as a commandline argument
-        ram_pickle_root: String
-            directory for storing the intermediate result pickle files. Defaults
-            to /dev/shm but can be modified with a commandline parameter
         processors: list
             list of children of SessionProcessor class, provide the
             process_update function as needed by the processor
         multiprocessed: boolean
-            whether we're running under multiprocessing. If not,
-            then we don't need to pickle our results; instead we
-            can just result them.
+            whether we're running under multiprocessing. If so, return the
+            pickled contexts, which pass back to the master process without
+            being pickled again. If not, return the contexts themselves.
+            Either way, also return the processing time in seconds and the
+            number of updates processed, for the scheduler.
         ignore_pickles: boolean
             If true, then disregard existing pickle files and
             generate them from scratch.
+        start_time, end_time: Unix timestamps or None
+            only process updates written between these times.
+        prefetch: boolean
+            read and decompress updates in a background thread while
+            processors run.
+        pipeline: boolean
+            read and decompress updates in this process's read ahead process
+            while processors run. This is meant for very large sessions.
     """
 
-    pickle_filename = '%s_%s_%s.pickle' \
-            % (session.node_id, session.anonymization_context, str(session.id))
-    disk_pickle_path = join(disk_pickle_root, pickle_filename)
+    started = time()
+    disk_pickle_path = join(disk_pickle_root, session_pickle_filename(session))
+    persistent_context = None
     if not ignore_pickles:
         try:
             persistent_context = pickle.load(open(disk_pickle_path, 'rb'))
         except:
             persistent_context = None
-    if ignore_pickles or persistent_context is None:
+    new_context = persistent_context is None
+    if new_context:
         persistent_context = PersistentContext(session)
         for processor in processors:
             processor.initialize_persistent_context(persistent_context)
-        with open(disk_pickle_path, 'wb') as handle:
-            pickle.dump(persistent_context, handle, pickle.HIGHEST_PROTOCOL)
     ephemeral_context = EphemeralContext(session)
     for processor in processors:
         processor.initialize_ephemeral_context(ephemeral_context)
 
-    processed_new_update = False
+    updates_processed = 0
     current_tarname = None
-    index = UpdatesReader(database_backend, database_name, **database_options)
-    session_data = index.session_data(
-            session, persistent_context.last_sequence_number_processed + 1)
+    first_sequence_number = \
+            persistent_context.last_sequence_number_processed + 1
+    if pipeline and read_ahead_process() is not None:
+        payloads = read_ahead_process().read((database_backend,
+                                              database_name,
+                                              database_options,
+                                              session,
+                                              first_sequence_number,
+                                              start_time,
+                                              end_time))
+        session_data = decode_payloads(payloads, start_time, end_time)
+    else:
+        index = open_index_reader(
+                database_backend, database_name, database_options)
+        session_data = index.session_data(session,
+                                          first_sequence_number,
+                                          start_time=start_time,
+                                          end_time=end_time,
+                                          prefetch=prefetch)
+    windowed = start_time is not None or end_time is not None
     for sequence_number, update in session_data:
         last_processed = persistent_context.last_sequence_number_processed
-        if sequence_number > last_processed + 1:
+        # A window usually starts partway through a session, so its first
+        # update can follow a gap.
+        if sequence_number > last_processed + 1 \
+                and not (windowed and last_processed == -1):
             print 'Invalid sequence number: %d' % sequence_number
             break
         elif sequence_number == last_processed:
@@ -122,36 +338,180 @@ def process_session((session,
                     persistent_context, ephemeral_context, update)
         persistent_context.last_sequence_number_processed = \
                 update.sequence_number
-        processed_new_update = True
+        updates_processed += 1
     for processor in processors:
         processor.complete_session(persistent_context, ephemeral_context)
-    if processed_new_update:
-        with open(disk_pickle_path, 'wb') as handle:
-            pickle.dump(persistent_context, handle, pickle.HIGHEST_PROTOCOL)
+    # Pickle the persistent context once, and use the same pickle for the
+    # disk and for the master process.
+    save_context = new_context or updates_processed > 0
+    if multiprocessed or save_context:
+        persistent_pickle = pickle.dumps(persistent_context,
+                                         pickle.HIGHEST_PROTOCOL)
+    if save_context:
+        pickle_writer().write(disk_pickle_path, persistent_pickle)
+    cost = (time() - started, updates_processed)
     if multiprocessed:
-        ram_pickle_path = join(ram_pickle_root, pickle_filename)
-        if processed_new_update:
-            with open(ram_pickle_path, 'wb') as handle:
-                pickle.dump((persistent_context, ephemeral_context),
-                            handle,
-                            pickle.HIGHEST_PROTOCOL)
-            return (ram_pickle_path, ram_pickle_path)
-        else:
-            with open(ram_pickle_path, 'wb') as handle:
-                pickle.dump(ephemeral_context, handle, pickle.HIGHEST_PROTOCOL)
-            return (disk_pickle_path, ram_pickle_path)
+        return (persistent_pickle,
+                pickle.dumps(ephemeral_context, pickle.HIGHEST_PROTOCOL),
+                cost)
     else:
-        return (persistent_context, ephemeral_context)
+        return (persistent_context, ephemeral_context, cost)
+
+def process_session_batch(batch):
+    """Process a task of several sessions packed together by the scheduler,
+    and return the results of process_session for each of them."""
+    return map(process_session, batch)
+
+def new_global_context(processors):
+    global_context = GlobalContext()
+    for processor in processors:
+        processor.initialize_global_context(global_context)
+    return global_context
+
+def merge_session_batch((processors, batch)):
+    """Process a batch of sessions and merge them into a partial global
+    context. Return the pickled partial global context, the manifest entries
+    of the sessions and their processing costs."""
+    global_context = new_global_context(processors)
+    manifest_entries = {}
+    costs = {}
+    for process_args in batch:
+        persistent_context, ephemeral_context, cost = \
+                process_session(process_args)
+        for processor in processors:
+            processor.merge_contexts(
+                    persistent_context, ephemeral_context, global_context)
+        key = context_key(persistent_context)
+        manifest_entries[key] = \
+                persistent_context.last_sequence_number_processed
+        costs[key] = cost
+    return (pickle.dumps(global_context, pickle.HIGHEST_PROTOCOL),
+            manifest_entries,
+            costs)
+
+def combine_partial_global_contexts((processors, first, second)):
+    """Combine two partial global contexts from merge_session_batch into
+    one."""
+    global_context = pickle.loads(first[0])
+    partial = pickle.loads(second[0])
+    for processor in processors:
+        processor.combine_global_contexts(global_context, partial)
+    manifest_entries = dict(first[1])
+    manifest_entries.update(second[1])
+    costs = dict(first[2])
+    costs.update(second[2])
+    return (pickle.dumps(global_context, pickle.HIGHEST_PROTOCOL),
+            manifest_entries,
+            costs)
+
+def reduce_partial_global_contexts(pool, processors, partials):
+    """Combine pickled partial global contexts in pairs on the pool until one
+    is left, and return it. Return None if there are no partial contexts."""
+    while len(partials) > 1:
+        pairs = [(processors, partials[index], partials[index + 1])
+                 for index in range(0, len(partials) - 1, 2)]
+        leftover = partials[len(pairs) * 2:]
+        partials = pool.map(combine_partial_global_contexts, pairs) + leftover
+    if partials:
+        return partials[0]
+    return None
+
+def processor_names(processors):
+    return ['%s.%s' % (type(processor).__module__, type(processor).__name__)
+            for processor in processors]
+
+def load_incremental_global_context(filename,
+                                    processors,
+                                    disk_pickle_root,
+                                    start_time,
+                                    end_time):
+    """Return the partial global context of every session, keyed by session,
+    and the pickled global context they combine into, both as stored by
+    save_incremental_global_context. Partial global contexts are tuples of the
+    last sequence number merged into them and the pickled partial context.
+    Return ({}, None) if the file is missing or was saved by a different set of
+    processors, for a different pickles directory or for a different time
+    window."""
+    try:
+        state = pickle.load(open(filename, 'rb'))
+    except:
+        return {}, None
+    if state['processors'] != processor_names(processors):
+        print 'Processors changed; rebuilding the incremental global context'
+        return {}, None
+    if state.get('pickle_root') != disk_pickle_root \
+            or state.get('window') != (start_time, end_time):
+        print 'The incremental global context is for different pickles; ' \
+                'rebuilding it'
+        return {}, None
+    return state['partials'], state['global_context']
+
+def save_incremental_global_context(filename,
+                                    processors,
+                                    disk_pickle_root,
+                                    start_time,
+                                    end_time,
+                                    partials,
+                                    global_context):
+    state = { 'processors': processor_names(processors),
+              'pickle_root': disk_pickle_root,
+              'window': (start_time, end_time),
+              'partials': partials,
+              'global_context': global_context }
+    with open(filename + '.tmp', 'wb') as handle:
+        pickle.dump(state, handle, pickle.HIGHEST_PROTOCOL)
+    rename(filename + '.tmp', filename)
+
+def replace_partial_global_contexts(processors,
+                                    partials,
+                                    global_context,
+                                    new_partials,
+                                    stale_keys):
+    """Replace the partial global contexts of the sessions in new_partials
+    and remove those of stale_keys, and return the global context of all the
+    remaining partial contexts. If every processor is retractable, this
+    retracts the old partial contexts from global_context and combines in the
+    new ones. Otherwise it combines every partial context again. partials is
+    updated in place. Partial global contexts are (last_sequence_number,
+    pickled partial context) tuples."""
+    retractable = global_context is not None \
+            and all(processor.retractable for processor in processors)
+    if retractable:
+        global_context = pickle.loads(global_context)
+        for key in set(new_partials).union(stale_keys):
+            if key in partials:
+                old_partial = pickle.loads(partials[key][1])
+                for processor in processors:
+                    processor.retract_global_context(
+                            global_context, old_partial)
+    for key in stale_keys:
+        del partials[key]
+    partials.update(new_partials)
+    if retractable:
+        combined = new_partials.itervalues()
+    else:
+        global_context = new_global_context(processors)
+        combined = partials.itervalues()
+    for last_sequence_number, partial in combined:
+        partial = pickle.loads(partial)
+        for processor in processors:
+            processor.combine_global_contexts(global_context, partial)
+    return global_context
 
 def process_sessions(harness,
                      database_backend,
                      database_name,
                      database_options,
                      disk_pickle_root,
-                     ram_pickles_dir='/dev/shm',
+                     ram_pickles_dir=None,
                      num_workers=None,
                      ignore_pickles=False,
-                     cached_global_context=None):
+                     cached_global_context=None,
+                     start_time=None,
+                     end_time=None,
+                     prefetch=False,
+                     incremental_global_context=None,
+                     pipeline_updates=None):
     """
         Args:
         harness: Harness (or subclass)
@@ -161,8 +521,8 @@ def process_sessions(harness,
         disk_pickle_root: String
             pickle directory given as a commandline argument
         ram_pickles_dir:
-            directory for storing the intermediate result pickle files. Defaults
-            to /dev/shm but can be modified with a commandline parameter
+            ignored. Workers used to store their results in temporary pickles
+            in this directory, but now return them over the pool's pipe.
         num_workers: Integer
             the number of threads that the process can use when multiprocessing
             the updates. Can be provided as a commandline argument
@@ -170,12 +530,26 @@ def process_sessions(harness,
             when this is True, then ignore all existing pickle files and recompute
             everything from scratch. You need to do this whenever you change
             a processor. Equivalently, you can manually delete the pickles.
+        start_time, end_time: Unix timestamps or None
+            only process updates written between these times. Windowed runs
+            keep their pickles in a subdirectory of disk_pickle_root.
+        prefetch: boolean
+            read updates ahead of the processors in a background thread. This
+            only overlaps with processing while the reader waits on the index
+            or zlib, which release the GIL.
+        incremental_global_context: String
+            file that caches each session's contribution to the global
+            context. Only the contributions of sessions with new updates are
+            merged again. Every processor must be mergeable.
+        pipeline_updates: Integer
+            sessions with at least this many updates left to process read
+            and decompress their updates in a separate process, in parallel
+            with their processors. Unlike prefetch, the Python work of
+            reading runs in parallel too. Each worker forks its read ahead
+            process when it starts, before it opens the index. Updates are
+            still decoded by the processing process either way.
     """
 
-    ram_pickle_root = join(ram_pickles_dir, str(getpid()))
-    makedirs(ram_pickle_root)
-    atexit.register(rmtree, ram_pickle_root)
-
     if cached_global_context is not None:
         try:
             global_context = pickle.load(open(cached_global_context, 'r'))
@@ -188,59 +562,220 @@ def process_sessions(harness,
             harness.process_results(global_context)
             return
 
+    disk_pickle_root = window_pickle_root(disk_pickle_root, start_time, end_time)
+    if not exists(disk_pickle_root):
+        makedirs(disk_pickle_root)
+
     if num_workers != 0:
-        pool = Pool(processes=num_workers)
+        pool = Pool(processes=num_workers,
+                    initializer=initialize_worker,
+                    initargs=(database_backend,
+                              database_name,
+                              database_options,
+                              pipeline_updates is not None))
+    elif pipeline_updates is not None:
+        start_read_ahead_process()
 
-    process_args = []
     processors = harness.instantiate_processors()
-    index = UpdatesReader(database_backend, database_name, **database_options)
-    for session in index.sessions:
+    global_context = new_global_context(processors)
+    if incremental_global_context is not None \
+            and not all(processor.mergeable for processor in processors):
+        print 'Ignoring the incremental global context, ' \
+                'since some processors aren\'t mergeable'
+        incremental_global_context = None
+
+    if ignore_pickles:
+        manifest = {}
+    else:
+        manifest = load_manifest(disk_pickle_root)
+    # Processing rates don't depend on the pickles, so keep them even when
+    # ignoring the pickles.
+    costs = load_costs(disk_pickle_root)
+    sessions = []
+    unchanged_sessions = []
+    index = open_index_reader(database_backend, database_name, database_options)
+    if start_time is None and end_time is None:
+        catalog = index.session_catalog
+    else:
+        catalog = index.window_catalog(start_time, end_time)
+    for session in catalog:
         if not harness.should_process_session(session):
             continue
+        if session.max_sequence_number is not None \
+                and manifest.get(session_key(session)) \
+                    == session.max_sequence_number:
+            unchanged_sessions.append(session)
+        else:
+            sessions.append(session)
+    incremental = incremental_global_context is not None
+    if incremental:
+        if ignore_pickles:
+            partials, cached_total = {}, None
+        else:
+            partials, cached_total = load_incremental_global_context(
+                    incremental_global_context,
+                    processors,
+                    disk_pickle_root,
+                    start_time,
+                    end_time)
+        session_keys = set(imap(session_key, sessions + unchanged_sessions))
+        stale_keys = [key for key in partials if key not in session_keys]
+        # Sessions without new updates already have partial global contexts,
+        # unless a run without the incremental global context processed their
+        # updates since.
+        unchanged_sessions = [
+                session for session in unchanged_sessions
+                if partials.get(session_key(session), (None, None))[0]
+                    != session.max_sequence_number]
+        new_partials = {}
+    print 'Merging %d sessions without new updates' % len(unchanged_sessions)
+    for session in unchanged_sessions:
+        if incremental:
+            partial = new_global_context(processors)
+        else:
+            partial = global_context
+        if not merge_unchanged_session(
+                session, disk_pickle_root, processors, partial):
+            sessions.append(session)
+        elif incremental:
+            new_partials[session_key(session)] = \
+                    (session.max_sequence_number,
+                     pickle.dumps(partial, pickle.HIGHEST_PROTOCOL))
+
+    merge_in_workers = incremental \
+            or (num_workers != 0
+                and all(processor.mergeable for processor in processors))
+    # Predict the cost of each session from the number of updates it has left
+    # and its recorded processing rate.
+    rate = default_rate(costs)
+    predicted_costs = []
+    process_args = []
+    pipelined_sessions = 0
+    for session in sessions:
+        key = session_key(session)
+        updates_left = new_updates(session, manifest.get(key))
+        predicted_costs.append(updates_left * costs.get(key, rate))
+        pipeline = pipeline_updates is not None \
+                and updates_left >= pipeline_updates
+        if pipeline:
+            pipelined_sessions += 1
         process_args.append((session,
                              database_backend,
                              database_name,
                              database_options,
                              disk_pickle_root,
-                             ram_pickle_root,
                              processors,
-                             num_workers != 0,
-                             ignore_pickles))
-    number_of_sessions = len(process_args)
+                             num_workers != 0 and not merge_in_workers,
+                             ignore_pickles,
+                             start_time,
+                             end_time,
+                             prefetch,
+                             pipeline))
+    if pipelined_sessions > 0:
+        print 'Reading updates in separate processes for %d large sessions' \
+                % pipelined_sessions
+    if incremental:
+        # Every session needs a partial global context of its own, so start
+        # the most expensive ones first.
+        tasks = [(processors, [args])
+                 for cost, args in sorted(zip(predicted_costs, process_args),
+                                          key=lambda (cost, args): cost,
+                                          reverse=True)]
+    elif merge_in_workers:
+        number_of_batches = MERGE_BATCHES_PER_WORKER \
+                * (num_workers or cpu_count())
+        tasks = [(processors, batch)
+                 for cost, batch in balance_tasks(
+                         process_args, predicted_costs, number_of_batches)]
+    elif num_workers == 0:
+        tasks = process_args
+    else:
+        tasks = [batch
+                 for cost, batch in pack_tasks(process_args,
+                                               predicted_costs,
+                                               num_workers or cpu_count())]
 
     if progressbar is not None:
         progress = progressbar.ProgressBar(
-                maxval=number_of_sessions,
+                maxval=len(tasks),
                 widgets=[progressbar.SimpleProgress(),
                          progressbar.Bar(),
                          progressbar.Timer()])
     else:
         progress = lambda x: x
-    global_context = GlobalContext()
-    for processor in processors:
-        processor.initialize_global_context(global_context)
-    if num_workers == 0:
+    if incremental:
+        if num_workers == 0:
+            results = imap(merge_session_batch, tasks)
+        else:
+            results = pool.imap_unordered(merge_session_batch, tasks)
+        for partial, manifest_entries, session_costs in progress(results):
+            for key, last_sequence_number in manifest_entries.iteritems():
+                new_partials[key] = (last_sequence_number, partial)
+            manifest.update(manifest_entries)
+            for key, cost in session_costs.iteritems():
+                record_cost(costs, key, *cost)
+        if num_workers == 0:
+            pickle_writer().flush()
+        else:
+            pool.close()
+            pool.join()
+        print 'Replacing %d sessions and removing %d sessions ' \
+                'in the incremental global context' \
+                % (len(new_partials), len(stale_keys))
+        global_context = replace_partial_global_contexts(
+                processors, partials, cached_total, new_partials, stale_keys)
+        save_incremental_global_context(
+                incremental_global_context,
+                processors,
+                disk_pickle_root,
+                start_time,
+                end_time,
+                partials,
+                pickle.dumps(global_context, pickle.HIGHEST_PROTOCOL))
+    elif num_workers == 0:
         results = imap(process_session, process_args)
-        for persistent_context, ephemeral_context in progress(results):
+        for persistent_context, ephemeral_context, cost in progress(results):
             for processor in processors:
                 processor.merge_contexts(
                         persistent_context, ephemeral_context, global_context)
-    else:
-        results = pool.imap_unordered(process_session, process_args)
-        for persistent_pickle_path, ephemeral_pickle_path in progress(results):
-            if persistent_pickle_path == ephemeral_pickle_path:
-                persistent_context, ephemeral_context = \
-                        pickle.load(open(persistent_pickle_path, 'rb'))
-            else:
-                persistent_context = pickle.load(
-                        open(persistent_pickle_path, 'rb'))
-                ephemeral_context = pickle.load(
-                        open(ephemeral_pickle_path, 'rb'))
+            key = context_key(persistent_context)
+            manifest[key] = persistent_context.last_sequence_number_processed
+            record_cost(costs, key, *cost)
+        pickle_writer().flush()
+    elif merge_in_workers:
+        print 'Merging sessions in worker processes'
+        partials = list(progress(
+                pool.imap_unordered(merge_session_batch, tasks)))
+        partial = reduce_partial_global_contexts(pool, processors, partials)
+        if partial is not None:
+            pickled_partial, manifest_entries, partial_costs = partial
+            partial = pickle.loads(pickled_partial)
             for processor in processors:
-                processor.merge_contexts(
-                        persistent_context, ephemeral_context, global_context)
+                processor.combine_global_contexts(global_context, partial)
+            manifest.update(manifest_entries)
+            for key, cost in partial_costs.iteritems():
+                record_cost(costs, key, *cost)
+        pool.close()
+        pool.join()
+    else:
+        # Tasks are packed by the scheduler, most expensive first.
+        results = pool.imap_unordered(process_session_batch, tasks)
+        for batch_results in progress(results):
+            for persistent_pickle, ephemeral_pickle, cost in batch_results:
+                persistent_context = pickle.loads(persistent_pickle)
+                ephemeral_context = pickle.loads(ephemeral_pickle)
+                for processor in processors:
+                    processor.merge_contexts(persistent_context,
+                                             ephemeral_context,
+                                             global_context)
+                key = context_key(persistent_context)
+                manifest[key] = \
+                        persistent_context.last_sequence_number_processed
+                record_cost(costs, key, *cost)
         pool.close()
         pool.join()
+    save_manifest(disk_pickle_root, manifest)
+    save_costs(disk_pickle_root, costs)
     for processor in processors:
         processor.complete_global_context(global_context)
     if cached_global_context is not None:
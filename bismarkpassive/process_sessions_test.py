@@ -0,0 +1,178 @@
+import harness
+import process_sessions
+from session_processor import PersistentSessionProcessor
+from update_parser_benchmark import encoded_updates
+from update_statistics_processor import DataAvailabilityProcessor
+from updates_index import UpdatesIndexer
+
+from collections import defaultdict
+from cStringIO import StringIO
+from optparse import Values
+from os.path import join
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+import unittest
+
+def index_updates(filename, seeds, sequence_numbers, backend='sqlite'):
+    indexer = UpdatesIndexer(backend, filename)
+    indexer.index([], encoded_updates(seeds, sequence_numbers, packets=20))
+    indexer.close()
+
+class PacketCountProcessor(PersistentSessionProcessor):
+    mergeable = True
+    retractable = True
+
+    def initialize_context(self, context):
+        context.packets = 0
+
+    def process_update_persistent(self, context, update):
+        context.packets += len(update.packet_series)
+
+    def initialize_global_context(self, global_context):
+        global_context.packets = defaultdict(int)
+
+    def merge_contexts_persistent(self, context, global_context):
+        global_context.packets[context.node_id] += context.packets
+
+    def combine_global_contexts(self, global_context, partial_global_context):
+        for node_id, packets in partial_global_context.packets.items():
+            global_context.packets[node_id] += packets
+
+    def retract_global_context(self, global_context, partial_global_context):
+        for node_id, packets in partial_global_context.packets.items():
+            global_context.packets[node_id] -= packets
+
+class UnmergeablePacketCountProcessor(PacketCountProcessor):
+    mergeable = False
+    retractable = False
+
+class TestHarness(harness.Harness):
+    processors = [PacketCountProcessor, DataAvailabilityProcessor]
+
+    def process_results(self, global_context):
+        self.results = (dict(global_context.packets),
+                        dict(global_context.availability_intervals))
+
+class UnmergeableTestHarness(TestHarness):
+    processors = [UnmergeablePacketCountProcessor, DataAvailabilityProcessor]
+
+class TestProcessSessions(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.index = join(self.directory, 'index.sqlite')
+        self.pickles = join(self.directory, 'pickles')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def run_harness(self,
+                    num_workers=0,
+                    pickles=None,
+                    harness_class=TestHarness,
+                    backend='sqlite',
+                    index=None,
+                    **options):
+        test_harness = harness_class(Values({ 'include_nodes': None,
+                                              'exclude_nodes': None }))
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            process_sessions.process_sessions(test_harness,
+                                              backend,
+                                              index or self.index,
+                                              {},
+                                              pickles or self.pickles,
+                                              None,
+                                              num_workers,
+                                              **options)
+        finally:
+            sys.stdout = stdout
+        return test_harness.results
+
+    def test_incremental_after_normal_run(self):
+        incremental = join(self.directory, 'incremental.pickle')
+        index_updates(self.index, range(2), range(10))
+        first = self.run_harness()
+        self.assertEqual(
+                self.run_harness(incremental_global_context=incremental),
+                first)
+        index_updates(self.index, range(2), range(10, 20))
+        second = self.run_harness()
+        self.assertNotEqual(second, first)
+        self.assertEqual(
+                self.run_harness(incremental_global_context=incremental),
+                second)
+        self.assertEqual(
+                self.run_harness(num_workers=2,
+                                 incremental_global_context=incremental),
+                second)
+
+    def test_incremental_different_pickles(self):
+        incremental = join(self.directory, 'incremental.pickle')
+        index_updates(self.index, range(2), range(10))
+        full = self.run_harness(incremental_global_context=incremental)
+        windowed = self.run_harness(incremental_global_context=incremental,
+                                    start_time=1300000150)
+        self.assertNotEqual(windowed[0], full[0])
+        self.assertEqual(windowed, self.run_harness(start_time=1300000150))
+        other_pickles = join(self.directory, 'other_pickles')
+        self.assertEqual(self.run_harness(pickles=other_pickles),
+                         self.run_harness(
+                             pickles=other_pickles,
+                             incremental_global_context=incremental))
+
+    def test_workers(self):
+        index_updates(self.index, range(7), range(5))
+        serial = self.run_harness(pickles=join(self.directory, 'serial'))
+        self.assertEqual(len(serial[0]), 7)
+        # Mergeable processors combine partial global contexts on the pool,
+        # and the others send every session's contexts back to this process.
+        for harness_class in [TestHarness, UnmergeableTestHarness]:
+            pickles = join(self.directory, harness_class.__name__)
+            self.assertEqual(self.run_harness(num_workers=3,
+                                              pickles=pickles,
+                                              harness_class=harness_class),
+                             serial)
+
+    def test_pipeline_updates(self):
+        # Postgres needs a server, so only the sqlite backends run here. The
+        # indexes hold different updates, so reading from the wrong index
+        # gives different results.
+        sharded = join(self.directory, 'sharded')
+        indexes = [('sqlite', self.index, range(2)),
+                   ('sqlite-sharded', sharded, range(3))]
+        for backend, index, seeds in indexes:
+            index_updates(index, seeds, range(10), backend)
+        # Serial runs reuse one read ahead process for every index.
+        for num_workers in [0, 2]:
+            for backend, index, seeds in indexes:
+                for start_time in [None, 1300000100]:
+                    pickles = join(self.directory, '%s-%d-%s' % (
+                            backend, num_workers, start_time))
+                    expected = self.run_harness(pickles=pickles + '-expected',
+                                                backend=backend,
+                                                index=index,
+                                                start_time=start_time)
+                    self.assertEqual(len(expected[0]), len(seeds))
+                    self.assertEqual(
+                            self.run_harness(num_workers=num_workers,
+                                             pickles=pickles,
+                                             backend=backend,
+                                             index=index,
+                                             start_time=start_time,
+                                             pipeline_updates=1),
+                            expected)
+
+    def test_window_availability(self):
+        index_updates(self.index, range(2), range(10))
+        packets, availability = self.run_harness(start_time=1300000150,
+                                                 end_time=1300000240)
+        self.assertEqual(sorted(availability), ['OWBENCHMARK0', 'OWBENCHMARK1'])
+        for intervals in availability.values():
+            (lower, upper), = intervals
+            self.assertTrue(lower is not None)
+            self.assertTrue(lower < upper)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Schedule sessions for processing by their predicted cost.
+
+Processing records how long each session took per new update. The next run
+predicts the cost of each session from the number of updates it has to
+process and its recorded rate, starts the most expensive sessions first, and
+packs cheap sessions together into tasks, so workers spend less time on
+per-task overhead and the run doesn't end with one huge session running
+alone.
+"""
+
+from os import rename
+from os.path import join
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Records the processing time per update of each session.
+COSTS_FILENAME = 'costs.pickle'
+
+# Seconds per update for sessions without a recorded rate, when no session
+# has one.
+DEFAULT_SECONDS_PER_UPDATE = 0.01
+
+# Cheap sessions are packed into tasks of about 1/TASKS_PER_WORKER of each
+# worker's share of the work.
+TASKS_PER_WORKER = 8
+
+def load_costs(disk_pickle_root):
+    try:
+        return pickle.load(open(join(disk_pickle_root, COSTS_FILENAME), 'rb'))
+    except:
+        return {}
+
+def save_costs(disk_pickle_root, costs):
+    costs_path = join(disk_pickle_root, COSTS_FILENAME)
+    with open(costs_path + '.tmp', 'wb') as handle:
+        pickle.dump(costs, handle, pickle.HIGHEST_PROTOCOL)
+    rename(costs_path + '.tmp', costs_path)
+
+def record_cost(costs, key, seconds, updates_processed):
+    """Record the processing time of a session. Sessions without new updates
+    only show the fixed cost of loading their contexts, so they don't change
+    the recorded rate."""
+    if updates_processed > 0:
+        costs[key] = seconds / updates_processed
+
+def default_rate(costs):
+    """Return the median recorded rate, for sessions without one."""
+    if not costs:
+        return DEFAULT_SECONDS_PER_UPDATE
+    rates = sorted(costs.itervalues())
+    return rates[len(rates) // 2]
+
+def new_updates(session, last_sequence_number_processed):
+    """Estimate the number of updates a session has left to process from its
+    catalog entry."""
+    if session.max_sequence_number is None:
+        return 1
+    if last_sequence_number_processed is None:
+        if session.update_count is not None:
+            return max(session.update_count, 1)
+        last_sequence_number_processed = -1
+    return max(session.max_sequence_number - last_sequence_number_processed, 1)
+
+def pack_tasks(items, predicted_costs, num_workers):
+    """Group items into tasks, given the predicted cost of each item.
+
+    Items predicted to cost at least a 1/TASKS_PER_WORKER share of a worker's
+    work get tasks of their own, and cheaper items are packed together up to
+    that cost. Return a list of (cost, items) tuples, most expensive first."""
+    total_cost = sum(predicted_costs)
+    target_cost = total_cost / (max(num_workers, 1) * TASKS_PER_WORKER)
+    tasks = []
+    batch = []
+    batch_cost = 0
+    for cost, item in sorted(zip(predicted_costs, items),
+                             key=lambda (cost, item): cost,
+                             reverse=True):
+        if cost >= target_cost:
+            tasks.append((cost, [item]))
+            continue
+        batch.append(item)
+        batch_cost += cost
+        if batch_cost >= target_cost:
+            tasks.append((batch_cost, batch))
+            batch = []
+            batch_cost = 0
+    if batch:
+        tasks.append((batch_cost, batch))
+    tasks.sort(key=lambda (cost, items): cost, reverse=True)
+    return tasks
+
+def balance_tasks(items, predicted_costs, number_of_tasks):
+    """Split items into number_of_tasks tasks of about the same predicted
+    cost, by assigning the most expensive items first to the cheapest task.
+    Return a list of (cost, items) tuples, most expensive first, without
+    empty tasks."""
+    tasks = [(0, []) for _ in range(number_of_tasks)]
+    for cost, item in sorted(zip(predicted_costs, items),
+                             key=lambda (cost, item): cost,
+                             reverse=True):
+        index = min(range(len(tasks)), key=lambda index: tasks[index][0])
+        task_cost, task_items = tasks[index]
+        task_items.append(item)
+        tasks[index] = (task_cost + cost, task_items)
+    tasks = [task for task in tasks if task[1]]
+    tasks.sort(key=lambda (cost, items): cost, reverse=True)
+    return tasks
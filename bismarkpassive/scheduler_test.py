@@ -0,0 +1,34 @@
+import scheduler
+
+import unittest
+
+class TestScheduler(unittest.TestCase):
+    def test_pack_tasks(self):
+        items = ['big', 'a', 'b', 'c', 'd']
+        costs = [100, 1, 1, 1, 1]
+        tasks = scheduler.pack_tasks(items, costs, 1)
+        self.assertEqual(tasks[0], (100, ['big']))
+        self.assertEqual(sorted(item for cost, batch in tasks[1:]
+                                     for item in batch),
+                         ['a', 'b', 'c', 'd'])
+        self.assertTrue(len(tasks) < len(items))
+        self.assertEqual(scheduler.pack_tasks([], [], 4), [])
+
+    def test_balance_tasks(self):
+        tasks = scheduler.balance_tasks(range(6), [5, 4, 3, 3, 2, 1], 2)
+        self.assertEqual([cost for cost, items in tasks], [9, 9])
+        self.assertEqual(sorted(sum((items for cost, items in tasks), [])),
+                         range(6))
+        self.assertEqual(len(scheduler.balance_tasks([1], [1], 4)), 1)
+
+    def test_record_cost(self):
+        costs = {}
+        scheduler.record_cost(costs, 'a', 2.0, 4)
+        scheduler.record_cost(costs, 'b', 1.0, 0)
+        self.assertEqual(costs, {'a': 0.5})
+        self.assertEqual(scheduler.default_rate(costs), 0.5)
+        self.assertEqual(scheduler.default_rate({}),
+                         scheduler.DEFAULT_SECONDS_PER_UPDATE)
+
+if __name__ == '__main__':
+    unittest.main()
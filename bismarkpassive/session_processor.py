@@ -43,6 +43,17 @@ class SessionProcessor(object):
 
     __metaclass__ = ABCMeta
 
+    # Set this to True if the processor implements combine_global_contexts.
+    # When every processor of a harness is mergeable, worker processes merge
+    # sessions into partial global contexts, which are then combined.
+    mergeable = False
+
+    # Set this to True if the processor also implements
+    # retract_global_context, which lets incremental global contexts replace
+    # the contributions of changed sessions without combining every session
+    # again.
+    retractable = False
+
     def __init__(self, options):
         self._options = options
 
@@ -90,6 +101,22 @@ class SessionProcessor(object):
     def merge_contexts(self, persistent_context, ephemeral_context, global_context):
         """Merge the session's contexts into the global context."""
 
+    def combine_global_contexts(self, global_context, partial_global_context):
+        """Combine a partial global context into the global context.
+
+        Both contexts were initialized with initialize_global_context and have
+        had different sessions merged into them. Combining must give the same
+        result whatever order sessions were merged and partial contexts were
+        combined in. Partial global contexts are pickled, so they can't
+        contain lambdas. We only call this method if mergeable is True."""
+
+    def retract_global_context(self, global_context, partial_global_context):
+        """Undo combine_global_contexts.
+
+        partial_global_context was previously combined into global_context,
+        possibly along with other partial contexts since. Remove its
+        contribution. We only call this method if retractable is True."""
+
     def complete_global_context(self, global_context):
         """We call this method after merging peristent and ephemeral contexts
         for all sessions into the global context."""
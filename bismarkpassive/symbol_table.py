@@ -0,0 +1,108 @@
+from sys import getrefcount
+
+from update_parser import AddressEntry, DnsAEntry, DnsCnameEntry, FlowEntry
+
+# Tables are pruned whenever they reach twice their size after they were last
+# pruned, and at least this many symbols.
+MIN_PRUNE_SIZE = 1024
+
+# The references to a symbol that nothing outside the table uses, while prune
+# looks at it: the table's key and value, the list of keys, the loop variable
+# and getrefcount's argument.
+UNUSED_SYMBOL_REFERENCES = 5
+
+class SymbolTable(object):
+
+    """Maps every distinct identifier string to one shared instance of it.
+
+    The same anonymized IPs, MAC addresses and domains appear in every update
+    of a session, but each update parses them into fresh strings. Interning
+    them through a symbol table that lives as long as the session means the
+    tables built from them reference one copy of each identifier. Since pickle
+    writes an object referenced many times only once, keeping the symbol
+    table in the persistent context also preserves this sharing across
+    processing runs and shrinks the pickled context.
+
+    The table only keeps identifiers that something else still references,
+    so it doesn't outgrow the tables of the session that use it."""
+
+    # Tables pickled before pruning existed don't have their own.
+    _prune_size = MIN_PRUNE_SIZE
+
+    def __init__(self):
+        self._symbols = dict()
+        self._prune_size = MIN_PRUNE_SIZE
+
+    def intern(self, value):
+        return self._symbols.setdefault(value, value)
+
+    def prune(self):
+        """Drop the symbols nothing outside the table references any more,
+        such as identifiers from expired DNS mappings."""
+        symbols = self._symbols
+        for value in symbols.keys():
+            if getrefcount(value) <= UNUSED_SYMBOL_REFERENCES:
+                del symbols[value]
+        self._prune_size = max(2 * len(symbols), MIN_PRUNE_SIZE)
+
+    def prune_if_grown(self):
+        if len(self._symbols) >= self._prune_size:
+            self.prune()
+
+_new_tuple = tuple.__new__
+
+def intern_update(update, symbols):
+    """Replace the identifiers in an update's flow, DNS and address tables with
+    their shared instances from symbols. Entries are rebuilt with
+    tuple.__new__, which skips the argument handling of namedtuples."""
+    symbols.prune_if_grown()
+    intern = symbols._symbols.setdefault
+    update.flow_table = [
+            _new_tuple(FlowEntry, (flow_id,
+                                   source_ip_anonymized,
+                                   intern(source_ip, source_ip),
+                                   destination_ip_anonymized,
+                                   intern(destination_ip, destination_ip),
+                                   transport_protocol,
+                                   source_port,
+                                   destination_port))
+            for flow_id,
+                source_ip_anonymized,
+                source_ip,
+                destination_ip_anonymized,
+                destination_ip,
+                transport_protocol,
+                source_port,
+                destination_port in update.flow_table]
+    update.a_records = [
+            _new_tuple(DnsAEntry, (packet_id,
+                                   address_id,
+                                   anonymized,
+                                   intern(domain, domain),
+                                   intern(ip_address, ip_address),
+                                   ttl))
+            for packet_id,
+                address_id,
+                anonymized,
+                domain,
+                ip_address,
+                ttl in update.a_records]
+    update.cname_records = [
+            _new_tuple(DnsCnameEntry, (packet_id,
+                                       address_id,
+                                       domain_anonymized,
+                                       intern(domain, domain),
+                                       cname_anonymized,
+                                       intern(cname, cname),
+                                       ttl))
+            for packet_id,
+                address_id,
+                domain_anonymized,
+                domain,
+                cname_anonymized,
+                cname,
+                ttl in update.cname_records]
+    update.addresses = [
+            _new_tuple(AddressEntry, (intern(mac_address, mac_address),
+                                      intern(ip_address, ip_address)))
+            for mac_address, ip_address in update.addresses]
@@ -0,0 +1,75 @@
+import correlation_processor
+from process_sessions import PersistentContext
+import symbol_table
+from update_parser import PassiveUpdate
+from updates_index_sqlite import Session
+import update_parser_benchmark
+
+import unittest
+
+class TestSymbolTable(unittest.TestCase):
+    def test_intern(self):
+        table = symbol_table.SymbolTable()
+        first = ''.join(['a', 'b'])
+        second = ''.join(['a', 'b'])
+        self.assertFalse(first is second)
+        self.assertTrue(table.intern(first) is first)
+        self.assertTrue(table.intern(second) is first)
+
+    def test_intern_update(self):
+        table = symbol_table.SymbolTable()
+        contents = update_parser_benchmark.small_updates([0], range(2))
+        first, second = map(PassiveUpdate, contents)
+        self.assertFalse(first.addresses[0].ip_address
+                         is second.addresses[0].ip_address)
+        symbol_table.intern_update(first, table)
+        symbol_table.intern_update(second, table)
+        original = PassiveUpdate(contents[0])
+        self.assertEqual(first.addresses, original.addresses)
+        self.assertEqual(first.flow_table, original.flow_table)
+        self.assertEqual(first.a_records, original.a_records)
+        self.assertEqual(first.cname_records, original.cname_records)
+        for first_address, second_address in zip(first.addresses,
+                                                 second.addresses):
+            self.assertTrue(first_address.ip_address
+                            is second_address.ip_address)
+            self.assertTrue(first_address.mac_address
+                            is second_address.mac_address)
+
+    def test_prune(self):
+        table = symbol_table.SymbolTable()
+        kept = [table.intern('kept %d' % index) for index in range(10)]
+        for index in range(10):
+            table.intern('dropped %d' % index)
+        table.prune()
+        self.assertEqual(sorted(table._symbols), sorted(kept))
+
+    def test_table_does_not_grow(self):
+        table = symbol_table.SymbolTable()
+        for index in range(10 * symbol_table.MIN_PRUNE_SIZE):
+            table.intern('symbol %d' % index)
+            table.prune_if_grown()
+            self.assertTrue(len(table._symbols) <= symbol_table.MIN_PRUNE_SIZE)
+
+    def test_session_table(self):
+        context = PersistentContext(Session('OWBENCHMARK0', 'context', 0))
+        processors = [
+                correlation_processor.SymbolTableSessionProcessor(None),
+                correlation_processor.FlowCorrelationSessionProcessor(None)]
+        for processor in processors:
+            processor.initialize_persistent_context(context)
+        for contents in update_parser_benchmark.small_updates([0], range(20)):
+            update = PassiveUpdate(contents)
+            for processor in processors:
+                processor.process_update_persistent(context, update)
+        del update
+        for processor in processors:
+            processor.complete_session_persistent(context)
+        flow_ips = set()
+        for flow in context.flows.values():
+            flow_ips.add(flow.source_ip)
+            flow_ips.add(flow.destination_ip)
+        self.assertEqual(set(context.symbols._symbols), flow_ips)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+"""
+A compact, versioned binary encoding of PassiveUpdate objects.
+
+The updates index used to store every update as a pickle. Pickles of
+thousands of namedtuples and datetimes are slow to load, bulky, and tied to
+the exact layout of the parser's classes. Instead, this codec stores each
+section of an update as fixed-width columns (one array per field), and all of
+an update's strings once in a shared string table.
+
+Encoded updates start with FORMAT_TAG followed by a one byte codec version, so
+decode_update can tell them apart from the pickles in older index rows and
+keep loading those.
+"""
+
+from array import array
+try:
+    from cPickle import loads
+except ImportError:
+    from pickle import loads
+import datetime
+from itertools import imap, izip, repeat
+import struct
+import sys
+
+from update_parser import AddressEntry, \
+                          DnsAEntry, \
+                          DnsCnameEntry, \
+                          FlowEntry, \
+                          HttpUrlEntry, \
+                          MICROSECONDS_PER_SECOND, \
+                          PacketEntry, \
+                          PacketSeries, \
+                          PassiveUpdate
+
+FORMAT_TAG = 'BPUC'
+# Version 2 stores DNS TTLs as 64 bit integers instead of 32 bit ones.
+CODEC_VERSION = 2
+
+# Flags describing which optional parts of an update are present.
+HAS_PCAP_STATISTICS = 1 << 0
+ANONYMIZED = 1 << 1
+HAS_BODY = 1 << 2
+RAW_TIMESTAMPS = 1 << 3
+COLUMNAR = 1 << 4
+HAS_DROP_STATISTICS = 1 << 5
+HAS_HTTP_URLS = 1 << 6
+
+EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+def _typecode(itemsize, signed):
+    for code in ('bhilq' if signed else 'BHILQ'):
+        try:
+            if array(code).itemsize == itemsize:
+                return code
+        except ValueError:
+            pass
+    raise ValueError('No %d byte array type' % itemsize)
+
+UINT8 = _typecode(1, False)
+INT32 = _typecode(4, True)
+UINT32 = _typecode(4, False)
+# Python 2's array module only has 8 byte integers where C longs are 8 bytes.
+# Elsewhere, INT64 columns are packed with struct and decode as tuples.
+try:
+    INT64 = _typecode(8, True)
+except ValueError:
+    INT64 = None
+
+_HEADER = struct.Struct('<BiqiqqqqI')
+_COUNT = struct.Struct('<I')
+_INTEGER = struct.Struct('<q')
+
+def _records(record_type, rows):
+    """Build namedtuples of record_type from rows of fields. This skips the
+    field count check of record_type._make, which makes it much faster."""
+    return list(imap(tuple.__new__, repeat(record_type), rows))
+
+def _convert(column, typecode):
+    if getattr(column, 'typecode', None) == typecode:
+        return column
+    return array(typecode, column)
+
+def _microseconds(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        delta = timestamp - EPOCH
+        return (delta.days * 86400 + delta.seconds) * MICROSECONDS_PER_SECOND \
+                + delta.microseconds
+    return timestamp
+
+def _seconds(ttl):
+    if isinstance(ttl, datetime.timedelta):
+        return ttl.days * 86400 + ttl.seconds
+    return ttl // MICROSECONDS_PER_SECOND
+
+class _Encoder(object):
+    def __init__(self):
+        self._chunks = []
+        self._string_indices = {}
+        self._strings = []
+
+    def string(self, value):
+        try:
+            return self._string_indices[value]
+        except KeyError:
+            index = self._string_indices[value] = len(self._strings)
+            self._strings.append(value)
+            return index
+
+    def strings(self, values):
+        return map(self.string, values)
+
+    def integers(self, *values):
+        for value in values:
+            self._chunks.append(_INTEGER.pack(value))
+
+    def columns(self, count, *columns):
+        self._chunks.append(_COUNT.pack(count))
+        for typecode, values in columns:
+            if typecode is None:
+                self._chunks.append(struct.pack('<%dq' % len(values),
+                                                *imap(int, values)))
+                continue
+            if isinstance(values, array) and values.typecode == typecode \
+                    and sys.byteorder == 'little':
+                self._chunks.append(values.tostring())
+                continue
+            column = array(typecode, values)
+            if sys.byteorder == 'big':
+                column.byteswap()
+            self._chunks.append(column.tostring())
+
+    def finish(self, header):
+        lengths = array(UINT32, map(len, self._strings))
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+        return ''.join([FORMAT_TAG,
+                        header,
+                        _COUNT.pack(len(self._strings)),
+                        lengths.tostring(),
+                        ''.join(self._strings)] + self._chunks)
+
+class _Decoder(object):
+    def __init__(self, data, offset):
+        self._data = data
+        self._offset = offset
+        count = self.count()
+        lengths = self.column(UINT32, count)
+        self.strings = []
+        for length in lengths:
+            self.strings.append(data[self._offset:self._offset + length])
+            self._offset += length
+
+    def count(self):
+        value, = _COUNT.unpack_from(self._data, self._offset)
+        self._offset += _COUNT.size
+        return value
+
+    def integers(self, count):
+        values = struct.unpack_from('<%dq' % count, self._data, self._offset)
+        self._offset += count * _INTEGER.size
+        return values
+
+    def column(self, typecode, count):
+        if typecode is None:
+            return self.integers(count)
+        column = array(typecode)
+        end = self._offset + count * column.itemsize
+        column.fromstring(self._data[self._offset:end])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        self._offset = end
+        return column
+
+    def string_column(self, count):
+        return map(self.strings.__getitem__, self.column(UINT32, count))
+
+def encode_update(update):
+    """Encode a PassiveUpdate (including one parsed with onlyheaders, columnar,
+    lazy or raw_timestamps) as a string. This decodes every section of a lazy
+    update, and decoding an encoded update decodes every section too."""
+    encoder = _Encoder()
+    flags = 0
+    if hasattr(update, 'pcap_received'):
+        flags |= HAS_PCAP_STATISTICS
+        pcap_statistics = (update.pcap_received,
+                           update.pcap_dropped,
+                           update.iface_dropped)
+    else:
+        pcap_statistics = (0, 0, 0)
+    if update.anonymized:
+        flags |= ANONYMIZED
+        signature = update.anonymization_signature
+    else:
+        signature = ''
+    encoder.columns(3, (UINT32, encoder.strings([update.build_id,
+                                                 update.bismark_id,
+                                                 signature])))
+    encoder.columns(len(update.whitelist),
+                    (UINT32, encoder.strings(update.whitelist)))
+    if update.raw_timestamps:
+        flags |= RAW_TIMESTAMPS
+
+    if hasattr(update, 'packet_series'):
+        flags |= HAS_BODY
+        packet_series = update.packet_series
+        encoder.integers(update.packet_series_dropped)
+        if isinstance(packet_series, PacketSeries):
+            flags |= COLUMNAR
+            encoder.columns(len(packet_series),
+                            (INT64, packet_series.timestamps),
+                            (UINT32, packet_series.sizes),
+                            (UINT32, packet_series.flow_ids))
+        else:
+            encoder.columns(len(packet_series),
+                            (INT64, [_microseconds(packet.timestamp)
+                                     for packet in packet_series]),
+                            (UINT32, [packet.size
+                                      for packet in packet_series]),
+                            (UINT32, [packet.flow_id
+                                      for packet in packet_series]))
+
+        flows = update.flow_table
+        encoder.integers(update.flow_table_baseline,
+                         update.flow_table_size,
+                         update.flow_table_expired,
+                         update.flow_table_dropped)
+        encoder.columns(len(flows),
+                        (UINT32, [flow.flow_id for flow in flows]),
+                        (UINT8, [flow.source_ip_anonymized for flow in flows]),
+                        (UINT32, encoder.strings(flow.source_ip
+                                                 for flow in flows)),
+                        (UINT8, [flow.destination_ip_anonymized
+                                 for flow in flows]),
+                        (UINT32, encoder.strings(flow.destination_ip
+                                                 for flow in flows)),
+                        (UINT32, [flow.transport_protocol for flow in flows]),
+                        (UINT32, [flow.source_port for flow in flows]),
+                        (UINT32, [flow.destination_port for flow in flows]))
+
+        records = update.a_records
+        encoder.integers(update.dropped_a_records,
+                         update.dropped_cname_records)
+        encoder.columns(len(records),
+                        (UINT32, [record.packet_id for record in records]),
+                        (UINT32, [record.address_id for record in records]),
+                        (UINT8, [record.anonymized for record in records]),
+                        (UINT32, encoder.strings(record.domain
+                                                 for record in records)),
+                        (UINT32, encoder.strings(record.ip_address
+                                                 for record in records)),
+                        (INT64, [_seconds(record.ttl) for record in records]))
+
+        records = update.cname_records
+        encoder.columns(len(records),
+                        (UINT32, [record.packet_id for record in records]),
+                        (UINT32, [record.address_id for record in records]),
+                        (UINT8, [record.domain_anonymized
+                                 for record in records]),
+                        (UINT32, encoder.strings(record.domain
+                                                 for record in records)),
+                        (UINT8, [record.cname_anonymized
+                                 for record in records]),
+                        (UINT32, encoder.strings(record.cname
+                                                 for record in records)),
+                        (INT64, [_seconds(record.ttl) for record in records]))
+
+        addresses = update.addresses
+        encoder.integers(update.address_table_first_id,
+                         update.address_table_size)
+        encoder.columns(len(addresses),
+                        (UINT32, encoder.strings(address.mac_address
+                                                 for address in addresses)),
+                        (UINT32, encoder.strings(address.ip_address
+                                                 for address in addresses)))
+
+        if hasattr(update, 'dropped_packets'):
+            flags |= HAS_DROP_STATISTICS
+            sizes = sorted(update.dropped_packets)
+            encoder.columns(len(sizes),
+                            (INT64, sizes),
+                            (INT64, [update.dropped_packets[size]
+                                     for size in sizes]))
+
+        if hasattr(update, 'http_urls'):
+            flags |= HAS_HTTP_URLS
+            urls = update.http_urls
+            encoder.integers(update.dropped_http_urls)
+            encoder.columns(len(urls),
+                            (UINT32, [url.flow_id for url in urls]),
+                            (UINT32, encoder.strings(url.hashed_url
+                                                     for url in urls)))
+
+    header = _HEADER.pack(CODEC_VERSION,
+                          update.file_format_version,
+                          update.creation_time,
+                          update.sequence_number,
+                          _microseconds(update.timestamp),
+                          pcap_statistics[0],
+                          pcap_statistics[1],
+                          pcap_statistics[2],
+                          flags)
+    return encoder.finish(header)
+
+def decode_update(data):
+    """Decode a string produced by encode_update. For compatibility with older
+    index rows, data may also be a pickled PassiveUpdate."""
+    if not data.startswith(FORMAT_TAG):
+        return loads(data)
+    (version,
+     file_format_version,
+     creation_time,
+     sequence_number,
+     timestamp,
+     pcap_received,
+     pcap_dropped,
+     iface_dropped,
+     flags) = _HEADER.unpack_from(data, len(FORMAT_TAG))
+    if version > CODEC_VERSION:
+        raise ValueError('Unsupported update codec version %d' % version)
+    ttl_type = INT32 if version < 2 else INT64
+    decoder = _Decoder(data, len(FORMAT_TAG) + _HEADER.size)
+    build_id, bismark_id, signature = decoder.string_column(decoder.count())
+    raw_timestamps = bool(flags & RAW_TIMESTAMPS)
+    if raw_timestamps:
+        def ttl(seconds):
+            return seconds * MICROSECONDS_PER_SECOND
+    else:
+        def ttl(seconds):
+            return datetime.timedelta(seconds=seconds)
+
+    update = PassiveUpdate.__new__(PassiveUpdate)
+    if raw_timestamps:
+        update.raw_timestamps = True
+        update.timestamp = timestamp
+    else:
+        update.timestamp = \
+                datetime.datetime.utcfromtimestamp(timestamp / 1e6)
+    update.file_format_version = file_format_version
+    update.build_id = build_id
+    update.bismark_id = bismark_id
+    update.creation_time = creation_time
+    update.sequence_number = sequence_number
+    if flags & HAS_PCAP_STATISTICS:
+        update.pcap_received = pcap_received
+        update.pcap_dropped = pcap_dropped
+        update.iface_dropped = iface_dropped
+    update.whitelist = decoder.string_column(decoder.count())
+    update.anonymized = bool(flags & ANONYMIZED)
+    if update.anonymized:
+        update.anonymization_signature = signature
+
+    if not flags & HAS_BODY:
+        return update
+
+    update.packet_series_dropped, = decoder.integers(1)
+    count = decoder.count()
+    timestamps = decoder.column(INT64, count)
+    sizes = decoder.column(UINT32, count)
+    flow_ids = decoder.column(UINT32, count)
+    if flags & COLUMNAR:
+        update._columnar = True
+        packet_series = update.packet_series = PacketSeries(raw_timestamps)
+        packet_series.timestamps = _convert(timestamps,
+                                            packet_series.timestamps.typecode)
+        packet_series.sizes = _convert(sizes, packet_series.sizes.typecode)
+        packet_series.flow_ids = _convert(flow_ids,
+                                          packet_series.flow_ids.typecode)
+    elif raw_timestamps:
+        update.packet_series = _records(PacketEntry,
+                                   izip(timestamps, sizes, flow_ids))
+    else:
+        update.packet_series = _records(
+                PacketEntry,
+                izip([datetime.datetime.utcfromtimestamp(t / 1e6)
+                      for t in timestamps],
+                     sizes,
+                     flow_ids))
+
+    (update.flow_table_baseline,
+     update.flow_table_size,
+     update.flow_table_expired,
+     update.flow_table_dropped) = decoder.integers(4)
+    count = decoder.count()
+    update.flow_table = _records(FlowEntry,
+                            izip(decoder.column(UINT32, count),
+                                 decoder.column(UINT8, count),
+                                 decoder.string_column(count),
+                                 decoder.column(UINT8, count),
+                                 decoder.string_column(count),
+                                 decoder.column(UINT32, count),
+                                 decoder.column(UINT32, count),
+                                 decoder.column(UINT32, count)))
+
+    update.dropped_a_records, update.dropped_cname_records = \
+            decoder.integers(2)
+    count = decoder.count()
+    update.a_records = _records(DnsAEntry,
+                           izip(decoder.column(UINT32, count),
+                                decoder.column(UINT32, count),
+                                decoder.column(UINT8, count),
+                                decoder.string_column(count),
+                                decoder.string_column(count),
+                                map(ttl, decoder.column(ttl_type, count))))
+
+    count = decoder.count()
+    update.cname_records = _records(DnsCnameEntry,
+                               izip(decoder.column(UINT32, count),
+                                    decoder.column(UINT32, count),
+                                    decoder.column(UINT8, count),
+                                    decoder.string_column(count),
+                                    decoder.column(UINT8, count),
+                                    decoder.string_column(count),
+                                    map(ttl, decoder.column(ttl_type, count))))
+
+    update.address_table_first_id, update.address_table_size = \
+            decoder.integers(2)
+    count = decoder.count()
+    update.addresses = _records(AddressEntry,
+                           izip(decoder.string_column(count),
+                                decoder.string_column(count)))
+
+    if flags & HAS_DROP_STATISTICS:
+        count = decoder.count()
+        update.dropped_packets = dict(izip(decoder.column(INT64, count),
+                                           decoder.column(INT64, count)))
+
+    if flags & HAS_HTTP_URLS:
+        update.dropped_http_urls, = decoder.integers(1)
+        count = decoder.count()
+        update.http_urls = _records(HttpUrlEntry,
+                               izip(decoder.column(UINT32, count),
+                                    decoder.string_column(count)))
+
+    return update
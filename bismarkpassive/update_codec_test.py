@@ -0,0 +1,157 @@
+import update_codec
+import update_parser
+import update_parser_benchmark
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import unittest
+
+# An update encoded by version 1 of the codec, which stored DNS TTLs as 32 bit
+# integers.
+VERSION_1_UPDATE = (
+        '425055430104000000006d7c4d0000000000000000004035d6579e0400010000'
+        '0000000000000000000000000000000000000000006700000007000000070000'
+        '000c000000200000001000000010000000100000000c0000004255494c444944'
+        '4f5742454e43484d41524b306562313136376233363761396333373837633635'
+        '6331653538326532653636323632396636666265643832633037636465336537'
+        '3036383263323039346361636637323862346661343234383565336130613564'
+        '3662616139343535030000000000000001000000020000000000000000000000'
+        '0000000001000000e64935d6579e040078050000070000000700000000000000'
+        '0000010000000000000000000000000000000000000000000100000007000000'
+        '010300000001040000000600000084c900003500000000000000000000000000'
+        '000000000000010000000000000000000000010500000004000000345f000001'
+        '000000000000000000000001050000000105000000b24b010000000000000000'
+        '0000010000000000000100000006000000030000000200000028000000000000'
+        '00dc050000000000005b00000000000000510000000000000000000000000000'
+        '0000000000').decode('hex')
+
+def normalize(update):
+    attributes = dict(update.__dict__)
+    series = attributes.get('packet_series')
+    if isinstance(series, update_parser.PacketSeries):
+        attributes['packet_series'] = (list(series.timestamps),
+                                       list(series.sizes),
+                                       list(series.flow_ids),
+                                       series.raw_timestamps)
+    return attributes
+
+def roundtrip(update):
+    return update_codec.decode_update(update_codec.encode_update(update))
+
+class TestCodec(unittest.TestCase):
+    def assertSameUpdate(self, first, second):
+        self.assertTrue(normalize(first) == normalize(second))
+        self.assertTrue(first.raw_timestamps == second.raw_timestamps)
+
+    def test_roundtrip(self):
+        for version in update_parser_benchmark.FILE_FORMAT_VERSIONS:
+            contents = update_parser_benchmark.generate_update(
+                    version, sequence_number=5, packets=200)
+            update = update_parser.PassiveUpdate(contents)
+            self.assertSameUpdate(roundtrip(update), update)
+
+    def test_roundtrip_modes(self):
+        contents = update_parser_benchmark.generate_update(packets=200)
+        for options in [{ 'onlyheaders': True },
+                        { 'columnar': True },
+                        { 'raw_timestamps': True },
+                        { 'columnar': True, 'raw_timestamps': True }]:
+            update = update_parser.PassiveUpdate(contents, **options)
+            decoded = roundtrip(update)
+            self.assertSameUpdate(decoded, update)
+            if 'onlyheaders' not in options:
+                self.assertTrue(list(decoded.packet_series)
+                                == list(update.packet_series))
+
+    def test_int64_without_arrays(self):
+        contents = update_parser_benchmark.generate_update(packets=200)
+        updates = [update_parser.PassiveUpdate(contents, **options)
+                   for options in [{},
+                                   { 'columnar': True },
+                                   { 'columnar': True,
+                                     'raw_timestamps': True }]]
+        encoded = map(update_codec.encode_update, updates)
+        int64 = update_codec.INT64
+        def restore():
+            update_codec.INT64 = int64
+        self.addCleanup(restore)
+        update_codec.INT64 = None
+        for update, data in zip(updates, encoded):
+            self.assertTrue(update_codec.encode_update(update) == data)
+            self.assertSameUpdate(update_codec.decode_update(data), update)
+
+    def test_large_ttls(self):
+        contents = update_parser_benchmark.generate_update(packets=200)
+        for options in [{}, { 'raw_timestamps': True }]:
+            update = update_parser.PassiveUpdate(contents, **options)
+            ttls = [update_parser.duration(update, 2 ** 31),
+                    update_parser.duration(update, 2 ** 33)]
+            update.a_records = [record._replace(ttl=ttls[index % 2])
+                                for index, record
+                                in enumerate(update.a_records)]
+            update.cname_records = [record._replace(ttl=ttls[index % 2])
+                                    for index, record
+                                    in enumerate(update.cname_records)]
+            decoded = roundtrip(update)
+            self.assertSameUpdate(decoded, update)
+            self.assertTrue(decoded.cname_records[1].ttl == ttls[1])
+
+    def test_version_1_ttls(self):
+        contents = update_parser_benchmark.generate_update(packets=1,
+                                                           flows=1,
+                                                           a_records=1,
+                                                           cname_records=1,
+                                                           addresses=1,
+                                                           http_urls=0,
+                                                           whitelist=0)
+        update = update_parser.PassiveUpdate(contents)
+        self.assertSameUpdate(update_codec.decode_update(VERSION_1_UPDATE),
+                              update)
+
+    def test_roundtrip_lazy(self):
+        contents = update_parser_benchmark.generate_update(packets=200)
+        update = update_parser.PassiveUpdate(contents)
+        lazy = update_parser.PassiveUpdate(contents, lazy=True)
+        self.assertSameUpdate(roundtrip(lazy), update)
+
+    def test_unanonymized(self):
+        source = '\n'.join(['9',
+                            'BUILDID',
+                            'BUILDID 1234567890 12 98765',
+                            '',
+                            '',
+                            'UNANONYMIZED',
+                            '',
+                            '0 0',
+                            '',
+                            '0 0 0 0',
+                            '',
+                            '0 0',
+                            '',
+                            '',
+                            '0 0'])
+        update = update_parser.PassiveUpdate(source)
+        decoded = roundtrip(update)
+        self.assertSameUpdate(decoded, update)
+        self.assertFalse(decoded.anonymized)
+        self.assertTrue(decoded.bismark_id == 'BUILDID')
+
+    def test_pickled_updates(self):
+        contents = update_parser_benchmark.generate_update(packets=20)
+        update = update_parser.PassiveUpdate(contents)
+        data = pickle.dumps(update, pickle.HIGHEST_PROTOCOL)
+        self.assertSameUpdate(update_codec.decode_update(data), update)
+
+    def test_unsupported_version(self):
+        contents = update_parser_benchmark.generate_update(packets=20)
+        data = update_codec.encode_update(update_parser.PassiveUpdate(contents))
+        tag_length = len(update_codec.FORMAT_TAG)
+        data = data[:tag_length] \
+                + chr(update_codec.CODEC_VERSION + 1) \
+                + data[tag_length + 1:]
+        self.assertRaises(ValueError, update_codec.decode_update, data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,11 @@
+from array import array
 from collections import namedtuple
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 import datetime
+from itertools import chain, imap, izip
 
 PacketEntry = namedtuple('PacketEntry', ['timestamp', 'size', 'flow_id'])
 FlowEntry = namedtuple('FlowEntry',
@@ -34,87 +40,340 @@ class ReservedFlowIndices(object):
     FLOW_ID_LAST_UNRESERVED = 65535
 ##############################################################################
 
-def parse_sections(lines):
-    sections = [[]]
-    section_counter = 0
-    for line in lines:
-        if len(line) == 0:
-            section_counter += 1
-            while len(sections) <= section_counter:
-                sections.append([])
-        else:
-            sections[section_counter].append(line)
-    return sections
+MICROSECONDS_PER_SECOND = 1000000
 
-class PassiveUpdate(object):
-    def __init__(self, contents, onlyheaders=False):
-        lines = contents.splitlines()
-        blocks = parse_sections(lines)
-
-        sections = {
-                'intro': blocks[0],
-                'whitelist': blocks[1],
-                'anonymization': blocks[2],
-                'packet_series': blocks[3],
-                'flow_table': blocks[4],
-                'dns_table_a': blocks[5],
-                'dns_table_cname': blocks[6],
-                'address_table': blocks[7]
-                }
+def _timestamp_typecode():
+    """Return the array typecode for timestamps in microseconds, which need 64
+    bits. Python 2's array module only has 64 bit integers where C longs are
+    64 bits, so elsewhere use doubles, which hold integers exactly up to 2**53
+    microseconds (the year 2255)."""
+    for code in 'ql':
         try:
-            sections['drop_statistics'] = blocks[8]
-        except IndexError:
+            if array(code).itemsize == 8:
+                return code
+        except ValueError:
             pass
-        try:
-            sections['http_urls'] = blocks[9]
-        except IndexError:
+    return 'd'
+
+TIMESTAMP_TYPECODE = _timestamp_typecode()
+
+def duration(update, seconds):
+    """Return a duration of the given number of seconds, in the same units
+    as the timestamps of update."""
+    if update.raw_timestamps:
+        return seconds * MICROSECONDS_PER_SECOND
+    return datetime.timedelta(seconds=seconds)
+
+class PacketSeries(object):
+
+    """A columnar packet series.
+
+    Stores packet timestamps (as integer microseconds since the epoch), sizes
+    and flow IDs in three parallel compact arrays, instead of one PacketEntry
+    per packet. Hot loops can iterate over the timestamps, sizes and flow_ids
+    arrays directly. For compatibility, indexing and iterating over the series
+    yields PacketEntry objects just like the list representation. Their
+    timestamps are datetimes, unless raw_timestamps is set.
+
+    The timestamps array has TIMESTAMP_TYPECODE, so on platforms where it
+    holds doubles, reading the array directly gives integral floats."""
+
+    __slots__ = ('timestamps', 'sizes', 'flow_ids', 'raw_timestamps')
+
+    def __init__(self, raw_timestamps=False):
+        self.timestamps = array(TIMESTAMP_TYPECODE)
+        self.sizes = array('I')
+        self.flow_ids = array('I')
+        self.raw_timestamps = raw_timestamps
+
+    def append(self, timestamp, size, flow_id):
+        self.timestamps.append(timestamp)
+        self.sizes.append(size)
+        self.flow_ids.append(flow_id)
+
+    def entry(self, index):
+        timestamp = self.timestamps[index]
+        if not self.raw_timestamps:
+            timestamp = datetime.datetime.utcfromtimestamp(timestamp / 1e6)
+        elif self.timestamps.typecode == 'd':
+            timestamp = int(timestamp)
+        return PacketEntry(
+                timestamp = timestamp,
+                size = self.sizes[index],
+                flow_id = self.flow_ids[index])
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return map(self.entry, xrange(*index.indices(len(self))))
+        return self.entry(index)
+
+    def __iter__(self):
+        if self.raw_timestamps:
+            timestamps = self.timestamps
+            if timestamps.typecode == 'd':
+                timestamps = imap(int, timestamps)
+            for timestamp, size, flow_id \
+                    in izip(timestamps, self.sizes, self.flow_ids):
+                yield PacketEntry(timestamp, size, flow_id)
+            return
+        for timestamp, size, flow_id \
+                in izip(self.timestamps, self.sizes, self.flow_ids):
+            yield PacketEntry(
+                    timestamp = datetime.datetime.utcfromtimestamp(
+                        timestamp / 1e6),
+                    size = size,
+                    flow_id = flow_id)
+
+    def __getstate__(self):
+        return (self.timestamps, self.sizes, self.flow_ids, self.raw_timestamps)
+
+    def __setstate__(self, state):
+        if len(state) == 3:
+            state += (False,)
+        self.timestamps, self.sizes, self.flow_ids, self.raw_timestamps = state
+
+class SectionReader(object):
+
+    """Splits an update into its blank-line separated sections in one pass.
+
+    source is either the contents of an update or a file-like object, such as
+    the GzipFile of an update inside a tarball. Lines are read from the source
+    as the sections are consumed, so the update never exists in memory as a
+    list of lines."""
+
+    def __init__(self, source):
+        if isinstance(source, basestring):
+            source = StringIO(source)
+        self._lines = iter(source)
+        self._current = None
+        self._exhausted = False
+
+    def _section_lines(self):
+        for line in self._lines:
+            line = line.rstrip('\r\n')
+            if len(line) == 0:
+                return
+            yield line
+        self._exhausted = True
+
+    def next_section(self):
+        """Return an iterator over the lines of the next section, or None if
+        there are no more sections. Any unread lines of the previous section
+        are skipped."""
+        if self._current is not None:
+            for line in self._current:
+                pass
+        if self._exhausted:
+            self._current = None
+        else:
+            self._current = self._section_lines()
+        return self._current
+
+    def required_section(self, name):
+        lines = self.next_section()
+        if lines is None:
+            raise ValueError('Update is missing the %s section' % name)
+        return lines
+
+    def skip_remaining(self):
+        while self.next_section() is not None:
             pass
 
-        self.file_format_version = int(sections['intro'][0])
-        self.build_id = sections['intro'][1]
-        intro_ids = sections['intro'][2].split()
+def next_line(lines, name):
+    for line in lines:
+        return line
+    raise ValueError('Update has an empty %s section' % name)
+
+# The sections following the header, in the order they appear in an update.
+BODY_SECTIONS = ['packet_series',
+                 'flow_table',
+                 'dns_table_a',
+                 'dns_table_cname',
+                 'address_table',
+                 'drop_statistics',
+                 'http_urls']
+# These sections are missing from some older file formats.
+OPTIONAL_SECTIONS = set(['drop_statistics', 'http_urls'])
+
+# Maps each attribute decoded from the body of an update to the decoder that
+# sets it. Lazy updates use this to decode sections on first access.
+DECODED_ATTRIBUTES = {
+        'packet_series_dropped': 'packet_series',
+        'packet_series': 'packet_series',
+        'flow_table_baseline': 'flow_table',
+        'flow_table_size': 'flow_table',
+        'flow_table_expired': 'flow_table',
+        'flow_table_dropped': 'flow_table',
+        'flow_table': 'flow_table',
+        'dropped_a_records': 'dns_table_a',
+        'dropped_cname_records': 'dns_table_a',
+        'a_records': 'dns_table_a',
+        'cname_records': 'dns_table_cname',
+        'address_table_first_id': 'address_table',
+        'address_table_size': 'address_table',
+        'addresses': 'address_table',
+        'dropped_packets': 'drop_statistics',
+        'dropped_http_urls': 'drop_statistics',
+        'http_urls': 'drop_statistics',
+        }
+
+class PassiveUpdate(object):
+
+    """A parsed update file.
+
+    contents is either the contents of an update file or a file-like object
+    from which to read them. If onlyheaders is set, only parse the header
+    sections (intro, whitelist and anonymization) and stop reading there. If
+    columnar is set, store the packet series as a PacketSeries instead of a
+    list of PacketEntry objects. If lazy is set, keep the raw lines of each
+    body section and only decode a section the first time one of its
+    attributes is accessed. This only saves work for code that parses update
+    files itself; indexing an update decodes all of it.
+
+    If raw_timestamps is set, the update's timestamp, packet timestamps and DNS
+    TTLs are integer microseconds instead of datetime and timedelta objects.
+    This makes parsing, processing and pickling much cheaper, but processors
+    must be written to handle integer timestamps."""
+
+    _columnar = False
+    raw_timestamps = False
+
+    def __init__(self, contents, onlyheaders=False, columnar=False, lazy=False,
+                 raw_timestamps=False):
+        reader = SectionReader(contents)
+        if raw_timestamps:
+            self.raw_timestamps = True
+
+        self._decode_intro(reader.required_section('intro'))
+        self._decode_whitelist(reader.required_section('whitelist'))
+        self._decode_anonymization(reader.required_section('anonymization'))
+
+        if onlyheaders:
+            return
+
+        if columnar:
+            self._columnar = True
+        if lazy:
+            self._pending_sections = {}
+            for name in BODY_SECTIONS:
+                if name in OPTIONAL_SECTIONS:
+                    lines = reader.next_section()
+                    if lines is None:
+                        break
+                else:
+                    lines = reader.required_section(name)
+                self._pending_sections[name] = list(lines)
+            self._pending_decoders = set(DECODED_ATTRIBUTES.itervalues())
+        else:
+            self._decode_packet_series(
+                    reader.required_section('packet_series'))
+            self._decode_flow_table(reader.required_section('flow_table'))
+            self._decode_dns_table_a(reader.required_section('dns_table_a'))
+            self._decode_dns_table_cname(
+                    reader.required_section('dns_table_cname'))
+            self._decode_address_table(
+                    reader.required_section('address_table'))
+            self._decode_trailer(reader.next_section(), reader.next_section)
+            reader.skip_remaining()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        decoder = DECODED_ATTRIBUTES.get(name)
+        pending = self.__dict__.get('_pending_decoders')
+        if decoder is None or not pending or decoder not in pending:
+            raise AttributeError(name)
+        pending.remove(decoder)
+        self._decode_pending(decoder)
+        if not pending:
+            del self._pending_sections
+            del self._pending_decoders
+        return object.__getattribute__(self, name)
+
+    def _decode_pending(self, decoder):
+        sections = self._pending_sections
+        def section(name):
+            if name in sections:
+                return iter(sections[name])
+            return None
+        if decoder == 'drop_statistics':
+            self._decode_trailer(section('drop_statistics'),
+                                 lambda: section('http_urls'))
+        else:
+            getattr(self, '_decode_' + decoder)(iter(sections[decoder]))
+
+    def _decode_intro(self, lines):
+        self.file_format_version = int(next_line(lines, 'intro'))
+        self.build_id = next_line(lines, 'intro')
+        intro_ids = next_line(lines, 'intro').split()
         self.bismark_id = intro_ids[0]
         self.creation_time = int(intro_ids[1])
         self.sequence_number = int(intro_ids[2])
-        self.timestamp = datetime.datetime.utcfromtimestamp(int(intro_ids[3]))
-        if len(sections['intro']) >= 4:
-            intro_stats = [ int(w) for w in sections['intro'][3].split() ]
+        if self.raw_timestamps:
+            self.timestamp = int(intro_ids[3]) * MICROSECONDS_PER_SECOND
+        else:
+            self.timestamp = \
+                    datetime.datetime.utcfromtimestamp(int(intro_ids[3]))
+        for line in lines:
+            intro_stats = [ int(w) for w in line.split() ]
             self.pcap_received = intro_stats[0]
             self.pcap_dropped = intro_stats[1]
             self.iface_dropped = intro_stats[2]
+            break
 
-        self.whitelist = list(sections['whitelist'])
+    def _decode_whitelist(self, lines):
+        self.whitelist = list(lines)
 
-        if sections['anonymization'][0] == 'UNANONYMIZED':
+    def _decode_anonymization(self, lines):
+        signature = next_line(lines, 'anonymization')
+        if signature == 'UNANONYMIZED':
             self.anonymized = False
         else:
             self.anonymized = True
-            self.anonymization_signature = sections['anonymization'][0]
+            self.anonymization_signature = signature
 
-        if onlyheaders:
-            return
-
-        packet_stats = [ int(w) for w in sections['packet_series'][0].split() ]
+    def _decode_packet_series(self, lines):
+        packet_stats = [ int(w) for w
+                in next_line(lines, 'packet_series').split() ]
         current_timestamp = packet_stats[0]
         self.packet_series_dropped = packet_stats[1]
-        self.packet_series = []
-        for line in sections['packet_series'][1:]:
-            offset, size, flow_id = [ int(w) for w in line.split() ]
-            current_timestamp += offset
-            self.packet_series.append(PacketEntry(
-                timestamp = datetime.datetime.utcfromtimestamp(
-                    current_timestamp / 1e6),
-                size = size,
-                flow_id = flow_id
-                ))
+        if self._columnar:
+            self.packet_series = PacketSeries(self.raw_timestamps)
+            for line in lines:
+                offset, size, flow_id = [ int(w) for w in line.split() ]
+                current_timestamp += offset
+                self.packet_series.append(current_timestamp, size, flow_id)
+        elif self.raw_timestamps:
+            self.packet_series = []
+            for line in lines:
+                offset, size, flow_id = [ int(w) for w in line.split() ]
+                current_timestamp += offset
+                self.packet_series.append(
+                        PacketEntry(current_timestamp, size, flow_id))
+        else:
+            self.packet_series = []
+            for line in lines:
+                offset, size, flow_id = [ int(w) for w in line.split() ]
+                current_timestamp += offset
+                self.packet_series.append(PacketEntry(
+                    timestamp = datetime.datetime.utcfromtimestamp(
+                        current_timestamp / 1e6),
+                    size = size,
+                    flow_id = flow_id
+                    ))
 
-        flow_stats = [ int(w) for w in sections['flow_table'][0].split() ]
+    def _decode_flow_table(self, lines):
+        flow_stats = [ int(w) for w
+                in next_line(lines, 'flow_table').split() ]
         self.flow_table_baseline = flow_stats[0]
         self.flow_table_size = flow_stats[1]
         self.flow_table_expired = flow_stats[2]
         self.flow_table_dropped = flow_stats[3]
         self.flow_table = []
-        for line in sections['flow_table'][1:]:
+        for line in lines:
             (flow_id, source_ip_anonymized, source_ip,
                     destination_ip_anonymized, destination_ip,
                     transport_protocol,
@@ -130,11 +389,13 @@ class PassiveUpdate(object):
                 destination_port = int(destination_port)
                 ))
 
-        dns_stats = [ int(w) for w in sections['dns_table_a'][0].split() ]
+    def _decode_dns_table_a(self, lines):
+        dns_stats = [ int(w) for w
+                in next_line(lines, 'dns_table_a').split() ]
         self.dropped_a_records = dns_stats[0]
         self.dropped_cname_records = dns_stats[1]
         self.a_records = []
-        for line in sections['dns_table_a'][1:]:
+        for line in lines:
             packet_id, address_id, anonymized, domain, address, ttl \
                     = line.split()
             self.a_records.append(DnsAEntry(
@@ -143,11 +404,12 @@ class PassiveUpdate(object):
                 anonymized = int(anonymized),
                 domain = domain,
                 ip_address = address,
-                ttl = datetime.timedelta(seconds=int(ttl)),
+                ttl = duration(self, int(ttl)),
                 ))
 
+    def _decode_dns_table_cname(self, lines):
         self.cname_records = []
-        for line in sections['dns_table_cname']:
+        for line in lines:
             try:
                 packet_id, address_id, \
                         domain_anonymized, domain, \
@@ -165,46 +427,68 @@ class PassiveUpdate(object):
                 domain = domain,
                 cname_anonymized = int(cname_anonymized),
                 cname = cname,
-                ttl = datetime.timedelta(seconds=int(ttl)),
+                ttl = duration(self, int(ttl)),
                 ))
 
-        address_stats = [ int(w) for w in sections['address_table'][0].split() ]
+    def _decode_address_table(self, lines):
+        address_stats = [ int(w) for w
+                in next_line(lines, 'address_table').split() ]
         self.address_table_first_id = address_stats[0]
         self.address_table_size = address_stats[1]
         self.addresses = []
-        for line in sections['address_table'][1:]:
+        for line in lines:
             mac, ip = line.split()
             self.addresses.append(AddressEntry(
                 mac_address = mac,
                 ip_address = ip,
                 ))
 
-        if 'drop_statistics' in sections:
-            self.dropped_packets = {}
-            for idx, line in enumerate(sections['drop_statistics']):
-                try:
-                    size, count = line.split()
-                except ValueError:
-                    if self.file_format_version <= 3:
-                        sections['http_urls'] = \
-                                sections['drop_statistics'][idx:]
-                        break
-                    else:
-                        raise
-                self.dropped_packets[int(size)] = int(count)
+    def _decode_trailer(self, drop_statistics_lines, next_section):
+        """Decode the drop statistics and HTTP URL sections together, since
+        file formats 3 and earlier store the HTTP URLs at the end of the drop
+        statistics section. next_section returns the lines of the HTTP URLs
+        section, and is only called if the drop statistics didn't contain
+        them."""
+        http_urls_lines = None
+        if drop_statistics_lines is not None:
+            http_urls_lines = self._decode_drop_statistics(
+                    drop_statistics_lines)
+        if http_urls_lines is None:
+            http_urls_lines = next_section()
+        if http_urls_lines is not None:
+            self._decode_http_urls(http_urls_lines)
 
-        if 'http_urls' in sections and sections['http_urls'] != []:
+    def _decode_drop_statistics(self, lines):
+        """Returns the lines of HTTP URLs embedded in the drop statistics of
+        file formats 3 and earlier, or None if there aren't any."""
+        self.dropped_packets = {}
+        for line in lines:
             try:
-                self.dropped_http_urls = int(sections['http_urls'][0])
-                self.http_urls = []
-                for line in sections['http_urls'][1:]:
-                    flow_id, _, hashed_url = line.split()
-                    self.http_urls.append(HttpUrlEntry(
-                        flow_id = int(flow_id),
-                        hashed_url = hashed_url,
-                        ))
-            except:
+                size, count = line.split()
+            except ValueError:
                 if self.file_format_version <= 3:
-                    pass
+                    return chain([line], lines)
                 else:
                     raise
+            self.dropped_packets[int(size)] = int(count)
+        return None
+
+    def _decode_http_urls(self, lines):
+        try:
+            for line in lines:
+                self.dropped_http_urls = int(line)
+                break
+            else:
+                return
+            self.http_urls = []
+            for line in lines:
+                flow_id, _, hashed_url = line.split()
+                self.http_urls.append(HttpUrlEntry(
+                    flow_id = int(flow_id),
+                    hashed_url = hashed_url,
+                    ))
+        except:
+            if self.file_format_version <= 3:
+                pass
+            else:
+                raise
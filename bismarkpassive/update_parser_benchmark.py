@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""
+Measures the throughput of the update parser on synthetic update files.
+
+For every combination of file format version and parser mode, this generates a
+batch of realistic updates and reports parse throughput (MB/s and updates/s),
+peak memory growth while parsing, and the size of each parsed update when
+pickled and when encoded with update_codec (both raw and zlib-compressed, and
+compressed against a preset dictionary trained on the first few updates, which
+is how the updates index stores them), along with how quickly each of those
+representations loads back into a PassiveUpdate.
+Each combination runs in a fresh process so peak memory measurements don't
+interfere with each other. Results are written as one JSON object per line so
+you can compare runs with other tools:
+
+    python -m bismarkpassive.update_parser_benchmark --packets 20000 --output before.json
+
+"""
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import json
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+from random import Random
+import resource
+import sys
+from time import time
+from zlib import compress
+
+from preset_dictionary import Compressor, train_dictionary, TRAINING_SAMPLES
+from update_codec import decode_update, encode_update
+from update_parser import PassiveUpdate
+from updates_index import map_update
+
+# The parser options for each benchmarked mode.
+PARSER_MODES = {
+        'full': {},
+        'onlyheaders': { 'onlyheaders': True },
+        'columnar': { 'columnar': True },
+        'lazy': { 'lazy': True },
+        'raw_timestamps': { 'raw_timestamps': True },
+        'columnar_raw_timestamps': { 'columnar': True, 'raw_timestamps': True },
+        }
+
+# File format versions that exercise each of the parser's layout quirks:
+# formats 0 and 1 have 6-field CNAME lines and end after the address table,
+# formats 2 and 3 store HTTP URLs at the end of the drop statistics section,
+# and format 4 onwards has a separate HTTP URLs section.
+FILE_FORMAT_VERSIONS = [0, 1, 2, 3, 4]
+
+def random_hash(rng, length=16):
+    return '%0*x' % (length, rng.getrandbits(4 * length))
+
+def generate_update(file_format_version=4,
+                    sequence_number=0,
+                    packets=1000,
+                    flows=100,
+                    a_records=20,
+                    cname_records=10,
+                    addresses=10,
+                    http_urls=20,
+                    whitelist=5,
+                    seed=0):
+    """Return the contents of a synthetic update file.
+
+    Anonymized identifiers are drawn from small per-seed pools, so like real
+    updates they repeat within and across updates from the same seed."""
+    rng = Random(seed * 1000003 + sequence_number)
+    pool = Random(seed)
+    local_ips = [random_hash(pool) for _ in range(max(addresses, 1))]
+    remote_ips = [random_hash(pool) for _ in range(max(flows, 1))]
+    macs = [random_hash(pool, 12) for _ in range(max(addresses, 1))]
+    domains = [random_hash(pool) for _ in range(max(a_records, 1))]
+    whitelisted = ['domain%d.com' % i for i in range(whitelist)]
+    creation_time = 1300000000 + seed
+    timestamp = creation_time + 30 * sequence_number
+
+    lines = [str(file_format_version),
+             'BUILDID',
+             'OWBENCHMARK%d %d %d %d' % (seed,
+                                        creation_time,
+                                        sequence_number,
+                                        timestamp)]
+    if file_format_version >= 2:
+        lines.append('%d %d %d' % (packets, 0, 0))
+    lines.append('')
+    lines.extend(whitelisted)
+    lines.append('')
+    lines.append(random_hash(pool, 32))
+    lines.append('')
+
+    lines.append('%d %d' % (timestamp * 1000000, 0))
+    first_flow = 7
+    for _ in range(packets):
+        lines.append('%d %d %d' % (rng.randint(0, 3000),
+                                   rng.choice([40, 52, 576, 1400, 1500]),
+                                   first_flow + rng.randint(0, max(flows, 1) - 1)))
+    lines.append('')
+
+    lines.append('%d %d %d %d' % (first_flow, 65536, 0, 0))
+    for flow_id in range(first_flow, first_flow + flows):
+        lines.append('%d 1 %s 1 %s %d %d %d' % (flow_id,
+                                               rng.choice(local_ips),
+                                               rng.choice(remote_ips),
+                                               rng.choice([6, 17]),
+                                               rng.randint(1024, 65535),
+                                               rng.choice([53, 80, 443])))
+    lines.append('')
+
+    lines.append('0 0')
+    for _ in range(a_records):
+        lines.append('%d %d 1 %s %s %d' % (rng.randint(0, max(packets, 1) - 1),
+                                          rng.randint(0, max(addresses, 1) - 1),
+                                          rng.choice(domains),
+                                          rng.choice(remote_ips),
+                                          rng.randint(30, 86400)))
+    lines.append('')
+
+    for _ in range(cname_records):
+        fields = [str(rng.randint(0, max(packets, 1) - 1)),
+                  str(rng.randint(0, max(addresses, 1) - 1)),
+                  '1',
+                  rng.choice(domains)]
+        if file_format_version >= 2:
+            fields.append('1')
+        fields.extend([rng.choice(domains), str(rng.randint(30, 86400))])
+        lines.append(' '.join(fields))
+    lines.append('')
+
+    lines.append('%d %d' % (0, 256))
+    for index in range(addresses):
+        lines.append('%s %s' % (macs[index], local_ips[index]))
+
+    if file_format_version >= 2:
+        lines.append('')
+        lines.append('%d %d' % (1500, rng.randint(0, 100)))
+        lines.append('%d %d' % (40, rng.randint(0, 100)))
+        if file_format_version >= 4:
+            lines.append('')
+        lines.append('0')
+        for _ in range(http_urls):
+            lines.append('%d 0 %s' % (
+                first_flow + rng.randint(0, max(flows, 1) - 1),
+                random_hash(rng, 40)))
+    return '\n'.join(lines) + '\n'
+
+def small_updates(seeds, sequence_numbers, packets=10, interleave=False):
+    """Return the contents of small synthetic updates from every seed, for
+    tests. Updates are ordered by seed and then by sequence number, or by
+    sequence number and then by seed if interleave is set."""
+    if interleave:
+        pairs = [(seed, sequence_number)
+                 for sequence_number in sequence_numbers
+                 for seed in seeds]
+    else:
+        pairs = [(seed, sequence_number)
+                 for seed in seeds
+                 for sequence_number in sequence_numbers]
+    return [generate_update(sequence_number=sequence_number,
+                            packets=packets,
+                            seed=seed)
+            for seed, sequence_number in pairs]
+
+def encoded_updates(seeds, sequence_numbers, packets=10, interleave=False):
+    """Return small_updates as rows for an updates index."""
+    return [map_update(PassiveUpdate(contents))
+            for contents in small_updates(seeds,
+                                          sequence_numbers,
+                                          packets,
+                                          interleave)]
+
+def peak_memory_kilobytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(file_format_version, mode, update_options, updates, results):
+    contents = [generate_update(file_format_version, sequence_number,
+                                **update_options)
+                for sequence_number in range(updates)]
+    input_bytes = sum(map(len, contents))
+    parser_options = PARSER_MODES[mode]
+    baseline_memory = peak_memory_kilobytes()
+    start = time()
+    parsed = [PassiveUpdate(update, **parser_options) for update in contents]
+    elapsed = time() - start
+    peak_memory = peak_memory_kilobytes()
+    pickles = [pickle.dumps(update, pickle.HIGHEST_PROTOCOL)
+               for update in parsed]
+    start = time()
+    for data in pickles:
+        pickle.loads(data)
+    unpickle_elapsed = time() - start
+    encoded = map(encode_update, parsed)
+    start = time()
+    for data in encoded:
+        decode_update(data)
+    decode_elapsed = time() - start
+    compressor = Compressor(train_dictionary(encoded[:TRAINING_SAMPLES]))
+    results.put({
+        'file_format_version': file_format_version,
+        'mode': mode,
+        'updates': updates,
+        'input_bytes': input_bytes,
+        'seconds': elapsed,
+        'megabytes_per_second': input_bytes / elapsed / 1e6,
+        'updates_per_second': updates / elapsed,
+        'peak_memory_growth_kilobytes': peak_memory - baseline_memory,
+        'pickle_bytes_per_update': sum(map(len, pickles)) / float(updates),
+        'compressed_pickle_bytes_per_update':
+            sum(len(compress(data)) for data in pickles) / float(updates),
+        'unpickle_updates_per_second': updates / unpickle_elapsed,
+        'codec_bytes_per_update': sum(map(len, encoded)) / float(updates),
+        'compressed_codec_bytes_per_update':
+            sum(len(compress(data)) for data in encoded) / float(updates),
+        'dictionary_compressed_codec_bytes_per_update':
+            sum(len(compressor.compress(data)) for data in encoded)
+            / float(updates),
+        'decode_updates_per_second': updates / decode_elapsed,
+        'update_options': update_options,
+        })
+
+def benchmark(versions, modes, update_options, updates):
+    """Run each benchmark in its own process and yield its results."""
+    for version in versions:
+        for mode in modes:
+            results = Queue()
+            process = Process(target=run_benchmark,
+                              args=(version, mode, update_options, updates,
+                                    results))
+            process.start()
+            result = results.get()
+            process.join()
+            yield result
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--a-records', type='int', action='store',
+                      dest='a_records', default=20,
+                      help='DNS A records per update')
+    parser.add_option('--addresses', type='int', action='store',
+                      dest='addresses', default=10,
+                      help='Address table entries per update')
+    parser.add_option('--cname-records', type='int', action='store',
+                      dest='cname_records', default=10,
+                      help='DNS CNAME records per update')
+    parser.add_option('--flows', type='int', action='store',
+                      dest='flows', default=100,
+                      help='Flow table entries per update')
+    parser.add_option('--http-urls', type='int', action='store',
+                      dest='http_urls', default=20,
+                      help='HTTP URLs per update')
+    parser.add_option('--modes', action='store',
+                      dest='modes', default=','.join(sorted(PARSER_MODES)),
+                      help='Comma separated list of parser modes')
+    parser.add_option('--output', action='store', dest='output',
+                      help='Write results to this file instead of stdout')
+    parser.add_option('--packets', type='int', action='store',
+                      dest='packets', default=1000,
+                      help='Packets per update')
+    parser.add_option('--updates', type='int', action='store',
+                      dest='updates', default=100,
+                      help='Number of updates to parse per benchmark')
+    parser.add_option('--versions', action='store',
+                      dest='versions',
+                      default=','.join(map(str, FILE_FORMAT_VERSIONS)),
+                      help='Comma separated list of file format versions')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments')
+    modes = options.modes.split(',')
+    for mode in modes:
+        if mode not in PARSER_MODES:
+            parser.error('Invalid parser mode: %s' % mode)
+    versions = map(int, options.versions.split(','))
+    update_options = { 'packets': options.packets,
+                       'flows': options.flows,
+                       'a_records': options.a_records,
+                       'cname_records': options.cname_records,
+                       'addresses': options.addresses,
+                       'http_urls': options.http_urls,
+                     }
+    if options.output is not None:
+        handle = open(options.output, 'w')
+    else:
+        handle = sys.stdout
+    for result in benchmark(versions, modes, update_options, options.updates):
+        handle.write(json.dumps(result, sort_keys=True) + '\n')
+        handle.flush()
+
+if __name__ == '__main__':
+    main()
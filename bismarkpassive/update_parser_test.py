@@ -1,6 +1,17 @@
 import update_parser
+import update_parser_benchmark
 
+from array import array
 import calendar
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from gzip import GzipFile
 import unittest
 
 def format_source(source):
@@ -113,6 +124,90 @@ class TestParser(unittest.TestCase):
         self.assertTrue(update.packet_series[2].size == 1024)
         self.assertTrue(update.packet_series[2].flow_id == 2)
 
+    def test_packet_series_columnar(self):
+        source = """0
+                    BUILDID
+                    BISMARKID 0 0 0
+
+
+                    UNANONYMIZED
+
+                    100 123
+                    0 15 1
+                    10 40 1
+                    5 1024 2
+
+                    0 0 0 0
+
+                    0 0
+
+
+                    0 0"""
+        update = update_parser.PassiveUpdate(format_source(source),
+                                             columnar=True)
+        self.assertTrue(update.packet_series_dropped == 123)
+        self.assertTrue(len(update.packet_series) == 3)
+        self.assertTrue(list(update.packet_series.timestamps) == [100, 110, 115])
+        self.assertTrue(list(update.packet_series.sizes) == [15, 40, 1024])
+        self.assertTrue(list(update.packet_series.flow_ids) == [1, 1, 2])
+        self.assertTrue(update.packet_series[1].timestamp.microsecond == 110)
+        self.assertTrue(update.packet_series[-1].size == 1024)
+        self.assertTrue(update.packet_series[2].flow_id == 2)
+        self.assertRaises(IndexError, lambda: update.packet_series[3])
+        eager = update_parser.PassiveUpdate(format_source(source))
+        self.assertTrue(list(update.packet_series) == eager.packet_series)
+        restored = pickle.loads(pickle.dumps(update, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(list(restored.packet_series) == eager.packet_series)
+
+    def test_packet_series_timestamp_range(self):
+        # Microseconds in 2200 don't fit in 32 bits.
+        timestamp = 7258118400000001
+        for typecode in [update_parser.TIMESTAMP_TYPECODE, 'd']:
+            series = update_parser.PacketSeries(raw_timestamps=True)
+            series.timestamps = array(typecode)
+            series.append(timestamp, 10, 1)
+            self.assertTrue(series[0].timestamp == timestamp)
+            self.assertTrue(isinstance(series[0].timestamp, (int, long)))
+            self.assertTrue(list(series)[0].timestamp == timestamp)
+            self.assertTrue(isinstance(list(series)[0].timestamp, (int, long)))
+
+    def test_raw_timestamps(self):
+        source = """0
+                    BUILDID
+                    BISMARKID 0 0 98765
+
+
+                    UNANONYMIZED
+
+                    100 123
+                    0 15 1
+                    10 40 1
+
+                    0 0 0 0
+
+                    0 0
+                    1 12 0 foo.com 123cd 2
+
+                    0 45 1 blah.cn 0 blorg.us 93
+
+                    0 0"""
+        for columnar in [False, True]:
+            update = update_parser.PassiveUpdate(format_source(source),
+                                                 columnar=columnar,
+                                                 raw_timestamps=True)
+            self.assertTrue(update.raw_timestamps)
+            self.assertTrue(update.timestamp == 98765000000)
+            self.assertTrue(update.packet_series[0].timestamp == 100)
+            self.assertTrue(update.packet_series[1].timestamp == 110)
+            self.assertTrue(
+                    [p.timestamp for p in update.packet_series] == [100, 110])
+            self.assertTrue(update.a_records[0].ttl == 2000000)
+            self.assertTrue(update.cname_records[0].ttl == 93000000)
+            self.assertTrue(update_parser.duration(update, 30) == 30000000)
+        update = update_parser.PassiveUpdate(format_source(source))
+        self.assertFalse(update.raw_timestamps)
+        self.assertTrue(update.a_records[0].ttl.seconds == 2)
+
     def test_flow_table(self):
         source = """0
                     BUILDID
@@ -278,5 +373,202 @@ class TestParser(unittest.TestCase):
         self.assertTrue(update.dropped_packets[12] == 53)
         self.assertTrue(update.dropped_packets[1500] == 34)
 
+    def test_lazy_decoding(self):
+        source = """9
+                    BUILDID
+                    BISMARKID 0 0 0
+
+
+                    UNANONYMIZED
+
+                    100 123
+                    0 15 1
+
+                    100 500 12 34
+                    29 0 987 0 456 23 45 56
+
+                    5 6
+                    9 12 0 foo.com 123cd 2
+
+
+                    1 2
+                    ABCDEF 1234ab
+
+                    12 53
+
+                    3
+                    29 0 abcdef"""
+        eager = update_parser.PassiveUpdate(format_source(source))
+        update = update_parser.PassiveUpdate(format_source(source), lazy=True)
+        self.assertFalse('flow_table' in update.__dict__)
+        self.assertTrue(update.flow_table == eager.flow_table)
+        self.assertTrue('flow_table_size' in update.__dict__)
+        self.assertFalse('packet_series' in update.__dict__)
+        update = pickle.loads(pickle.dumps(update, pickle.HIGHEST_PROTOCOL))
+        self.assertFalse('packet_series' in update.__dict__)
+        self.assertTrue(update.packet_series == eager.packet_series)
+        self.assertTrue(update.dropped_a_records == 5)
+        self.assertTrue(update.a_records == eager.a_records)
+        self.assertTrue(update.cname_records == [])
+        self.assertTrue(update.addresses == eager.addresses)
+        self.assertTrue(update.dropped_packets == {12: 53})
+        self.assertTrue(update.dropped_http_urls == 3)
+        self.assertTrue(update.http_urls == eager.http_urls)
+        self.assertFalse(hasattr(update, 'nonexistent_attribute'))
+
+    def test_lazy_headers_only(self):
+        source = """0
+                    BUILDID
+                    BISMARKID 0 0 0
+
+
+                    UNANONYMIZED
+
+                    0 0
+
+                    0 0 0 0
+
+                    0 0
+
+
+                    0 0"""
+        update = update_parser.PassiveUpdate(format_source(source),
+                                             onlyheaders=True,
+                                             lazy=True)
+        self.assertFalse(hasattr(update, 'packet_series'))
+        self.assertFalse(hasattr(update, 'http_urls'))
+
+    def test_lazy_missing_section(self):
+        source = """9
+                    BUILDID
+                    BISMARKID 0 0 0
+
+
+                    UNANONYMIZED
+
+                    100 123
+                    0 15 1
+
+                    100 500 12 34"""
+        for lazy in [False, True]:
+            self.assertRaises(ValueError,
+                              update_parser.PassiveUpdate,
+                              format_source(source),
+                              lazy=lazy)
+
+    def test_cname_without_cname_anonymized(self):
+        source = """0
+                    BUILDID
+                    BISMARKID 0 0 0
+
+
+                    UNANONYMIZED
+
+                    0 0
+
+                    0 0 0 0
+
+                    0 0
+
+                    7 45 1 blah.cn blorg.us 93
+
+                    0 0"""
+        update = update_parser.PassiveUpdate(format_source(source))
+        self.assertTrue(len(update.cname_records) == 1)
+        self.assertTrue(update.cname_records[0].domain_anonymized == 1)
+        self.assertTrue(update.cname_records[0].cname_anonymized == 1)
+        self.assertTrue(update.cname_records[0].cname == 'blorg.us')
+        self.assertTrue(update.cname_records[0].ttl.seconds == 93)
+
+    def test_http_urls_in_drop_statistics(self):
+        source = """3
+                    BUILDID
+                    BISMARKID 0 0 0
+
+
+                    UNANONYMIZED
+
+                    0 0
+
+                    0 0 0 0
+
+                    0 0
+
+
+                    0 0
+
+                    12 53
+                    2
+                    29 0 abcdef
+                    30 0 fedcba"""
+        for lazy in [False, True]:
+            update = update_parser.PassiveUpdate(format_source(source),
+                                                 lazy=lazy)
+            self.assertTrue(update.dropped_packets == {12: 53})
+            self.assertTrue(update.dropped_http_urls == 2)
+            self.assertTrue(len(update.http_urls) == 2)
+            self.assertTrue(update.http_urls[0].flow_id == 29)
+            self.assertTrue(update.http_urls[1].hashed_url == 'fedcba')
+
+    def test_parse_from_stream(self):
+        source = """4
+                    BUILDID
+                    BISMARKID 1234567890 12 98765
+
+                    foo.com
+
+                    KEY
+
+                    100 123
+                    0 15 1
+                    10 40 1
+
+                    100 500 12 34
+                    29 0 987 0 456 23 45 56
+
+                    0 0
+                    9 12 0 foo.com 123cd 2
+
+
+                    1 2
+                    ABCDEF 1234ab
+
+                    12 53
+
+                    1
+                    29 0 abcdef
+                    """
+        compressed = StringIO()
+        handle = GzipFile(fileobj=compressed, mode='w')
+        handle.write(format_source(source))
+        handle.close()
+        compressed.seek(0)
+        update = update_parser.PassiveUpdate(GzipFile(fileobj=compressed))
+        expected = update_parser.PassiveUpdate(format_source(source))
+        self.assertTrue(update.__dict__ == expected.__dict__)
+        self.assertTrue(update.whitelist == ['foo.com'])
+        self.assertTrue(update.anonymization_signature == 'KEY')
+        self.assertTrue(len(update.packet_series) == 2)
+        self.assertTrue(update.http_urls[0].hashed_url == 'abcdef')
+
+    def test_synthetic_updates(self):
+        for version in update_parser_benchmark.FILE_FORMAT_VERSIONS:
+            contents = update_parser_benchmark.generate_update(
+                    version, sequence_number=3, packets=50, flows=5,
+                    a_records=4, cname_records=3, addresses=2, http_urls=6)
+            update = update_parser.PassiveUpdate(contents)
+            self.assertTrue(update.file_format_version == version)
+            self.assertTrue(update.sequence_number == 3)
+            self.assertTrue(len(update.packet_series) == 50)
+            self.assertTrue(len(update.flow_table) == 5)
+            self.assertTrue(len(update.a_records) == 4)
+            self.assertTrue(len(update.cname_records) == 3)
+            self.assertTrue(len(update.addresses) == 2)
+            if version >= 2:
+                self.assertTrue(len(update.dropped_packets) == 2)
+                self.assertTrue(len(update.http_urls) == 6)
+            else:
+                self.assertFalse(hasattr(update, 'http_urls'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -48,12 +48,23 @@ class UpdateStatisticsSessionProcessor(PersistentSessionProcessor):
                 iter(persistent_context.update_statistics))
 
 class DataAvailabilityProcessor(PersistentSessionProcessor):
+
+    """Computes the intervals each node was uploading data, joining sessions
+    less than OUTAGE_TIMEOUT apart. The global context keeps the interval of
+    every session until complete_global_context joins them, so sessions can
+    be combined and retracted in any order."""
+
+    mergeable = True
+    retractable = True
+
     def initialize_context(self, context):
         context.availability_lower_bound = None
         context.availability_upper_bound = None
 
     def process_update_persistent(self, context, update):
-        if update.sequence_number == 0:
+        # Time windows can start partway through a session, so the session's
+        # first update might not have sequence number 0.
+        if context.availability_lower_bound is None:
             try:
                 context.availability_lower_bound = update.packet_series[0].timestamp
             except IndexError:
@@ -61,16 +72,42 @@ class DataAvailabilityProcessor(PersistentSessionProcessor):
         context.availability_upper_bound = update.timestamp
 
     def initialize_global_context(self, global_context):
+        global_context.session_availability = defaultdict(list)
         global_context.availability_intervals = defaultdict(list)
 
     def merge_contexts_persistent(self, context, global_context):
-        new_lower, new_upper = (context.availability_lower_bound,
-                                context.availability_upper_bound)
-        if new_lower is None and new_upper is None:
+        if context.availability_lower_bound is None \
+                and context.availability_upper_bound is None:
             return
+        global_context.session_availability[context.node_id].append(
+                (context.availability_lower_bound,
+                 context.availability_upper_bound))
+
+    def combine_global_contexts(self, global_context, partial_global_context):
+        for node_id, intervals \
+                in partial_global_context.session_availability.items():
+            global_context.session_availability[node_id].extend(intervals)
+
+    def retract_global_context(self, global_context, partial_global_context):
+        for node_id, intervals \
+                in partial_global_context.session_availability.items():
+            for interval in intervals:
+                global_context.session_availability[node_id].remove(interval)
+            if not global_context.session_availability[node_id]:
+                del global_context.session_availability[node_id]
+
+    def complete_global_context(self, global_context):
+        global_context.availability_intervals = defaultdict(list)
+        for node_id, intervals in global_context.session_availability.items():
+            for lower, upper in sorted(intervals):
+                self.merge_interval(global_context, node_id, lower, upper)
+
+    def merge_interval(self, global_context, node_id, new_lower, new_upper):
+        """Add an interval to a node's availability, joining it with the
+        intervals less than OUTAGE_TIMEOUT away."""
         obsolete_indices = []
         for idx, (lower, upper) in \
-                enumerate(global_context.availability_intervals[context.node_id]):
+                enumerate(global_context.availability_intervals[node_id]):
             if new_upper <= lower - OUTAGE_TIMEOUT:
                 continue
             if new_lower >= upper + OUTAGE_TIMEOUT:
@@ -79,6 +116,6 @@ class DataAvailabilityProcessor(PersistentSessionProcessor):
             new_upper = max(new_upper, upper)
             obsolete_indices.append(idx)
         for index in sorted(obsolete_indices, reverse=True):
-            del global_context.availability_intervals[context.node_id][index]
-        global_context.availability_intervals[context.node_id].append(
+            del global_context.availability_intervals[node_id][index]
+        global_context.availability_intervals[node_id].append(
                 (new_lower, new_upper))
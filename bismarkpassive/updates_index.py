@@ -1,3 +1,8 @@
+from calendar import timegm
+
+from update_codec import decode_update, encode_update
+from update_parser import MICROSECONDS_PER_SECOND
+
 def UpdatesIndexer(backend, database, **options):
     if backend == 'sqlite':
         import updates_index_sqlite
@@ -5,6 +10,9 @@ def UpdatesIndexer(backend, database, **options):
     elif backend == 'postgres':
         import updates_index_postgres
         return updates_index_postgres.UpdatesIndexer(database, **options)
+    elif backend == 'sqlite-sharded':
+        import updates_index_sharded
+        return updates_index_sharded.UpdatesIndexer(database, **options)
     else:
         raise ValueError('Invalid database backend')
 
@@ -15,5 +23,46 @@ def UpdatesReader(backend, database, **options):
     elif backend == 'postgres':
         import updates_index_postgres
         return updates_index_postgres.UpdatesReader(database, **options)
+    elif backend == 'sqlite-sharded':
+        import updates_index_sharded
+        return updates_index_sharded.UpdatesReader(database, **options)
     else:
         raise ValueError('Invalid database backend')
+
+def map_update(update):
+    """Encode an update for UpdatesIndexer.index as a (node_id, row, data)
+    tuple. This doesn't need a connection to the index, so indexing can run
+    it in worker processes."""
+    return (update.bismark_id,
+            (update.bismark_id,
+             update.anonymization_signature,
+             update.creation_time,
+             update.sequence_number,
+             update_timestamp(update)),
+            encode_update(update))
+
+def update_timestamp(update):
+    """Return the time an update was written as a Unix timestamp."""
+    if update.raw_timestamps:
+        return update.timestamp // MICROSECONDS_PER_SECOND
+    return timegm(update.timestamp.utctimetuple())
+
+def in_window(update, start_time=None, end_time=None):
+    """Return whether an update was written between start_time (inclusive)
+    and end_time (exclusive). Either bound may be None."""
+    timestamp = update_timestamp(update)
+    if start_time is not None and timestamp < start_time:
+        return False
+    if end_time is not None and timestamp >= end_time:
+        return False
+    return True
+
+def decode_payloads(payloads, start_time=None, end_time=None):
+    """Decode the (sequence_number, timestamp, data) tuples yielded by
+    session_payloads into (sequence_number, update) tuples. Updates indexed
+    without a timestamp are checked against the time window here."""
+    for sequence_number, timestamp, data in payloads:
+        update = decode_update(data)
+        if timestamp is None and not in_window(update, start_time, end_time):
+            continue
+        yield sequence_number, update
@@ -1,22 +1,270 @@
-from collections import namedtuple
-from itertools import imap
+from collections import deque, namedtuple
+from itertools import imap, islice
 from os.path import basename
-try:
-    from cPickle import dumps, loads, HIGHEST_PROTOCOL
-except ImportError:
-    from pickle import dumps, loads, HIGHEST_PROTOCOL
-import psycopg2
-from zlib import compress, decompress
+from os import getpid
+from psycopg2.pool import SimpleConnectionPool
+from time import time
+from zlib import decompress
+
+from preset_dictionary import Decompressor, DictionaryCompressor
+from update_codec import decode_update
+from prefetch import read_ahead
+from updates_index import decode_payloads, update_timestamp
 
 Session = namedtuple('Session', ['node_id', 'anonymization_context', 'id'])
 
+# Catalog entry for a session. Timestamps are Unix timestamps of the first and
+# last updates, and last_indexer_run is the id of the indexer run that last
+# added updates to the session.
+SessionMetadata = namedtuple('SessionMetadata',
+                             ['node_id',
+                              'anonymization_context',
+                              'id',
+                              'pickle_size',
+                              'min_sequence_number',
+                              'max_sequence_number',
+                              'update_count',
+                              'first_timestamp',
+                              'last_timestamp',
+                              'last_indexer_run'])
+
+# Must match the definition in scripts/updates_index.sql.
+UPDATES_TIMESTAMP_INDEX = '''CREATE INDEX
+                             updates_timestamp_index ON updates
+                             (node_id,
+                              anonymization_context,
+                              session_id,
+                              timestamp)'''
+
+# Each process keeps its own pool of connections to each database, so indexes
+# opened one after another in the same process reuse connections instead of
+# paying for a new connection each time.
+MAX_CONNECTIONS_PER_PROCESS = 4
+_connection_pools = {}
+
+def connection_pool(database, postgres_host=None, postgres_user=None):
+    # Connections can't be shared with forked children, so key pools on the
+    # process id too.
+    key = (getpid(), database, postgres_host, postgres_user)
+    try:
+        return _connection_pools[key]
+    except KeyError:
+        pool = SimpleConnectionPool(1,
+                                    MAX_CONNECTIONS_PER_PROCESS,
+                                    database=database,
+                                    host=postgres_host,
+                                    user=postgres_user)
+        _connection_pools[key] = pool
+        return pool
+
+# Columns of the rows UpdatesIndexer.index gets from its DictionaryCompressor.
+UPDATE_COLUMNS = '''node_id,
+                    anonymization_context,
+                    session_id,
+                    sequence_number,
+                    timestamp,
+                    pickle,
+                    size,
+                    dictionary_id'''
+
+# Number of rows server-side cursors fetch at a time. Each update row holds a
+# compressed update, so this bounds the memory session_data uses.
+DEFAULT_FETCH_SIZE = 100
+
+# Number of updates to load with each COPY before merging them into the
+# updates and sessions tables.
+COPY_BATCH_SIZE = 10000
+
+def copy_field(value):
+    """Format a value as a field of COPY's text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, buffer):
+        # bytea's hex format. The backslash itself needs escaping in COPY.
+        return '\\\\x' + str(value).encode('hex')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\') \
+                     .replace('\t', '\\t') \
+                     .replace('\n', '\\n') \
+                     .replace('\r', '\\r')
+
+class CopyStream(object):
+
+    """A file-like object that formats rows for COPY ... FROM STDIN as
+    psycopg2 reads them, so rows never have to be in memory all at once.
+    Formatted rows are kept as separate lines until they're read, so every
+    byte is only copied once however psycopg2 sizes its reads."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._lines = deque()
+        # How far into the first line reads have got, and how many bytes are
+        # left to read from all the lines.
+        self._offset = 0
+        self._buffered = 0
+        self.rows = 0
+
+    def read(self, size=-1):
+        while size < 0 or self._buffered < size:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                break
+            line = '\t'.join(map(copy_field, row)) + '\n'
+            self._lines.append(line)
+            self._buffered += len(line)
+            self.rows += 1
+        if size < 0 or size > self._buffered:
+            size = self._buffered
+        chunks = []
+        needed = size
+        while needed > 0:
+            line = self._lines[0]
+            end = self._offset + needed
+            if end < len(line):
+                chunks.append(line[self._offset:end])
+                self._offset = end
+                break
+            chunks.append(line[self._offset:])
+            needed -= len(line) - self._offset
+            self._lines.popleft()
+            self._offset = 0
+        self._buffered -= size
+        return ''.join(chunks)
+
 class UpdatesIndex(object):
-    def __init__(self, database, postgres_host=None, postgres_user=None):
-        self._conn = psycopg2.connect(database=database)
+    def __init__(self,
+                 database,
+                 postgres_host=None,
+                 postgres_user=None,
+                 postgres_fetch_size=DEFAULT_FETCH_SIZE):
+        self._pool = connection_pool(database, postgres_host, postgres_user)
+        self._conn = self._pool.getconn()
+        self._decompressors = {}
+        self._fetch_size = postgres_fetch_size
+        self._cursors_created = 0
+        self._cursors_open = 0
+
+    def _stream(self, query, arguments=()):
+        """Yield the rows of a query from a server-side cursor, which holds
+        at most fetch_size rows in memory at a time."""
+        self._cursors_created += 1
+        cur = self._conn.cursor('stream_%d' % self._cursors_created)
+        cur.itersize = self._fetch_size
+        self._cursors_open += 1
+        try:
+            cur.execute(query, arguments)
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+            self._cursors_open -= 1
+            # Server-side cursors only live as long as their transaction, so
+            # end it once no cursors are using it. This also stops reused
+            # connections from sitting idle in a transaction.
+            if self._cursors_open == 0:
+                self._conn.rollback()
+
+    def close(self):
+        """Return this index's connection to the connection pool."""
+        self._pool.putconn(self._conn)
+        self._conn = None
+
+    def _decompress(self, dictionary_id, blob):
+        if dictionary_id is None:
+            return decompress(blob)
+        try:
+            decompressor = self._decompressors[dictionary_id]
+        except KeyError:
+            cur = self._conn.cursor()
+            cur.execute('''SELECT dictionary FROM dictionaries
+                           WHERE dictionary_id = %s''',
+                        (dictionary_id,))
+            decompressor = Decompressor(str(cur.fetchone()[0]))
+            self._decompressors[dictionary_id] = decompressor
+        return decompressor.decompress(blob)
 
 class UpdatesIndexer(UpdatesIndex):
     def __init__(self, database, **options):
         super(UpdatesIndexer, self).__init__(database, **options)
+        cur = self._conn.cursor()
+        cur.execute('''SELECT table_name, column_name
+                       FROM information_schema.columns
+                       WHERE table_name IN ('updates', 'sessions')''')
+        columns = set(cur.fetchall())
+        # Bring indexes created with an older scripts/updates_index.sql up to
+        # date.
+        migrated = False
+        if ('updates', 'dictionary_id') not in columns:
+            cur.execute('ALTER TABLE updates ADD COLUMN dictionary_id integer')
+            cur.execute('''CREATE TABLE dictionaries
+                           (dictionary_id integer PRIMARY KEY,
+                            node_id text UNIQUE,
+                            dictionary bytea)''')
+            migrated = True
+        if ('sessions', 'update_count') not in columns:
+            self._migrate_catalog()
+            migrated = True
+        cur.execute('''SELECT 1 FROM pg_indexes
+                       WHERE indexname = 'updates_timestamp_index' ''')
+        if cur.fetchone() is None:
+            cur.execute(UPDATES_TIMESTAMP_INDEX)
+            self._conn.commit()
+        if migrated:
+            # Older schemas inserted updates through this function, which
+            # doesn't fill in the new columns. The indexer uses COPY instead.
+            cur.execute('''DROP FUNCTION IF EXISTS insert_new_update
+                           (text, text, bigint, integer, bytea, integer)''')
+            self._conn.commit()
+
+    def _migrate_catalog(self):
+        """Add the session catalog to an index created before it existed.
+        Updates from then don't have timestamps in the index, so this decodes
+        the first and last update of each session to find them."""
+        print 'Building session catalog'
+        cur = self._conn.cursor()
+        cur.execute('ALTER TABLE updates ADD COLUMN timestamp bigint')
+        cur.execute('''ALTER TABLE sessions
+                       ADD COLUMN min_sequence_number integer,
+                       ADD COLUMN max_sequence_number integer,
+                       ADD COLUMN update_count integer,
+                       ADD COLUMN first_timestamp bigint,
+                       ADD COLUMN last_timestamp bigint,
+                       ADD COLUMN last_indexer_run integer''')
+        cur.execute('''CREATE TABLE indexer_runs
+                       (run_id serial PRIMARY KEY, timestamp bigint)''')
+        cur.execute('''SELECT node_id,
+                              anonymization_context,
+                              session_id,
+                              min(sequence_number),
+                              max(sequence_number),
+                              count(*)
+                       FROM updates
+                       GROUP BY node_id, anonymization_context, session_id''')
+        for row in cur.fetchall():
+            key = row[:3]
+            timestamps = []
+            for sequence_number in row[3:5]:
+                cur.execute('''SELECT pickle, dictionary_id FROM updates
+                               WHERE node_id = %s
+                               AND anonymization_context = %s
+                               AND session_id = %s
+                               AND sequence_number = %s''',
+                            key + (sequence_number,))
+                pickle, dictionary_id = cur.fetchone()
+                timestamps.append(update_timestamp(decode_update(
+                    self._decompress(dictionary_id, pickle))))
+            cur.execute('''UPDATE sessions
+                           SET min_sequence_number = %s,
+                               max_sequence_number = %s,
+                               update_count = %s,
+                               first_timestamp = %s,
+                               last_timestamp = %s
+                           WHERE node_id = %s
+                           AND anonymization_context = %s
+                           AND session_id = %s''',
+                        row[3:] + tuple(timestamps) + key)
 
     @property
     def tarnames(self):
@@ -24,15 +272,15 @@ class UpdatesIndexer(UpdatesIndex):
         cur.execute('SELECT tarname FROM tarnames')
         return map(lambda row: row[0], cur)
 
-    @staticmethod
-    def map_update(update):
-        data = buffer(compress(dumps(update, HIGHEST_PROTOCOL)))
-        return (update.bismark_id,
-                update.anonymization_signature,
-                update.creation_time,
-                update.sequence_number,
-                data,
-                len(data))
+    def dictionary_compressor(self):
+        cur = self._conn.cursor()
+        cur.execute('SELECT dictionary_id, node_id, dictionary FROM dictionaries')
+        dictionaries = {}
+        next_dictionary_id = 0
+        for dictionary_id, node_id, dictionary in cur:
+            dictionaries[node_id] = (dictionary_id, str(dictionary))
+            next_dictionary_id = max(next_dictionary_id, dictionary_id + 1)
+        return DictionaryCompressor(dictionaries, next_dictionary_id)
 
     @staticmethod
     def map_session(update):
@@ -40,23 +288,83 @@ class UpdatesIndexer(UpdatesIndex):
                 update.anonymization_signature,
                 update.creation_time)
 
-    def index(self, tarnames, updates, reindex=False):
+    def _merge_staged_updates(self, cur, run_id):
+        cur.execute('INSERT INTO updates (%s) SELECT %s FROM staged_updates'
+                    % (UPDATE_COLUMNS, UPDATE_COLUMNS))
+        staged_sessions = '''(SELECT node_id,
+                                     anonymization_context,
+                                     session_id,
+                                     sum(size) AS pickle_size,
+                                     min(sequence_number) AS min_sequence_number,
+                                     max(sequence_number) AS max_sequence_number,
+                                     count(*) AS update_count,
+                                     min(timestamp) AS first_timestamp,
+                                     max(timestamp) AS last_timestamp
+                              FROM staged_updates
+                              GROUP BY node_id,
+                                       anonymization_context,
+                                       session_id) AS staged'''
+        cur.execute('''UPDATE sessions
+                       SET pickle_size
+                               = sessions.pickle_size + staged.pickle_size,
+                           min_sequence_number
+                               = least(sessions.min_sequence_number,
+                                       staged.min_sequence_number),
+                           max_sequence_number
+                               = greatest(sessions.max_sequence_number,
+                                          staged.max_sequence_number),
+                           update_count = coalesce(sessions.update_count, 0)
+                                          + staged.update_count,
+                           first_timestamp
+                               = least(sessions.first_timestamp,
+                                       staged.first_timestamp),
+                           last_timestamp
+                               = greatest(sessions.last_timestamp,
+                                          staged.last_timestamp),
+                           last_indexer_run = %%s
+                       FROM %s
+                       WHERE sessions.node_id = staged.node_id
+                       AND sessions.anonymization_context
+                           = staged.anonymization_context
+                       AND sessions.session_id = staged.session_id'''
+                    % staged_sessions,
+                    (run_id,))
+        cur.execute('''INSERT INTO sessions
+                       (node_id,
+                        anonymization_context,
+                        session_id,
+                        pickle_size,
+                        min_sequence_number,
+                        max_sequence_number,
+                        update_count,
+                        first_timestamp,
+                        last_timestamp,
+                        last_indexer_run)
+                       SELECT staged.*, %%s
+                       FROM %s
+                       WHERE NOT EXISTS
+                       (SELECT 1 FROM sessions
+                        WHERE sessions.node_id = staged.node_id
+                        AND sessions.anonymization_context
+                            = staged.anonymization_context
+                        AND sessions.session_id = staged.session_id)'''
+                    % staged_sessions,
+                    (run_id,))
+
+    def index(self, tarnames, encoded_updates, reindex=False):
         cur = self._conn.cursor()
-        cur.executemany('INSERT INTO tarnames (tarname) VALUES (%s)',
-                        imap(lambda n: (basename(n),), tarnames))
+        cur.execute('''INSERT INTO indexer_runs (timestamp) VALUES (%s)
+                       RETURNING run_id''',
+                    (int(time()),))
+        run_id = cur.fetchone()[0]
         print 'Inserting new updates'
+        compressor = self.dictionary_compressor()
+        rows = compressor.compress(encoded_updates)
         if reindex:
             cur.execute('DROP INDEX IF EXISTS updates_index')
-            cur.executemany(
-                    '''INSERT INTO updates
-                       (node_id,
-                        anonymization_context,
-                        session_id,
-                        sequence_number,
-                        pickle,
-                        size)
-                       VALUES (%s, %s, %s, %s, %s, %s)''',
-                    imap(UpdatesIndexer.map_update, updates))
+            cur.execute('DROP INDEX IF EXISTS updates_timestamp_index')
+            cur.copy_expert('COPY updates (%s) FROM STDIN' % UPDATE_COLUMNS,
+                            CopyStream(rows))
             print 'Building index'
             cur.execute('''CREATE INDEX
                            updates_index ON updates
@@ -64,20 +372,62 @@ class UpdatesIndexer(UpdatesIndex):
                             anonymization_context,
                             session_id,
                             sequence_number)''')
+            cur.execute(UPDATES_TIMESTAMP_INDEX)
             print 'Computing sessions'
+            # Keep the catalog entries of sessions that didn't change and the
+            # timestamps of updates indexed before they were recorded.
+            cur.execute('CREATE TEMPORARY TABLE old_sessions AS '
+                        'SELECT * FROM sessions')
             cur.execute('DELETE FROM sessions')
             cur.execute(
                     '''INSERT INTO sessions
-                       (node_id, anonymization_context, session_id, pickle_size)
+                       (node_id,
+                        anonymization_context,
+                        session_id,
+                        pickle_size,
+                        min_sequence_number,
+                        max_sequence_number,
+                        update_count,
+                        first_timestamp,
+                        last_timestamp,
+                        last_indexer_run)
                        SELECT node_id,
                               anonymization_context,
                               session_id,
-                              sum(size)
+                              sum(size),
+                              min(sequence_number),
+                              max(sequence_number),
+                              count(*),
+                              least(min(timestamp), min(old.first_timestamp)),
+                              greatest(max(timestamp), max(old.last_timestamp)),
+                              CASE WHEN count(*) = max(old.update_count)
+                                   THEN max(old.last_indexer_run)
+                                   ELSE %s END
                        FROM updates
-                       GROUP BY node_id, anonymization_context, session_id''')
+                       LEFT JOIN old_sessions AS old
+                       USING (node_id, anonymization_context, session_id)
+                       GROUP BY node_id, anonymization_context, session_id''',
+                    (run_id,))
+            cur.execute('DROP TABLE old_sessions')
         else:
-            cur.executemany('SELECT insert_new_update(%s, %s, %s, %s, %s, %s)',
-                            imap(UpdatesIndexer.map_update, updates))
+            cur.execute('''CREATE TEMPORARY TABLE staged_updates
+                           (LIKE updates)''')
+            while True:
+                batch = CopyStream(islice(rows, COPY_BATCH_SIZE))
+                cur.copy_expert(
+                        'COPY staged_updates (%s) FROM STDIN' % UPDATE_COLUMNS,
+                        batch)
+                if batch.rows == 0:
+                    break
+                self._merge_staged_updates(cur, run_id)
+                cur.execute('TRUNCATE staged_updates')
+            cur.execute('DROP TABLE staged_updates')
+        cur.executemany('''INSERT INTO dictionaries
+                           (dictionary_id, node_id, dictionary)
+                           VALUES (%s, %s, %s)''',
+                        compressor.new_dictionaries)
+        cur.executemany('INSERT INTO tarnames (tarname) VALUES (%s)',
+                        imap(lambda n: (basename(n),), tarnames))
         self._conn.commit()
 
 class UpdatesReader(UpdatesIndex):
@@ -86,23 +436,108 @@ class UpdatesReader(UpdatesIndex):
 
     @property
     def sessions(self):
-        cur = self._conn.cursor()
-        cur.execute('''SELECT node_id, anonymization_context, session_id
-                       FROM sessions ORDER BY pickle_size DESC''')
-        for row in cur:
+        for row in self._stream(
+                '''SELECT node_id, anonymization_context, session_id
+                   FROM sessions ORDER BY pickle_size DESC'''):
             yield Session(row[0], row[1], row[2])
 
-    def session_data(self, session, first_sequence_number=0):
-        cur = self._conn.cursor()
-        cur.execute('''SELECT sequence_number, pickle FROM updates
-                       WHERE node_id = %s
-                       AND anonymization_context = %s
-                       AND session_id = %s
-                       AND sequence_number >= %s
-                       ORDER BY sequence_number''',
-                    (session.node_id,
+    @property
+    def session_catalog(self):
+        """Yield a SessionMetadata for every session, largest first. This only
+        reads the sessions table."""
+        for row in self._stream(
+                '''SELECT node_id,
+                          anonymization_context,
+                          session_id,
+                          pickle_size,
+                          min_sequence_number,
+                          max_sequence_number,
+                          update_count,
+                          first_timestamp,
+                          last_timestamp,
+                          last_indexer_run
+                   FROM sessions ORDER BY pickle_size DESC'''):
+            yield SessionMetadata(*row)
+
+    def window_catalog(self, start_time=None, end_time=None):
+        """Yield a SessionMetadata for every session with updates between
+        start_time (inclusive) and end_time (exclusive), largest first.
+        Sessions without catalog timestamps are always included."""
+        for row in self._stream(
+                '''SELECT node_id,
+                          anonymization_context,
+                          session_id,
+                          pickle_size,
+                          min_sequence_number,
+                          max_sequence_number,
+                          update_count,
+                          first_timestamp,
+                          last_timestamp,
+                          last_indexer_run
+                   FROM sessions
+                   WHERE (%(start_time)s IS NULL
+                          OR last_timestamp IS NULL
+                          OR last_timestamp >= %(start_time)s)
+                   AND (%(end_time)s IS NULL
+                        OR first_timestamp IS NULL
+                        OR first_timestamp < %(end_time)s)
+                   ORDER BY pickle_size DESC''',
+                { 'start_time': start_time, 'end_time': end_time }):
+            yield SessionMetadata(*row)
+
+    def session_data(self,
+                     session,
+                     first_sequence_number=0,
+                     start_time=None,
+                     end_time=None,
+                     prefetch=False):
+        """Yield (sequence_number, update) for the updates of a session from
+        first_sequence_number on. If start_time or end_time is given, only
+        yield updates between start_time (inclusive) and end_time
+        (exclusive). If prefetch is true, a background thread reads and
+        decompresses updates ahead of the caller."""
+        payloads = self.session_payloads(
+                session, first_sequence_number, start_time, end_time)
+        if prefetch:
+            payloads = read_ahead(payloads)
+        return decode_payloads(payloads, start_time, end_time)
+
+    def session_payloads(self,
+                         session,
+                         first_sequence_number=0,
+                         start_time=None,
+                         end_time=None):
+        """Yield (sequence_number, timestamp, data) for the updates that
+        session_data would return, where data is the decompressed encoding of
+        the update. timestamp is None for updates indexed without one, which
+        might lie outside the time window."""
+        query = '''SELECT sequence_number, timestamp, pickle, dictionary_id
+                   FROM updates
+                   WHERE node_id = %s
+                   AND anonymization_context = %s
+                   AND session_id = %s
+                   AND sequence_number >= %s'''
+        arguments = [session.node_id,
                      session.anonymization_context,
                      session.id,
-                     first_sequence_number))
-        for row in cur:
-            yield (row[0], loads(decompress(row[1])))
+                     first_sequence_number]
+        if start_time is not None or end_time is not None:
+            # Updates indexed before the timestamp column existed don't have
+            # one, so select them separately and check their timestamps after
+            # decoding them. Both halves can use updates_timestamp_index.
+            window_query = query
+            window_arguments = list(arguments)
+            if start_time is not None:
+                window_query += ' AND timestamp >= %s'
+                window_arguments.append(start_time)
+            if end_time is not None:
+                window_query += ' AND timestamp < %s'
+                window_arguments.append(end_time)
+            query = '%s UNION ALL %s AND timestamp IS NULL' \
+                    % (window_query, query)
+            arguments = window_arguments + arguments
+        query += ' ORDER BY sequence_number'
+        for row in self._stream(query, arguments):
+            yield (row[0],
+                   row[1],
+                   self._decompress(row[3], row[2]))
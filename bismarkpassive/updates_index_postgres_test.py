@@ -0,0 +1,55 @@
+try:
+    import updates_index_postgres
+except ImportError:
+    updates_index_postgres = None
+
+import unittest
+
+# Rows of (text, integer, NULL, bytea) fields and how COPY's text format
+# should write them.
+ROWS = [(('plain', 12, None, buffer('\x00\xff\\')),
+         'plain\t12\t\\N\t\\\\x00ff5c\n'),
+        (('tab\tnewline\nreturn\r', -3, 'back\\slash', buffer('')),
+         'tab\\tnewline\\nreturn\\r\t-3\tback\\\\slash\t\\\\x\n'),
+        ((u'caf\xe9', 2 ** 40, '\\N', buffer('\t\n')),
+         'caf\xc3\xa9\t1099511627776\t\\\\N\t\\\\x090a\n')]
+
+@unittest.skipIf(updates_index_postgres is None, 'psycopg2 is not installed')
+class TestCopyFormat(unittest.TestCase):
+    def test_copy_field(self):
+        for row, line in ROWS:
+            self.assertEqual(
+                    '\t'.join(map(updates_index_postgres.copy_field, row))
+                    + '\n',
+                    line)
+
+    def test_read_everything(self):
+        stream = updates_index_postgres.CopyStream(row for row, _ in ROWS)
+        self.assertEqual(stream.read(), ''.join(line for _, line in ROWS))
+        self.assertEqual(stream.rows, len(ROWS))
+        self.assertEqual(stream.read(), '')
+        self.assertEqual(stream.read(10), '')
+
+    def test_read_chunks(self):
+        rows = [(index, 'x' * (index * 37 % 1000), buffer('y' * index))
+                for index in range(200)]
+        expected = ''.join('\t'.join(map(updates_index_postgres.copy_field,
+                                         row)) + '\n'
+                           for row in rows)
+        for size in [1, 7, 100, 8192, 1 << 20]:
+            stream = updates_index_postgres.CopyStream(rows)
+            chunks = list(iter(lambda: stream.read(size), ''))
+            self.assertTrue(all(len(chunk) == size for chunk in chunks[:-1]))
+            self.assertEqual(''.join(chunks), expected)
+            self.assertEqual(stream.rows, len(rows))
+
+    def test_read_lazily(self):
+        rows = ((index, 'row') for index in range(100))
+        stream = updates_index_postgres.CopyStream(rows)
+        self.assertEqual(stream.read(6), '0\trow\n')
+        self.assertEqual(stream.rows, 1)
+        self.assertEqual(stream.read(3), '1\tr')
+        self.assertEqual(stream.rows, 2)
+
+if __name__ == '__main__':
+    unittest.main()
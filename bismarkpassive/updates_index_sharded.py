@@ -0,0 +1,324 @@
+"""
+An updates index split across a directory of sqlite databases.
+
+Every shard is an ordinary sqlite updates index holding the sessions of one
+node (shard_by='node') or of the sessions that started in one calendar month
+(shard_by='month'). A catalog database in the same directory records which
+tarballs have been indexed, which shards exist and how the index is sharded.
+
+The indexer hands each shard to one of several writer processes, so shards are
+written in parallel. Each writer keeps a few shards open at once, and closes
+the one it wrote least recently to open another. Runs whose updates are
+grouped by shard, such as tarballs named by node in a node sharded index, open
+each shard once. Readers merge the session catalogs of every shard, but
+session_data only opens the shard its session lives in.
+"""
+
+from calendar import timegm
+from collections import defaultdict, OrderedDict
+from itertools import chain, imap
+from multiprocessing import cpu_count, Process, Queue
+from os import makedirs
+from os.path import basename, exists, join
+from Queue import Full, Queue as ThreadQueue
+import sqlite3
+import sys
+from threading import Thread
+from time import gmtime, strftime, strptime
+import traceback
+
+import updates_index_sqlite
+from updates_index_sqlite import DATABASE_LOCK_TIMEOUT, Session
+
+CATALOG_FILENAME = 'catalog.sqlite'
+SHARDS_DIRECTORY = 'shards'
+
+SHARD_KEYS = ['node', 'month']
+DEFAULT_SHARD_BY = 'node'
+
+# Encoded updates are sent to writers in batches of this many updates, and each
+# writer (and each shard within a writer) can have this many batches waiting.
+BATCH_SIZE = 32
+BATCHES_PER_WRITER = 4
+
+# How many shards each writer process keeps open at once. Every open shard has
+# a thread, a connection and a transaction of its own.
+MAX_OPEN_SHARD_WRITERS = 4
+
+# How many shards a reader keeps open at once.
+MAX_OPEN_SHARDS = 16
+
+# How long to wait on a full queue before checking its consumer is still alive.
+QUEUE_POLL_INTERVAL = 1
+
+def shard_name(shard_by, node_id, session_id):
+    if shard_by == 'node':
+        return node_id
+    elif shard_by == 'month':
+        return strftime('%Y-%m', gmtime(session_id))
+    else:
+        raise ValueError('Invalid shard key %r' % shard_by)
+
+def shard_filename(directory, shard):
+    return join(directory, SHARDS_DIRECTORY, '%s.sqlite' % shard)
+
+def open_catalog(directory):
+    conn = sqlite3.connect(join(directory, CATALOG_FILENAME),
+                           timeout=DATABASE_LOCK_TIMEOUT)
+    conn.execute('''CREATE TABLE IF NOT EXISTS tarnames
+                    (tarname text PRIMARY KEY)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS shards
+                    (shard text PRIMARY KEY)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS settings
+                    (name text PRIMARY KEY, value text)''')
+    conn.commit()
+    return conn
+
+def catalog_shard_by(conn):
+    row = conn.execute(
+            "SELECT value FROM settings WHERE name = 'shard_by'").fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def put(queue, item, consumer):
+    """Put item on a bounded queue, giving up if its consumer has died."""
+    while True:
+        try:
+            queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return
+        except Full:
+            if not consumer.is_alive():
+                raise RuntimeError('Shard writer exited unexpectedly')
+
+def shard_writer(directory, batches, reindex, shard_options):
+    """Index batches of (shard, encoded_updates) from the batches queue until
+    it yields None. Each open shard is written by its own thread, since a
+    shard indexer consumes all of its updates in a single call. When
+    MAX_OPEN_SHARD_WRITERS shards are open, the least recently written one is
+    committed and closed to make room, and indexed again if more of its
+    updates arrive."""
+    open_shards = OrderedDict()
+    opened_shards = set()
+    failures = []
+    def index_shard(shard, queue, reindex):
+        try:
+            indexer = updates_index_sqlite.UpdatesIndexer(
+                    shard_filename(directory, shard), **shard_options)
+            indexer.index([],
+                          chain.from_iterable(iter(queue.get, None)),
+                          reindex)
+            indexer.close()
+        except:
+            print 'Failed to index shard', shard
+            traceback.print_exc(file=sys.stdout)
+            failures.append(shard)
+    def close_shard(shard):
+        queue, thread = open_shards[shard]
+        put(queue, None, thread)
+        thread.join()
+        del open_shards[shard]
+    try:
+        for shard, batch in iter(batches.get, None):
+            if shard in open_shards:
+                open_shards[shard] = open_shards.pop(shard)
+            else:
+                if len(open_shards) >= MAX_OPEN_SHARD_WRITERS:
+                    close_shard(next(iter(open_shards)))
+                queue = ThreadQueue(BATCHES_PER_WRITER)
+                # Only the first pass over a shard needs to rebuild its indexes.
+                thread = Thread(target=index_shard,
+                                args=(shard,
+                                      queue,
+                                      reindex and shard not in opened_shards))
+                thread.daemon = True
+                thread.start()
+                open_shards[shard] = (queue, thread)
+                opened_shards.add(shard)
+            queue, thread = open_shards[shard]
+            put(queue, batch, thread)
+        while open_shards:
+            close_shard(next(iter(open_shards)))
+    except RuntimeError:
+        pass
+    if failures or open_shards:
+        sys.exit(1)
+
+class UpdatesIndexer(object):
+    def __init__(self,
+                 directory,
+                 shard_by=None,
+                 shard_writers=None,
+                 **shard_options):
+        if not exists(join(directory, SHARDS_DIRECTORY)):
+            makedirs(join(directory, SHARDS_DIRECTORY))
+        self._directory = directory
+        self._conn = open_catalog(directory)
+        existing_shard_by = catalog_shard_by(self._conn)
+        if existing_shard_by is None:
+            if shard_by is None:
+                shard_by = DEFAULT_SHARD_BY
+            if shard_by not in SHARD_KEYS:
+                raise ValueError('Invalid shard key %r' % shard_by)
+            self._conn.execute(
+                    "INSERT INTO settings (name, value) VALUES ('shard_by', ?)",
+                    (shard_by,))
+            self._conn.commit()
+        elif shard_by is not None and shard_by != existing_shard_by:
+            raise ValueError('Index is already sharded by %s'
+                             % existing_shard_by)
+        self._shard_by = catalog_shard_by(self._conn)
+        if shard_writers is None:
+            shard_writers = cpu_count()
+        self._shard_writers = max(shard_writers, 1)
+        self._shard_options = shard_options
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def tarnames(self):
+        return map(lambda row: row[0],
+                   self._conn.execute('SELECT tarname FROM tarnames'))
+
+    def index(self, tarnames, encoded_updates, reindex=False):
+        """Index encoded updates into their shards. Every shard commits on
+        its own, so unlike the sqlite indexer, a failed run can leave some
+        shards updated without recording its tarnames. Shards skip updates
+        they already have, so rerunning the failed run doesn't index those
+        updates twice."""
+        writers = []
+        for _ in range(self._shard_writers):
+            batches = Queue(BATCHES_PER_WRITER)
+            writer = Process(target=shard_writer,
+                             args=(self._directory,
+                                   batches,
+                                   reindex,
+                                   self._shard_options))
+            writer.daemon = True
+            writer.start()
+            writers.append((writer, batches))
+
+        print 'Inserting new updates into shards'
+        # Shards are assigned to writers in the order they first appear, which
+        # spreads the shards of a run evenly across the writers.
+        assignments = {}
+        def send(shard, batch):
+            if shard not in assignments:
+                assignments[shard] = writers[len(assignments) % len(writers)]
+            writer, batches = assignments[shard]
+            put(batches, (shard, batch), writer)
+        pending = defaultdict(list)
+        try:
+            for encoded_update in encoded_updates:
+                node_id, row, _ = encoded_update
+                shard = shard_name(self._shard_by, node_id, row[2])
+                pending[shard].append(encoded_update)
+                if len(pending[shard]) >= BATCH_SIZE:
+                    send(shard, pending.pop(shard))
+            for shard, batch in pending.iteritems():
+                send(shard, batch)
+            for writer, batches in writers:
+                put(batches, None, writer)
+        except:
+            exc_info = sys.exc_info()
+            # Killing writers could corrupt shards written without a journal
+            # on disk, so let them commit what they have. The next run skips
+            # those updates.
+            for writer, batches in writers:
+                try:
+                    put(batches, None, writer)
+                except RuntimeError:
+                    pass
+            for writer, _ in writers:
+                writer.join()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for writer, _ in writers:
+            writer.join()
+        if any(writer.exitcode != 0 for writer, _ in writers):
+            raise RuntimeError('Failed to index some shards')
+
+        self._conn.executemany('INSERT OR IGNORE INTO shards (shard) VALUES (?)',
+                               imap(lambda shard: (shard,), assignments))
+        self._conn.executemany(
+                'INSERT OR IGNORE INTO tarnames (tarname) VALUES (?)',
+                imap(lambda n: (basename(n),), tarnames))
+        self._conn.commit()
+
+class UpdatesReader(object):
+    def __init__(self, directory, **shard_options):
+        self._directory = directory
+        conn = open_catalog(directory)
+        self._shard_by = catalog_shard_by(conn)
+        self._shards = map(lambda row: row[0],
+                           conn.execute('SELECT shard FROM shards'))
+        conn.close()
+        self._shard_options = shard_options
+        self._readers = OrderedDict()
+
+    def close(self):
+        for reader in self._readers.itervalues():
+            reader.close()
+        self._readers.clear()
+
+    def _reader(self, shard):
+        """Return a reader for a shard, keeping the most recently used
+        MAX_OPEN_SHARDS shards open."""
+        reader = self._readers.pop(shard, None)
+        if reader is None:
+            reader = updates_index_sqlite.UpdatesReader(
+                    shard_filename(self._directory, shard),
+                    **self._shard_options)
+            if len(self._readers) >= MAX_OPEN_SHARDS:
+                self._readers.popitem(last=False)[1].close()
+        self._readers[shard] = reader
+        return reader
+
+    @property
+    def sessions(self):
+        for entry in self.session_catalog:
+            yield Session(*entry[:3])
+
+    @property
+    def session_catalog(self):
+        """Yield a SessionMetadata for every session in every shard, largest
+        first. This reads the sessions table of each shard in turn."""
+        return self.window_catalog()
+
+    def window_catalog(self, start_time=None, end_time=None):
+        """Yield a SessionMetadata for every session with updates between
+        start_time (inclusive) and end_time (exclusive), largest first. Month
+        shards that start after the window aren't opened."""
+        entries = []
+        for shard in self._shards:
+            if self._shard_by == 'month' and end_time is not None \
+                    and timegm(strptime(shard, '%Y-%m')) >= end_time:
+                continue
+            reader = updates_index_sqlite.UpdatesReader(
+                    shard_filename(self._directory, shard),
+                    **self._shard_options)
+            entries.extend(reader.window_catalog(start_time, end_time))
+            reader.close()
+        entries.sort(key=lambda entry: entry.pickle_size, reverse=True)
+        return iter(entries)
+
+    def _session_reader(self, session):
+        return self._reader(
+                shard_name(self._shard_by, session.node_id, session.id))
+
+    def session_data(self,
+                     session,
+                     first_sequence_number=0,
+                     start_time=None,
+                     end_time=None,
+                     prefetch=False):
+        return self._session_reader(session).session_data(
+                session, first_sequence_number, start_time, end_time, prefetch)
+
+    def session_payloads(self,
+                         session,
+                         first_sequence_number=0,
+                         start_time=None,
+                         end_time=None):
+        return self._session_reader(session).session_payloads(
+                session, first_sequence_number, start_time, end_time)
@@ -0,0 +1,159 @@
+from update_parser_benchmark import encoded_updates
+from updates_index import UpdatesIndexer, UpdatesReader
+import updates_index_sharded
+import updates_index_sqlite
+
+from cStringIO import StringIO
+from os import listdir
+from os.path import join
+from shutil import rmtree
+import sqlite3
+import sys
+from tempfile import mkdtemp
+import unittest
+
+# Sessions of seed 0 start in March 2011, and those of this seed in April.
+APRIL_SEED = 3000000
+APRIL_2011 = 1301616000
+
+def catalog_key(entry):
+    """A catalog entry without its size, which depends on how updates were
+    compressed."""
+    return entry[:3] + entry[4:]
+
+class TestShardedIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.sharded = join(self.directory, 'sharded')
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        rmtree(self.directory)
+
+    def index(self, updates, reindex=False, **options):
+        indexer = UpdatesIndexer('sqlite-sharded', self.sharded, **options)
+        indexer.index(['a.tar'], updates, reindex)
+        indexer.close()
+
+    def reader(self, backend='sqlite-sharded', filename=None):
+        reader = UpdatesReader(backend, filename or self.sharded)
+        self.addCleanup(reader.close)
+        return reader
+
+    def shard_nodes(self, shard):
+        reader = updates_index_sqlite.UpdatesReader(
+                updates_index_sharded.shard_filename(self.sharded, shard))
+        self.addCleanup(reader.close)
+        return sorted(set(session.node_id for session in reader.sessions))
+
+    def catalog(self):
+        return dict((entry.node_id, entry)
+                    for entry in self.reader().session_catalog)
+
+    def assertSameCatalog(self, first, second):
+        self.assertEqual(sorted(map(catalog_key, first)),
+                         sorted(map(catalog_key, second)))
+
+    def test_node_shards(self):
+        updates = encoded_updates(range(3), range(5), interleave=True)
+        self.index(updates, shard_writers=2)
+        self.assertEqual(sorted(listdir(join(self.sharded, 'shards'))),
+                         ['OWBENCHMARK0.sqlite',
+                          'OWBENCHMARK1.sqlite',
+                          'OWBENCHMARK2.sqlite'])
+        for seed in range(3):
+            self.assertEqual(self.shard_nodes('OWBENCHMARK%d' % seed),
+                             ['OWBENCHMARK%d' % seed])
+        single = join(self.directory, 'single.sqlite')
+        indexer = UpdatesIndexer('sqlite', single)
+        indexer.index([], updates)
+        indexer.close()
+        self.assertSameCatalog(self.reader().session_catalog,
+                               self.reader('sqlite', single).session_catalog)
+        self.assertSameCatalog(
+                self.reader().window_catalog(1300000060, 1300000090),
+                self.reader('sqlite', single).window_catalog(1300000060,
+                                                             1300000090))
+        sizes = [entry.pickle_size for entry in self.reader().session_catalog]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        indexer = UpdatesIndexer('sqlite-sharded', self.sharded)
+        self.assertEqual(indexer.tarnames, ['a.tar'])
+        indexer.close()
+
+    def test_month_shards(self):
+        self.index(encoded_updates([0, APRIL_SEED], range(3),
+                                   interleave=True),
+                   shard_by='month')
+        self.assertEqual(sorted(listdir(join(self.sharded, 'shards'))),
+                         ['2011-03.sqlite', '2011-04.sqlite'])
+        self.assertEqual(self.shard_nodes('2011-03'), ['OWBENCHMARK0'])
+        self.assertEqual(self.shard_nodes('2011-04'),
+                         ['OWBENCHMARK%d' % APRIL_SEED])
+        self.assertEqual([entry.node_id for entry
+                          in self.reader().window_catalog(end_time=APRIL_2011)],
+                         ['OWBENCHMARK0'])
+        self.assertEqual(len(list(self.reader().session_catalog)), 2)
+        with self.assertRaises(ValueError):
+            UpdatesIndexer('sqlite-sharded', self.sharded, shard_by='node')
+
+    def reopen_shards(self):
+        """Make writers close and reopen every shard of interleaved
+        updates."""
+        original = (updates_index_sharded.MAX_OPEN_SHARD_WRITERS,
+                    updates_index_sharded.BATCH_SIZE)
+        def restore():
+            (updates_index_sharded.MAX_OPEN_SHARD_WRITERS,
+             updates_index_sharded.BATCH_SIZE) = original
+        self.addCleanup(restore)
+        updates_index_sharded.MAX_OPEN_SHARD_WRITERS = 1
+        updates_index_sharded.BATCH_SIZE = 2
+
+    def assertCompleteSessions(self, sessions, updates):
+        reader = self.reader()
+        catalog = list(reader.session_catalog)
+        self.assertEqual(len(catalog), sessions)
+        for entry in catalog:
+            self.assertEqual((entry.min_sequence_number,
+                              entry.max_sequence_number,
+                              entry.update_count),
+                             (0, updates - 1, updates))
+            self.assertEqual([sequence_number for sequence_number, _
+                              in reader.session_data(entry)],
+                             range(updates))
+
+    def test_reopened_shards(self):
+        self.reopen_shards()
+        self.index(encoded_updates(range(3), range(10), interleave=True),
+                   reindex=True,
+                   shard_writers=1)
+        self.assertCompleteSessions(3, 10)
+
+    def test_rerun_after_failure(self):
+        self.reopen_shards()
+        updates = encoded_updates(range(3), range(10), interleave=True)
+        def failing_updates():
+            for update in updates[:20]:
+                yield update
+            raise ValueError('Invalid tarball')
+        with self.assertRaises(ValueError):
+            self.index(failing_updates(), shard_writers=2)
+        indexer = UpdatesIndexer('sqlite-sharded', self.sharded)
+        self.assertEqual(indexer.tarnames, [])
+        indexer.close()
+        self.index(updates, shard_writers=2)
+        self.assertCompleteSessions(3, 10)
+        for seed in range(3):
+            conn = sqlite3.connect(updates_index_sharded.shard_filename(
+                    self.sharded, 'OWBENCHMARK%d' % seed))
+            (count, size), = conn.execute(
+                    'SELECT count(*), sum(size) FROM updates')
+            conn.close()
+            self.assertEqual(count, 10)
+            self.assertEqual(self.catalog()['OWBENCHMARK%d' % seed]
+                                 .pickle_size,
+                             size)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,61 +1,219 @@
 from collections import namedtuple
 from itertools import imap
 from os.path import basename
-try:
-    from cPickle import dumps, loads, HIGHEST_PROTOCOL
-except ImportError:
-    from pickle import dumps, loads, HIGHEST_PROTOCOL
 import sqlite3
-from zlib import compress, decompress
+from time import time
+from zlib import decompress
+
+from preset_dictionary import Decompressor, DictionaryCompressor
+from update_codec import decode_update
+from prefetch import read_ahead
+from updates_index import decode_payloads, update_timestamp
 
 Session = namedtuple('Session', ['node_id', 'anonymization_context', 'id'])
 
+# Catalog entry for a session. Timestamps are Unix timestamps of the first and
+# last updates, and last_indexer_run is the id of the indexer run that last
+# added updates to the session.
+SessionMetadata = namedtuple('SessionMetadata',
+                             ['node_id',
+                              'anonymization_context',
+                              'id',
+                              'pickle_size',
+                              'min_sequence_number',
+                              'max_sequence_number',
+                              'update_count',
+                              'first_timestamp',
+                              'last_timestamp',
+                              'last_indexer_run'])
+
 DATABASE_LOCK_TIMEOUT=600  # 10 minutes
 
+# In WAL mode the indexer doesn't block readers while it writes, so processing
+# can run during indexing.
+DEFAULT_JOURNAL_MODE = 'WAL'
+
+# Initial builds and reindexing write the whole index in one transaction, which
+# is far too large for the WAL, so they use this journal mode when no readers
+# have the index open.
+BULK_JOURNAL_MODE = 'MEMORY'
+
+# Readers memory map this much of the index and keep this many kilobytes of
+# pages in their cache.
+DEFAULT_MMAP_SIZE = 1 << 30
+DEFAULT_CACHE_SIZE = 64 * 1024
+
+# Columns added to the sessions table after its original schema. New indexes
+# create them with the table, and older ones add them and backfill them.
+CATALOG_COLUMNS = [('min_sequence_number', 'integer'),
+                   ('max_sequence_number', 'integer'),
+                   ('update_count', 'integer'),
+                   ('first_timestamp', 'integer'),
+                   ('last_timestamp', 'integer'),
+                   ('last_indexer_run', 'integer')]
+
 class UpdatesIndex(object):
     def __init__(self, filename):
-        self._conn = sqlite3.connect(filename, timeout=DATABASE_LOCK_TIMEOUT)
+        # session_data can read from a prefetching thread, though only one
+        # thread uses the connection at a time.
+        self._conn = sqlite3.connect(filename,
+                                     timeout=DATABASE_LOCK_TIMEOUT,
+                                     check_same_thread=False)
         self._conn.row_factory = sqlite3.Row
+        self._decompressors = {}
+
+    def close(self):
+        self._conn.close()
+
+    def _decompress(self, dictionary_id, blob):
+        if dictionary_id is None:
+            return decompress(blob)
+        try:
+            decompressor = self._decompressors[dictionary_id]
+        except KeyError:
+            row = self._conn.execute(
+                    '''SELECT dictionary FROM dictionaries
+                       WHERE dictionary_id = ?''',
+                    (dictionary_id,)).fetchone()
+            decompressor = Decompressor(str(row['dictionary']))
+            self._decompressors[dictionary_id] = decompressor
+        return decompressor.decompress(blob)
+
+    def _columns(self, table):
+        return [row['name'] for row
+                in self._conn.execute('PRAGMA table_info(%s)' % table)]
 
 class UpdatesIndexer(UpdatesIndex):
-    def __init__(self, filename):
+    def __init__(self, filename, sqlite_journal_mode=DEFAULT_JOURNAL_MODE):
         super(UpdatesIndexer, self).__init__(filename)
         self._conn.execute('''PRAGMA synchronous = OFF''')
-        self._conn.execute('''PRAGMA journal_mode = MEMORY''')
+        self._conn.execute('PRAGMA journal_mode = %s' % sqlite_journal_mode)
+        self._journal_mode = sqlite_journal_mode
         self._conn.execute('''CREATE TABLE IF NOT EXISTS tarnames
                               (tarname text PRIMARY KEY)''')
-        self._conn.execute('''CREATE TABLE IF NOT EXISTS sessions
-                              (node_id text,
-                               anonymization_context text,
-                               session_id integer,
-                               pickle_size integer,
-                               UNIQUE (node_id,
-                                       anonymization_context,
-                                       session_id)
-                              )''')
         self._conn.execute('''CREATE TABLE IF NOT EXISTS updates
                               (node_id text,
                                anonymization_context text,
                                session_id integer,
                                sequence_number integer,
+                               timestamp integer,
                                pickle blob,
-                               size integer)''')
+                               size integer,
+                               dictionary_id integer)''')
+        columns = self._columns('updates')
+        if 'dictionary_id' not in columns:
+            self._conn.execute('''ALTER TABLE updates
+                                  ADD COLUMN dictionary_id integer''')
+        if 'timestamp' not in columns:
+            self._conn.execute('''ALTER TABLE updates
+                                  ADD COLUMN timestamp integer''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS dictionaries
+                              (dictionary_id integer PRIMARY KEY,
+                               node_id text UNIQUE,
+                               dictionary blob)''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS indexer_runs
+                              (run_id integer PRIMARY KEY,
+                               timestamp integer)''')
+        columns = self._columns('sessions')
+        if not columns:
+            self._conn.execute('''CREATE TABLE sessions
+                                  (node_id text,
+                                   anonymization_context text,
+                                   session_id integer,
+                                   pickle_size integer,
+                                   %s,
+                                   UNIQUE (node_id,
+                                           anonymization_context,
+                                           session_id)
+                                  )'''
+                               % ', '.join('%s %s' % column
+                                           for column in CATALOG_COLUMNS))
+        else:
+            missing_columns = [(name, column_type)
+                               for name, column_type in CATALOG_COLUMNS
+                               if name not in columns]
+            for name, column_type in missing_columns:
+                self._conn.execute('ALTER TABLE sessions ADD COLUMN %s %s'
+                                   % (name, column_type))
+            if missing_columns:
+                self._backfill_catalog()
         self._conn.commit()
 
+    def _backfill_catalog(self):
+        """Fill in the catalog columns of sessions indexed before the catalog
+        existed. Updates from then don't have timestamps in the index, so this
+        decodes the first and last update of each session to find them."""
+        print 'Building session catalog'
+        for row in self._conn.execute(
+                '''SELECT node_id,
+                          anonymization_context,
+                          session_id,
+                          min(sequence_number) AS min_sequence_number,
+                          max(sequence_number) AS max_sequence_number,
+                          count(*) AS update_count
+                   FROM updates
+                   GROUP BY node_id, anonymization_context, session_id''') \
+                .fetchall():
+            key = (row['node_id'], row['anonymization_context'], row['session_id'])
+            timestamps = []
+            for sequence_number in (row['min_sequence_number'],
+                                    row['max_sequence_number']):
+                update = self._conn.execute(
+                        '''SELECT pickle, dictionary_id FROM updates
+                           WHERE node_id = ?
+                           AND anonymization_context = ?
+                           AND session_id = ?
+                           AND sequence_number = ?''',
+                        key + (sequence_number,)).fetchone()
+                timestamps.append(update_timestamp(decode_update(
+                    self._decompress(update['dictionary_id'],
+                                     update['pickle']))))
+            self._conn.execute(
+                    '''UPDATE sessions
+                       SET min_sequence_number = ?,
+                           max_sequence_number = ?,
+                           update_count = ?,
+                           first_timestamp = ?,
+                           last_timestamp = ?
+                       WHERE node_id = ?
+                       AND anonymization_context = ?
+                       AND session_id = ?''',
+                    (row['min_sequence_number'],
+                     row['max_sequence_number'],
+                     row['update_count'])
+                    + tuple(timestamps)
+                    + key)
+
+    def _set_journal_mode(self, journal_mode):
+        """Switch journal modes and return whether it worked. Switching out of
+        WAL mode needs every other connection to the index closed, and this
+        doesn't wait for them."""
+        self._conn.execute('PRAGMA busy_timeout = 0')
+        try:
+            mode = self._conn.execute(
+                    'PRAGMA journal_mode = %s' % journal_mode).fetchone()[0]
+        except sqlite3.OperationalError:
+            return False
+        finally:
+            self._conn.execute('PRAGMA busy_timeout = %d'
+                               % (DATABASE_LOCK_TIMEOUT * 1000))
+        return mode.lower() == journal_mode.lower()
+
     @property
     def tarnames(self):
         return map(lambda row: row['tarname'],
                    self._conn.execute('''SELECT tarname FROM tarnames'''))
 
-    @staticmethod
-    def map_update(update):
-        data = buffer(compress(dumps(update, HIGHEST_PROTOCOL)))
-        return (update.bismark_id,
-                update.anonymization_signature,
-                update.creation_time,
-                update.sequence_number,
-                data,
-                len(data))
+    def dictionary_compressor(self):
+        dictionaries = {}
+        next_dictionary_id = 0
+        for row in self._conn.execute(
+                'SELECT dictionary_id, node_id, dictionary FROM dictionaries'):
+            dictionaries[row['node_id']] = (row['dictionary_id'],
+                                            str(row['dictionary']))
+            next_dictionary_id = max(next_dictionary_id,
+                                     row['dictionary_id'] + 1)
+        return DictionaryCompressor(dictionaries, next_dictionary_id)
 
     @staticmethod
     def map_session(update):
@@ -63,23 +221,49 @@ class UpdatesIndexer(UpdatesIndex):
                 update.anonymization_signature,
                 update.creation_time)
 
-    def index(self, tarnames, updates, reindex=False):
+    def index(self, tarnames, encoded_updates, reindex=False):
+        """Index encoded updates in one transaction, and record tarnames in
+        the same transaction. Updates that are already in the index are
+        skipped."""
+        bulk = (reindex
+                or self._conn.execute('SELECT 1 FROM updates LIMIT 1')
+                        .fetchone() is None) \
+                and self._journal_mode.lower() == 'wal'
+        if bulk and not self._set_journal_mode(BULK_JOURNAL_MODE):
+            print 'Readers have the index open, so writing every update ' \
+                    'to the write-ahead log'
+            bulk = False
         if reindex:
             self._conn.execute('DROP INDEX IF EXISTS updates_index')
-        self._conn.executemany(
-                'INSERT OR IGNORE INTO tarnames (tarname) VALUES (?)',
-                imap(lambda n: (basename(n),), tarnames))
+            self._conn.execute('DROP INDEX IF EXISTS updates_timestamp_index')
+        run_id = self._conn.execute(
+                'INSERT INTO indexer_runs (timestamp) VALUES (?)',
+                (int(time()),)).lastrowid
         print 'Inserting new updates'
+        # Rowids of new rows are larger than any existing rowid, so this
+        # identifies the updates inserted by this run.
+        last_old_rowid = self._conn.execute(
+                'SELECT coalesce(max(rowid), 0) FROM updates').fetchone()[0]
+        compressor = self.dictionary_compressor()
         self._conn.executemany(
                 '''INSERT INTO updates
                    (node_id,
                     anonymization_context,
                     session_id,
                     sequence_number,
+                    timestamp,
                     pickle,
-                    size)
-                   VALUES (?, ?, ?, ?, ?, ?)''',
-                imap(UpdatesIndexer.map_update, updates))
+                    size,
+                    dictionary_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                compressor.compress(encoded_updates))
+        self._conn.executemany(
+                '''INSERT INTO dictionaries (dictionary_id, node_id, dictionary)
+                   VALUES (?, ?, ?)''',
+                compressor.new_dictionaries)
+        self._conn.executemany(
+                'INSERT OR IGNORE INTO tarnames (tarname) VALUES (?)',
+                imap(lambda n: (basename(n),), tarnames))
         print 'Building index'
         self._conn.execute('''CREATE INDEX IF NOT EXISTS
                               updates_index ON updates
@@ -87,22 +271,116 @@ class UpdatesIndexer(UpdatesIndex):
                                anonymization_context,
                                session_id,
                                sequence_number)''')
+        self._conn.execute('''CREATE INDEX IF NOT EXISTS
+                              updates_timestamp_index ON updates
+                              (node_id,
+                               anonymization_context,
+                               session_id,
+                               timestamp)''')
+        if last_old_rowid > 0:
+            # A failed run of a sharded index can leave some of its shards
+            # committed, so the next run sends their updates again.
+            self._conn.execute(
+                    '''DELETE FROM updates
+                       WHERE rowid > :last_old_rowid
+                       AND EXISTS (SELECT 1 FROM updates AS old
+                                   WHERE old.node_id = updates.node_id
+                                   AND old.anonymization_context
+                                       = updates.anonymization_context
+                                   AND old.session_id = updates.session_id
+                                   AND old.sequence_number
+                                       = updates.sequence_number
+                                   AND old.rowid <= :last_old_rowid)''',
+                    { 'last_old_rowid': last_old_rowid })
         print 'Computing sessions'
-        self._conn.execute('DELETE FROM sessions')
-        self._conn.execute(
-                '''INSERT INTO sessions
-                   (node_id, anonymization_context, session_id, pickle_size)
-                   SELECT node_id,
+        new_sessions = self._conn.execute(
+                '''SELECT node_id,
                           anonymization_context,
                           session_id,
-                          sum(size)
+                          sum(size),
+                          min(sequence_number),
+                          max(sequence_number),
+                          count(*),
+                          min(timestamp),
+                          max(timestamp)
                    FROM updates
-                   GROUP BY node_id, anonymization_context, session_id''')
+                   WHERE rowid > ?
+                   GROUP BY node_id, anonymization_context, session_id''',
+                (last_old_rowid,)).fetchall()
+        for row in new_sessions:
+            inserted = self._conn.execute(
+                    '''INSERT OR IGNORE INTO sessions
+                       (node_id,
+                        anonymization_context,
+                        session_id,
+                        pickle_size,
+                        min_sequence_number,
+                        max_sequence_number,
+                        update_count,
+                        first_timestamp,
+                        last_timestamp,
+                        last_indexer_run)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    tuple(row) + (run_id,)).rowcount
+            if not inserted:
+                self._conn.execute(
+                        '''UPDATE sessions
+                           SET pickle_size = pickle_size + :pickle_size,
+                               min_sequence_number = min(
+                                   coalesce(min_sequence_number, :min_sequence),
+                                   :min_sequence),
+                               max_sequence_number = max(
+                                   coalesce(max_sequence_number, :max_sequence),
+                                   :max_sequence),
+                               update_count
+                                   = coalesce(update_count, 0) + :update_count,
+                               first_timestamp = min(
+                                   coalesce(first_timestamp, :first_timestamp),
+                                   :first_timestamp),
+                               last_timestamp = max(
+                                   coalesce(last_timestamp, :last_timestamp),
+                                   :last_timestamp),
+                               last_indexer_run = :run_id
+                           WHERE node_id = :node_id
+                           AND anonymization_context = :anonymization_context
+                           AND session_id = :session_id''',
+                        { 'node_id': row[0],
+                          'anonymization_context': row[1],
+                          'session_id': row[2],
+                          'pickle_size': row[3],
+                          'min_sequence': row[4],
+                          'max_sequence': row[5],
+                          'update_count': row[6],
+                          'first_timestamp': row[7],
+                          'last_timestamp': row[8],
+                          'run_id': run_id,
+                        })
         self._conn.commit()
+        if bulk:
+            # If readers opened the index in the meantime, the next indexer
+            # run switches back instead.
+            self._set_journal_mode(self._journal_mode)
 
 class UpdatesReader(UpdatesIndex):
-    def __init__(self, filename):
+    def __init__(self,
+                 filename,
+                 sqlite_read_only=True,
+                 sqlite_mmap_size=DEFAULT_MMAP_SIZE,
+                 sqlite_cache_size=DEFAULT_CACHE_SIZE):
         super(UpdatesReader, self).__init__(filename)
+        # Python 2's sqlite3 module can't open read-only URIs, so use
+        # query_only instead.
+        if sqlite_read_only:
+            self._conn.execute('PRAGMA query_only = ON')
+        self._conn.execute('PRAGMA mmap_size = %d' % sqlite_mmap_size)
+        # Negative cache sizes are in kilobytes rather than pages.
+        self._conn.execute('PRAGMA cache_size = %d' % -sqlite_cache_size)
+        # Indexes built before time windows existed get this index the next
+        # time the indexer runs.
+        self._timestamp_index = self._conn.execute(
+                '''SELECT 1 FROM sqlite_master
+                   WHERE type = 'index' AND name = 'updates_timestamp_index'
+                   ''').fetchone() is not None
 
     @property
     def sessions(self):
@@ -113,17 +391,108 @@ class UpdatesReader(UpdatesIndex):
                           row['anonymization_context'],
                           row['session_id'])
 
-    def session_data(self, session, first_sequence_number=0):
+    @property
+    def session_catalog(self):
+        """Yield a SessionMetadata for every session, largest first. This only
+        reads the sessions table."""
+        for row in self._conn.execute(
+                '''SELECT node_id,
+                          anonymization_context,
+                          session_id,
+                          pickle_size,
+                          min_sequence_number,
+                          max_sequence_number,
+                          update_count,
+                          first_timestamp,
+                          last_timestamp,
+                          last_indexer_run
+                   FROM sessions ORDER BY pickle_size DESC'''):
+            yield SessionMetadata(*row)
+
+    def window_catalog(self, start_time=None, end_time=None):
+        """Yield a SessionMetadata for every session with updates between
+        start_time (inclusive) and end_time (exclusive), largest first.
+        Sessions without catalog timestamps are always included."""
         for row in self._conn.execute(
-                '''SELECT sequence_number, pickle FROM updates
+                '''SELECT node_id,
+                          anonymization_context,
+                          session_id,
+                          pickle_size,
+                          min_sequence_number,
+                          max_sequence_number,
+                          update_count,
+                          first_timestamp,
+                          last_timestamp,
+                          last_indexer_run
+                   FROM sessions
+                   WHERE (:start_time IS NULL
+                          OR last_timestamp IS NULL
+                          OR last_timestamp >= :start_time)
+                   AND (:end_time IS NULL
+                        OR first_timestamp IS NULL
+                        OR first_timestamp < :end_time)
+                   ORDER BY pickle_size DESC''',
+                { 'start_time': start_time, 'end_time': end_time }):
+            yield SessionMetadata(*row)
+
+    def session_data(self,
+                     session,
+                     first_sequence_number=0,
+                     start_time=None,
+                     end_time=None,
+                     prefetch=False):
+        """Yield (sequence_number, update) for the updates of a session from
+        first_sequence_number on. If start_time or end_time is given, only
+        yield updates between start_time (inclusive) and end_time
+        (exclusive). If prefetch is true, a background thread reads and
+        decompresses updates ahead of the caller."""
+        payloads = self.session_payloads(
+                session, first_sequence_number, start_time, end_time)
+        if prefetch:
+            payloads = read_ahead(payloads)
+        return decode_payloads(payloads, start_time, end_time)
+
+    def session_payloads(self,
+                         session,
+                         first_sequence_number=0,
+                         start_time=None,
+                         end_time=None):
+        """Yield (sequence_number, timestamp, data) for the updates that
+        session_data would return, where data is the decompressed encoding of
+        the update. timestamp is None for updates indexed without one, which
+        might lie outside the time window."""
+        query = '''SELECT sequence_number, timestamp, pickle, dictionary_id
+                   FROM updates
                    WHERE node_id = ?
                    AND anonymization_context = ?
                    AND session_id = ?
-                   AND sequence_number >= ?
-                   ORDER BY sequence_number''',
-                (session.node_id,
-                 session.anonymization_context,
-                 session.id,
-                 first_sequence_number)):
+                   AND sequence_number >= ?'''
+        arguments = [session.node_id,
+                     session.anonymization_context,
+                     session.id,
+                     first_sequence_number]
+        if start_time is not None or end_time is not None:
+            # Updates indexed before the timestamp column existed don't have
+            # one, so select them separately and check their timestamps after
+            # decoding them. Without statistics sqlite prefers updates_index
+            # for both halves, since it returns rows in order.
+            if self._timestamp_index:
+                query = query.replace(
+                        'FROM updates',
+                        'FROM updates INDEXED BY updates_timestamp_index')
+            window_query = query
+            window_arguments = list(arguments)
+            if start_time is not None:
+                window_query += ' AND timestamp >= ?'
+                window_arguments.append(start_time)
+            if end_time is not None:
+                window_query += ' AND timestamp < ?'
+                window_arguments.append(end_time)
+            query = '%s UNION ALL %s AND timestamp IS NULL' \
+                    % (window_query, query)
+            arguments = window_arguments + arguments
+        query += ' ORDER BY sequence_number'
+        for row in self._conn.execute(query, arguments):
             yield (row['sequence_number'],
-                   loads(decompress(row['pickle'])))
+                   row['timestamp'],
+                   self._decompress(row['dictionary_id'], row['pickle']))
@@ -0,0 +1,219 @@
+from update_parser_benchmark import encoded_updates
+import updates_index_sqlite
+
+from cStringIO import StringIO
+from os.path import exists, join
+from shutil import rmtree
+import sqlite3
+import sys
+from tempfile import mkdtemp
+import unittest
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.filename = join(self.directory, 'index.sqlite')
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        rmtree(self.directory)
+
+    def index(self, updates, reindex=False):
+        indexer = updates_index_sqlite.UpdatesIndexer(self.filename)
+        indexer.index([], updates, reindex)
+        indexer.close()
+
+    def reader(self, **options):
+        reader = updates_index_sqlite.UpdatesReader(self.filename, **options)
+        self.addCleanup(reader.close)
+        return reader
+
+    def journal_mode(self):
+        conn = sqlite3.connect(self.filename)
+        mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        conn.close()
+        return mode
+
+class TestJournalMode(IndexTestCase):
+    def wal_exists_while_indexing(self, updates, reindex=False):
+        """Index updates and return whether the index had a write-ahead log
+        while they were inserted."""
+        wal_exists = []
+        def check_wal():
+            wal_exists.append(exists(self.filename + '-wal'))
+            for update in updates:
+                yield update
+        self.index(check_wal(), reindex)
+        return wal_exists[0]
+
+    def test_bulk_indexing(self):
+        self.assertFalse(self.wal_exists_while_indexing(
+                encoded_updates([0], range(5))))
+        self.assertEqual(self.journal_mode(), 'wal')
+        self.assertTrue(self.wal_exists_while_indexing(
+                encoded_updates([0], range(5, 10))))
+        self.assertFalse(self.wal_exists_while_indexing(
+                encoded_updates([0], range(10, 15)), reindex=True))
+        self.assertEqual(self.journal_mode(), 'wal')
+        session, = self.reader().sessions
+        self.assertEqual([sequence_number for sequence_number, _
+                          in self.reader().session_data(session)],
+                         range(15))
+
+    def test_reindex_with_open_reader(self):
+        self.index(encoded_updates([0], range(5)))
+        reader = self.reader()
+        self.assertEqual(len(list(reader.sessions)), 1)
+        self.assertTrue(self.wal_exists_while_indexing(
+                encoded_updates([1], range(5)), reindex=True))
+        self.assertEqual(len(list(reader.sessions)), 2)
+
+class TestReaderOptions(IndexTestCase):
+    def setUp(self):
+        super(TestReaderOptions, self).setUp()
+        self.index(encoded_updates([0], range(2)))
+
+    def test_read_only(self):
+        reader = self.reader()
+        with self.assertRaises(sqlite3.OperationalError):
+            reader._conn.execute('DELETE FROM updates')
+        reader = self.reader(sqlite_read_only=False)
+        reader._conn.execute('DELETE FROM updates')
+        reader._conn.rollback()
+
+    def test_cache_and_mmap_size(self):
+        reader = self.reader(sqlite_cache_size=1234, sqlite_mmap_size=1 << 20)
+        self.assertEqual(
+                reader._conn.execute('PRAGMA cache_size').fetchone()[0], -1234)
+        # sqlite can be built without memory mapping.
+        self.assertIn(reader._conn.execute('PRAGMA mmap_size').fetchone()[0],
+                      [0, 1 << 20])
+        reader = self.reader()
+        self.assertEqual(
+                reader._conn.execute('PRAGMA cache_size').fetchone()[0],
+                -updates_index_sqlite.DEFAULT_CACHE_SIZE)
+
+class TestSessionCatalog(IndexTestCase):
+    def catalog(self):
+        return dict((entry.node_id, entry)
+                    for entry in self.reader().session_catalog)
+
+    def test_incremental_catalog(self):
+        self.index(encoded_updates([0], range(5)))
+        self.index(encoded_updates([0], range(5, 10))
+                   + encoded_updates([1], range(3)))
+        self.index(encoded_updates([1], range(3, 5)))
+        catalog = self.catalog()
+        self.assertEqual(tuple(catalog['OWBENCHMARK0'][4:]),
+                         (0, 9, 10, 1300000000, 1300000270, 2))
+        self.assertEqual(tuple(catalog['OWBENCHMARK1'][4:]),
+                         (0, 4, 5, 1300000001, 1300000121, 3))
+        conn = sqlite3.connect(self.filename)
+        sizes = dict(conn.execute('''SELECT node_id, sum(size) FROM updates
+                                     GROUP BY node_id'''))
+        conn.close()
+        for node_id, entry in catalog.iteritems():
+            self.assertEqual(entry.pickle_size, sizes[node_id])
+        self.assertEqual([entry.node_id
+                          for entry in self.reader().session_catalog],
+                         ['OWBENCHMARK0', 'OWBENCHMARK1'])
+
+    def test_skip_indexed_updates(self):
+        self.index(encoded_updates([0], range(5)))
+        self.index(encoded_updates([0], range(3, 8)))
+        entry = self.catalog()['OWBENCHMARK0']
+        self.assertEqual(tuple(entry[4:7]), (0, 7, 8))
+        self.assertEqual([sequence_number for sequence_number, _
+                          in self.reader().session_data(entry)],
+                         range(8))
+
+    def test_new_index(self):
+        self.index(encoded_updates([0], range(2)))
+        self.assertNotIn('Building session catalog', sys.stdout.getvalue())
+        self.assertEqual(self.catalog()['OWBENCHMARK0'].update_count, 2)
+
+    def test_backfill_old_index(self):
+        self.index(encoded_updates([0, 1], range(3)))
+        catalog = self.catalog()
+        conn = sqlite3.connect(self.filename)
+        conn.executescript('''
+                ALTER TABLE sessions RENAME TO new_sessions;
+                CREATE TABLE sessions
+                (node_id text,
+                 anonymization_context text,
+                 session_id integer,
+                 pickle_size integer,
+                 UNIQUE (node_id, anonymization_context, session_id));
+                INSERT INTO sessions
+                SELECT node_id, anonymization_context, session_id, pickle_size
+                FROM new_sessions;
+                DROP TABLE new_sessions;''')
+        conn.close()
+        updates_index_sqlite.UpdatesIndexer(self.filename).close()
+        self.assertEqual(
+                sys.stdout.getvalue().count('Building session catalog'), 1)
+        for node_id, entry in self.catalog().iteritems():
+            self.assertEqual(entry[:9], catalog[node_id][:9])
+        updates_index_sqlite.UpdatesIndexer(self.filename).close()
+        self.assertEqual(
+                sys.stdout.getvalue().count('Building session catalog'), 1)
+
+class TestTimeWindows(IndexTestCase):
+    def setUp(self):
+        super(TestTimeWindows, self).setUp()
+        # Update n of seed s is written at 1300000000 + s + 30 * n.
+        self.index(encoded_updates(range(2), range(10)))
+
+    def window_nodes(self, start_time=None, end_time=None):
+        return sorted(entry.node_id for entry
+                      in self.reader().window_catalog(start_time, end_time))
+
+    def window_sequence_numbers(self, start_time, end_time, first=0):
+        reader = self.reader()
+        session, = [session for session in reader.session_catalog
+                    if session.node_id == 'OWBENCHMARK0']
+        return [sequence_number for sequence_number, update
+                in reader.session_data(session,
+                                       first,
+                                       start_time=start_time,
+                                       end_time=end_time)]
+
+    def test_window_catalog(self):
+        self.assertEqual(self.window_nodes(), ['OWBENCHMARK0', 'OWBENCHMARK1'])
+        self.assertEqual(self.window_nodes(1300000271),
+                         ['OWBENCHMARK1'])
+        self.assertEqual(self.window_nodes(end_time=1300000001),
+                         ['OWBENCHMARK0'])
+        self.assertEqual(self.window_nodes(1300000300), [])
+        conn = sqlite3.connect(self.filename)
+        conn.execute('''UPDATE sessions
+                        SET first_timestamp = NULL, last_timestamp = NULL
+                        WHERE session_id = 1300000001''')
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.window_nodes(1300000300), ['OWBENCHMARK1'])
+
+    def test_session_data(self):
+        self.assertEqual(self.window_sequence_numbers(1300000060, 1300000150),
+                         [2, 3, 4])
+        self.assertEqual(
+                self.window_sequence_numbers(1300000060, 1300000150, first=3),
+                [3, 4])
+        self.assertEqual(self.window_sequence_numbers(None, 1300000030), [0])
+        self.assertEqual(self.window_sequence_numbers(1300000270, None), [9])
+
+    def test_updates_without_timestamps(self):
+        conn = sqlite3.connect(self.filename)
+        conn.execute('''UPDATE updates SET timestamp = NULL
+                        WHERE sequence_number >= 5''')
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.window_sequence_numbers(1300000120, 1300000210),
+                         [4, 5, 6])
+        self.assertEqual(self.window_sequence_numbers(1300000240, None),
+                         [8, 9])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,12 +17,22 @@ from collections import defaultdict
 import bismarkpassive
 
 class SimpleByteCountProcessor(bismarkpassive.PersistentSessionProcessor):
+    # Byte counts from different sessions add up in any order, so workers can
+    # merge sessions in parallel, and subtracting a session's count removes it.
+    mergeable = True
+    retractable = True
+
     def initialize_context(self, context):
         context.number_of_bytes_this_session = 0
 
     def process_update_persistent(self, context, update):
-        for packet in update.packet_series:
-            context.number_of_bytes_this_session += packet.size
+        if isinstance(update.packet_series, bismarkpassive.PacketSeries):
+            # Indexes built with --columnar store packet sizes in an array.
+            context.number_of_bytes_this_session += \
+                    sum(update.packet_series.sizes)
+        else:
+            for packet in update.packet_series:
+                context.number_of_bytes_this_session += packet.size
 
     def initialize_global_context(self, global_context):
         global_context.number_of_bytes_per_node = defaultdict(int)
@@ -30,6 +40,16 @@ class SimpleByteCountProcessor(bismarkpassive.PersistentSessionProcessor):
     def merge_contexts_persistent(self, context, global_context):
         global_context.number_of_bytes_per_node[context.node_id] += context.number_of_bytes_this_session
 
+    def combine_global_contexts(self, global_context, partial_global_context):
+        for node_id, count in \
+                partial_global_context.number_of_bytes_per_node.items():
+            global_context.number_of_bytes_per_node[node_id] += count
+
+    def retract_global_context(self, global_context, partial_global_context):
+        for node_id, count in \
+                partial_global_context.number_of_bytes_per_node.items():
+            global_context.number_of_bytes_per_node[node_id] -= count
+
 class PrintByteCountsHarness(bismarkpassive.Harness):
     @property
     def processors(self):
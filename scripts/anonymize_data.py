@@ -11,6 +11,12 @@ from os.path import basename, join, splitext
 import sys
 import tarfile
 
+from bismarkpassive.index_traces import CHUNK_SIZE, HashingReader
+
+def file_checksum(filename):
+    with open(filename, 'rb', CHUNK_SIZE) as handle:
+        return HashingReader(handle).hexdigest()
+
 def anonymize_update(tarfilename, destination_directory, check_destination):
     # extract the router ID from file name and create an MD5 hash
     router_id = basename(tarfilename).split('_', 1)[0]
@@ -27,9 +33,7 @@ def anonymize_update(tarfilename, destination_directory, check_destination):
         if check_destination:
             true_sum = splitext(
                     basename(existing_filenames[0]))[0].split('_')[3]
-            hasher = md5()
-            hasher.update(open(existing_filenames[0], 'r').read())
-            if hasher.hexdigest() == true_sum:
+            if file_checksum(existing_filenames[0]) == true_sum:
                 sys.stdout.write('_')
                 sys.stdout.flush()
                 return
@@ -44,52 +48,57 @@ def anonymize_update(tarfilename, destination_directory, check_destination):
         true_sum = splitext(basename(tarfilename))[0].split('_')[3]
     except IndexError:
         true_sum = None
-    if true_sum is not None:
-        hasher = md5()
-        hasher.update(open(tarfilename, 'r').read())
-        if hasher.hexdigest() != true_sum:
-            sys.stdout.write('?')
-            sys.stdout.flush()
-            return
-    sys.stdout.write('.')
-    sys.stdout.flush()
 
-    # Read a tar file and output an anonymized tar file
-    tarball = tarfile.open(tarfilename, 'r')
-    outfile = StringIO()
-    outtarball = tarfile.open(fileobj=outfile, mode='w')
-    for tarmember in tarball:
-        # get the .gz file
-        tarhandle = tarball.extractfile(tarmember.name)
-        logfile = GzipFile(fileobj=tarhandle)
-        outtarbuffer = StringIO()
-        outtarhandle = GzipFile(mode='w', fileobj=outtarbuffer)
-        unanonymized = False
-        for line in logfile:
-            if line.startswith('UNANONYMIZED'):
-                unanonymized = True
-                break
-            outtarhandle.write(line.replace(router_id, hashed_router_id))
-        if unanonymized:
-            continue
+    # Read a tar file and output an anonymized tar file, verifying the input's
+    # checksum in the same pass.
+    inhandle = open(tarfilename, 'rb', CHUNK_SIZE)
+    try:
+        inreader = HashingReader(inhandle)
+        tarball = tarfile.open(tarfilename, 'r|', fileobj=inreader)
+        outfile = StringIO()
+        outtarball = tarfile.open(fileobj=outfile, mode='w')
+        for tarmember in tarball:
+            # get the .gz file. GzipFile seeks backwards, which tarball streams
+            # don't allow, so read it into memory first.
+            tarhandle = StringIO(tarball.extractfile(tarmember).read())
+            logfile = GzipFile(fileobj=tarhandle)
+            outtarbuffer = StringIO()
+            outtarhandle = GzipFile(mode='w', fileobj=outtarbuffer)
+            unanonymized = False
+            for line in logfile:
+                if line.startswith('UNANONYMIZED'):
+                    unanonymized = True
+                    break
+                outtarhandle.write(line.replace(router_id, hashed_router_id))
+            if unanonymized:
+                continue
 
-        # write compressed lines to the .gz file
-        outtarhandle.close()
-        outtarsize = outtarbuffer.tell() # size of the final buffer
-        outtarbuffer.seek(0)
+            # write compressed lines to the .gz file
+            outtarhandle.close()
+            outtarsize = outtarbuffer.tell() # size of the final buffer
+            outtarbuffer.seek(0)
 
-        # anonymize the router id from the gzip file as well
-        outgzname = '%s-%s' % (hashed_router_id,
-                               tarmember.name.split('-', 1)[1])
-        outtarmember = tarfile.TarInfo(name=outgzname)
-        outtarmember.size = outtarsize
-        outtarmember.mtime = tarmember.mtime
-        outtarmember.mode = tarmember.mode
-        outtarmember.type = tarmember.type
+            # anonymize the router id from the gzip file as well
+            outgzname = '%s-%s' % (hashed_router_id,
+                                   tarmember.name.split('-', 1)[1])
+            outtarmember = tarfile.TarInfo(name=outgzname)
+            outtarmember.size = outtarsize
+            outtarmember.mtime = tarmember.mtime
+            outtarmember.mode = tarmember.mode
+            outtarmember.type = tarmember.type
 
-        # add anonymized .gz file to tarball 
-        outtarball.addfile(outtarmember, outtarbuffer)
-    outtarball.close()
+            # add anonymized .gz file to tarball 
+            outtarball.addfile(outtarmember, outtarbuffer)
+        outtarball.close()
+        checksum = inreader.hexdigest()
+    finally:
+        inhandle.close()
+    if true_sum is not None and checksum != true_sum:
+        sys.stdout.write('?')
+        sys.stdout.flush()
+        return
+    sys.stdout.write('.')
+    sys.stdout.flush()
 
     # Change the md5sum in the name of the file
     m = md5()
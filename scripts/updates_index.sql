@@ -9,7 +9,13 @@ CREATE TABLE sessions
     node_id text,
     anonymization_context text,
     session_id bigint,
-    pickle_size bigint
+    pickle_size bigint,
+    min_sequence_number integer,
+    max_sequence_number integer,
+    update_count integer,
+    first_timestamp bigint,
+    last_timestamp bigint,
+    last_indexer_run integer
 );
 
 CREATE TABLE updates
@@ -18,35 +24,25 @@ CREATE TABLE updates
     anonymization_context text,
     session_id bigint,
     sequence_number integer,
+    timestamp bigint,
     pickle bytea,
-    size integer
+    size integer,
+    dictionary_id integer
 );
 CREATE INDEX updates_index ON updates
 (node_id, anonymization_context, session_id, sequence_number);
+CREATE INDEX updates_timestamp_index ON updates
+(node_id, anonymization_context, session_id, timestamp);
 
-CREATE FUNCTION insert_new_update
-(text, text, bigint, integer, bytea, integer)
-RETURNS VOID AS
-$$
-INSERT INTO updates
-(node_id,
- anonymization_context,
- session_id,
- sequence_number,
- pickle,
- size)
-VALUES ($1, $2, $3, $4, $5, $6);
-UPDATE sessions SET pickle_size = pickle_size + $6
-WHERE node_id = $1
-AND anonymization_context = $2
-AND session_id = $3;
-INSERT INTO sessions
-(node_id, anonymization_context, session_id, pickle_size)
-SELECT $1, $2, $3, $6
-WHERE NOT EXISTS
-(SELECT 1 FROM sessions
- WHERE node_id = $1
- AND anonymization_context = $2
- AND session_id = $3);
-$$
-LANGUAGE sql;
+CREATE TABLE indexer_runs
+(
+    run_id serial PRIMARY KEY,
+    timestamp bigint
+);
+
+CREATE TABLE dictionaries
+(
+    dictionary_id integer PRIMARY KEY,
+    node_id text UNIQUE,
+    dictionary bytea
+);